@@ -1,4 +1,5 @@
 from distrib_rl.experience import Timestep, Trajectory
+from distrib_rl.environments.vector_env import FINAL_OBSERVATION_KEY
 import numpy as np
 import torch
 import time
@@ -10,6 +11,11 @@ class BaseAgent(object):
         self.leftover_obs = None
         self.ep_rewards = []
         self.current_ep_rew = 0
+        self.current_ep_rews = None
+
+        # Length of the last finished episode, used to size the next
+        # trajectory's buffers.
+        self.length_hint = None
 
     @torch.no_grad()
     def gather_timesteps(
@@ -20,18 +26,54 @@ class BaseAgent(object):
         num_timesteps=None,
         num_seconds=None,
         num_eps=None,
+        update_fn=None,
+        num_active_envs=None,
     ):
+        """
+        Collect experience from env with policy.
+        :param update_fn: Optional function called before every step. If it
+                          returns a new policy epoch, the policy weights have
+                          changed and the current trajectory is cut so every
+                          trajectory records the epoch it was actually
+                          collected under.
+        :param num_active_envs: Optional number of envs of a VectorEnv to step,
+                                the rest stay paused.
+        """
+
+        if getattr(env, "num_envs", 1) > 1:
+            yield from self._gather_vectorized(
+                policy,
+                policy_epoch,
+                env,
+                num_timesteps,
+                num_seconds,
+                num_eps,
+                update_fn,
+                num_active_envs,
+            )
+            return
+
         trajectoryCount = 0
-        trajectory = Trajectory()
+        trajectory = Trajectory(policy_epoch, self.length_hint)
         if self.leftover_obs is None:
             obs = env.reset()
         else:
             obs = self.leftover_obs
 
+        # The policy fills in the action and log prob, add copies everything
+        # out so one timestep is enough.
+        ts = Timestep()
         cumulative_timesteps = 0
         start_time = time.time()
         while True:
-            ts = Timestep()
+            if update_fn is not None:
+                new_epoch = update_fn()
+                if new_epoch is not None and new_epoch != policy_epoch:
+                    policy_epoch = new_epoch
+                    if len(trajectory.obs) > 0:
+                        trajectory.final_obs = obs
+                        yield trajectory
+                    trajectory = Trajectory(policy_epoch, self.length_hint)
 
             # ts.action and ts.log_prob will be filled here
             action = self._get_policy_action(policy, obs, ts)
@@ -40,21 +82,19 @@ class BaseAgent(object):
             done = terminated or truncated
 
             self.current_ep_rew += rew
-            ts.reward = rew
-            ts.obs = obs
-            ts.done = 1 if done else 0
-            trajectory.register_timestep(ts)
+            trajectory.add(ts.action, ts.log_prob, rew, obs, 1 if done else 0)
             cumulative_timesteps += 1
 
             if done:
                 self.ep_rewards.append(self.current_ep_rew)
                 self.current_ep_rew = 0
+                self.length_hint = len(trajectory)
 
                 trajectory.final_obs = next_obs
                 trajectoryCount += 1
 
                 yield trajectory
-                trajectory = Trajectory()
+                trajectory = Trajectory(policy_epoch, self.length_hint)
 
                 next_obs = env.reset()
 
@@ -76,6 +116,99 @@ class BaseAgent(object):
             trajectory.final_obs = next_obs
             yield trajectory
 
+    def _gather_vectorized(
+        self,
+        policy,
+        policy_epoch,
+        env,
+        num_timesteps,
+        num_seconds,
+        num_eps,
+        update_fn,
+        num_active_envs=None,
+    ):
+        """
+        Collect experience from a VectorEnv, picking the actions of every env
+        with one forward pass of the policy. Each env still gets its own
+        trajectories, and num_timesteps counts the timesteps of all envs
+        together. Only the first num_active_envs envs are stepped if it is
+        given.
+        """
+
+        n_envs = env.num_envs
+        n_active = n_envs if num_active_envs is None else min(n_envs, num_active_envs)
+        trajectory_count = 0
+        trajectories = [
+            Trajectory(policy_epoch, self.length_hint) for _ in range(n_envs)
+        ]
+        if self.leftover_obs is None:
+            obs = env.reset()
+        else:
+            obs = self.leftover_obs
+
+        if self.current_ep_rews is None:
+            self.current_ep_rews = np.zeros(n_envs, dtype=np.float32)
+
+        cumulative_timesteps = 0
+        start_time = time.time()
+        while True:
+            if update_fn is not None:
+                new_epoch = update_fn()
+                if new_epoch is not None and new_epoch != policy_epoch:
+                    policy_epoch = new_epoch
+                    for i in range(n_envs):
+                        if len(trajectories[i].obs) > 0:
+                            trajectories[i].final_obs = obs[i]
+                            yield trajectories[i]
+                    trajectories = [
+                        Trajectory(policy_epoch, self.length_hint)
+                        for _ in range(n_envs)
+                    ]
+
+            actions, log_probs = self._get_policy_actions(policy, obs[:n_active])
+            next_obs, rews, terminated, truncated, infos = env.step(actions)
+            dones = terminated | truncated
+            self.current_ep_rews[:n_active] += rews
+
+            for i in range(n_active):
+                trajectories[i].add(
+                    actions[i], log_probs[i], rews[i], obs[i], 1 if dones[i] else 0
+                )
+
+                if dones[i]:
+                    self.ep_rewards.append(float(self.current_ep_rews[i]))
+                    self.current_ep_rews[i] = 0
+                    self.length_hint = len(trajectories[i])
+
+                    # The env has already been reset, its last observation
+                    # comes back in the info dict.
+                    trajectories[i].final_obs = infos[i][FINAL_OBSERVATION_KEY]
+                    trajectory_count += 1
+
+                    yield trajectories[i]
+                    trajectories[i] = Trajectory(policy_epoch, self.length_hint)
+
+            cumulative_timesteps += n_active
+            if n_active < n_envs:
+                next_obs = np.concatenate((next_obs, obs[n_active:]))
+            obs = next_obs
+            if (
+                num_timesteps is not None
+                and cumulative_timesteps >= num_timesteps
+                or num_seconds is not None
+                and time.time() - start_time >= num_seconds
+                or num_eps is not None
+                and trajectory_count >= num_eps
+            ):
+                break
+
+        self.leftover_obs = obs
+
+        for i in range(n_envs):
+            if len(trajectories[i].obs) > 0:
+                trajectories[i].final_obs = obs[i]
+                yield trajectories[i]
+
     @torch.no_grad()
     def evaluate_policy(self, policy, env, num_timesteps=0, num_eps=1, render=False):
         obs = env.reset()
@@ -106,3 +239,11 @@ class BaseAgent(object):
 
     def _get_policy_action(self, policy, obs, timestep, evaluate=False):
         raise NotImplementedError
+
+    def _get_policy_actions(self, policy, obs):
+        """
+        :param obs: Batch holding the current observation of every env.
+        :return: Tuple of (actions, log probabilities) with one row per env.
+        """
+
+        raise NotImplementedError
@@ -1,4 +1,4 @@
-from distrib_rl.experience import Timestep, Trajectory
+from distrib_rl.experience import Trajectory
 from distrib_rl.policies import policy_factory
 from distrib_rl.marl import OpponentSelector
 import numpy as np
@@ -17,6 +17,9 @@ class MARLAgent(object):
         self.ep_rewards = []
         self.current_ep_rew = 0
         self.policies = None
+        self.policy_groups = None
+        self.learner_groups = None
+        self.length_hint = None
 
         # TODO: replace this with something more generic
         self.n_agents = (
@@ -34,6 +37,7 @@ class MARLAgent(object):
         num_timesteps=None,
         num_seconds=None,
         num_eps=None,
+        update_fn=None,
     ):
         n_agents = self.n_agents
         agents_to_save = n_agents if self.save_both_teams else n_agents // 2
@@ -42,12 +46,11 @@ class MARLAgent(object):
             self.init_opponent_policy(env)
 
         if self.policies is None:
-            self.policies = [policy for _ in range(n_agents // 2)] + [
-                self.opponent_policy for _ in range(n_agents // 2)
-            ]
-        policies = self.policies
+            self._init_policy_groups(policy)
         experience_trajectories = []
-        trajectories = [Trajectory(policy_epoch) for _ in range(n_agents)]
+        trajectories = [
+            Trajectory(policy_epoch, self.length_hint) for _ in range(n_agents)
+        ]
 
         obs = self.leftover_obs
         if obs is None:
@@ -56,15 +59,21 @@ class MARLAgent(object):
         cumulative_timesteps = 0
         start_time = time.time()
         while True:
-            actions = []
-            ts = [Timestep() for _ in range(n_agents)]
-            for i in range(n_agents):
-                action, log_prob = policies[i].get_action(obs[i], deterministic=False)
-                ts[i].action = action
-                ts[i].log_prob = log_prob
-                actions.append(action)
-
-            next_obs, rews, terminated, truncated, _ = env.step(np.asarray(actions))
+            if update_fn is not None:
+                new_epoch = update_fn()
+                if new_epoch is not None and new_epoch != policy_epoch:
+                    policy_epoch = new_epoch
+                    for i in range(agents_to_save):
+                        if len(trajectories[i].obs) > 0:
+                            trajectories[i].final_obs = obs[i]
+                            yield trajectories[i]
+                    trajectories = [
+                        Trajectory(policy_epoch, self.length_hint)
+                        for _ in range(n_agents)
+                    ]
+
+            actions, log_probs = self._get_policy_actions(obs)
+            next_obs, rews, terminated, truncated, _ = env.step(actions)
 
             done = terminated or truncated
 
@@ -74,16 +83,17 @@ class MARLAgent(object):
                 elif i < n_agents // 2:
                     self.current_ep_rew += rews[i]
 
-                ts[i].reward = rews[i]
-                ts[i].obs = obs[i].copy()
-                ts[i].done = 1 if done else 0
-                trajectories[i].register_timestep(ts[i])
+                # The trajectory copies the observation into its own buffer.
+                trajectories[i].add(
+                    actions[i], log_probs[i], rews[i], obs[i], 1 if done else 0
+                )
 
             cumulative_timesteps += 1
             if done:
 
                 self.ep_rewards.append(self.current_ep_rew / agents_to_save)
                 self.current_ep_rew = 0
+                self.length_hint = len(trajectories[0])
 
                 for i in range(agents_to_save):
                     trajectories[i].final_obs = next_obs[i]
@@ -96,7 +106,9 @@ class MARLAgent(object):
                 self.get_next_opponent(policy)
 
                 next_obs = env.reset()
-                trajectories = [Trajectory(policy_epoch) for _ in range(n_agents)]
+                trajectories = [
+                    Trajectory(policy_epoch, self.length_hint) for _ in range(n_agents)
+                ]
 
             obs = next_obs
             if (
@@ -133,3 +145,59 @@ class MARLAgent(object):
 
     def _get_policy_action(self, policy, obs, timestep, evaluate=False):
         raise NotImplementedError
+
+    def _init_policy_groups(self, policy):
+        n_agents = self.n_agents
+        self.policies = [policy for _ in range(n_agents // 2)] + [
+            self.opponent_policy for _ in range(n_agents // 2)
+        ]
+        self.policy_groups = _group_by_policy(self.policies)
+        self.learner_groups = _group_by_policy([policy for _ in range(n_agents)])
+
+    def _get_policy_actions(self, obs):
+        """
+        Pick the actions of every agent with one forward pass per distinct
+        policy rather than one per agent. While the opponent plays with the
+        learner's weights (opponent_num == -1) both teams share a single
+        forward pass.
+        :param obs: Observation of every agent, an array or a list of rows.
+        :return: Tuple of (actions, log probabilities) with one row per agent.
+        """
+
+        # Some env wrappers return a list of observations, which can't be fancy
+        # indexed.
+        obs = np.asarray(obs)
+        if self.opponent_num == -1:
+            groups = self.learner_groups
+        else:
+            groups = self.policy_groups
+
+        actions = None
+        log_probs = np.empty(self.n_agents, dtype=np.float32)
+        for policy, indices in groups:
+            group_actions, group_log_probs = policy.get_actions(
+                torch.as_tensor(obs[indices], dtype=torch.float32)
+            )
+            if actions is None:
+                actions = np.empty(
+                    (self.n_agents,) + group_actions.shape[1:],
+                    dtype=group_actions.dtype,
+                )
+            actions[indices] = group_actions
+            log_probs[indices] = group_log_probs
+
+        return actions, log_probs
+
+
+def _group_by_policy(policies):
+    """
+    :return: List of (policy, indices of the agents that use it) pairs.
+    """
+
+    # Grouping by id(policy) assumes opponent policies are never recreated
+    # during a collect call. Loading a new opponent only swaps the weights of
+    # the same object, and the groups are built once and then reused.
+    groups = {}
+    for i, policy in enumerate(policies):
+        groups.setdefault(id(policy), (policy, []))[1].append(i)
+    return [(policy, np.asarray(indices)) for policy, indices in groups.values()]
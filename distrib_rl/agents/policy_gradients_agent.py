@@ -15,3 +15,6 @@ class PolicyGradientsAgent(BaseAgent):
             timestep.log_prob = log_prob
 
         return action
+
+    def _get_policy_actions(self, policy, obs):
+        return policy.get_actions(torch.as_tensor(obs, dtype=torch.float32))
@@ -0,0 +1,65 @@
+from distrib_rl.agents import MARLAgent
+import numpy as np
+
+TEAM_SIZE = 2
+OBS_SIZE = 3
+
+
+class FakeTeamPolicy(object):
+    """
+    Acts with the first observation entry plus an offset, so every action can
+    be traced back to the agent and the policy that produced it.
+    """
+
+    def __init__(self, offset):
+        self.offset = offset
+        self.batch_sizes = []
+
+    def get_actions(self, obs):
+        obs = np.asarray(obs)
+        self.batch_sizes.append(len(obs))
+        actions = obs[:, 0].astype(np.int64) + self.offset
+        return actions, obs[:, 0].astype(np.float32) / 10
+
+
+def build_agent(policy, opponent_policy):
+    # Skip __init__, the opponent selector would connect to a transport server.
+    agent = MARLAgent.__new__(MARLAgent)
+    agent.n_agents = TEAM_SIZE * 2
+    agent.opponent_policy = opponent_policy
+    agent.opponent_num = -1
+    agent._init_policy_groups(policy)
+    return agent
+
+
+def run_test():
+    policy = FakeTeamPolicy(0)
+    opponent_policy = FakeTeamPolicy(100)
+    agent = build_agent(policy, opponent_policy)
+
+    # The RocketLeague wrapper returns one array per agent in a plain list.
+    obs = [np.full(OBS_SIZE, i, dtype=np.float32) for i in range(agent.n_agents)]
+    agent_ids = np.arange(agent.n_agents)
+
+    # The opponent holds the learner's weights, so one forward pass covers both
+    # teams.
+    actions, log_probs = agent._get_policy_actions(obs)
+    assert np.array_equal(actions, agent_ids)
+    assert np.allclose(log_probs, agent_ids / 10)
+    assert policy.batch_sizes == [agent.n_agents]
+    assert opponent_policy.batch_sizes == []
+
+    # Against a past opponent each team gets its own forward pass.
+    agent.opponent_num = 0
+    actions, log_probs = agent._get_policy_actions(obs)
+    expected = np.where(agent_ids < TEAM_SIZE, agent_ids, agent_ids + 100)
+    assert np.array_equal(actions, expected)
+    assert np.allclose(log_probs, agent_ids / 10)
+    assert policy.batch_sizes == [agent.n_agents, TEAM_SIZE]
+    assert opponent_policy.batch_sizes == [TEAM_SIZE]
+
+    print("MARL agent actions come back in agent order")
+
+
+if __name__ == "__main__":
+    run_test()
@@ -1,4 +1,7 @@
 from distrib_rl.agents import PolicyGradientsAgent
+from distrib_rl.environments import VectorEnv
+import numpy as np
+import functools
 import gym
 
 
@@ -9,11 +12,14 @@ class FakeDiscretePolicy(object):
     def get_output(self, obs):
         return [1]
 
+    def get_actions(self, obs):
+        return np.ones(len(obs), dtype=np.int64), np.ones(len(obs), dtype=np.float32)
+
 
 def run_test():
     cfg = {}
     num_timesteps = 10
-    env = gym.make("CartPole-v1")
+    env = gym.make("CartPole-v1", new_step_api=True)
     policy = FakeDiscretePolicy()
     agent = PolicyGradientsAgent(cfg)
 
@@ -25,6 +31,23 @@ def run_test():
     reward = agent.evaluate_policy(policy, env, num_timesteps=num_timesteps)
     print("Eval reward: {}".format(reward))
 
+    # Pushing CartPole right every step ends an episode within a few dozen
+    # steps, so every env finishes some.
+    make_env = functools.partial(gym.make, "CartPole-v1", new_step_api=True)
+    for asynchronous in (False, True):
+        env = VectorEnv([make_env for _ in range(4)], asynchronous=asynchronous)
+        env.reset(seed=0)
+        agent = PolicyGradientsAgent(cfg)
+
+        trajectories = list(agent.gather_timesteps(policy, 0, env, 400))
+        assert sum(len(traj.rewards) for traj in trajectories) == 400
+        assert len(agent.ep_rewards) == sum(traj.dones[-1] for traj in trajectories)
+        assert len(agent.ep_rewards) >= 4
+        for traj in trajectories:
+            assert traj.final_obs is not None and len(traj.final_obs) == 4
+            assert sum(traj.dones) <= 1
+        env.close()
+
 
 if __name__ == "__main__":
     run_test()
@@ -1,2 +1,3 @@
+from .transport import ServerTransport, ClientTransport
 from .redis_server import RedisServer
 from .redis_client import RedisClient
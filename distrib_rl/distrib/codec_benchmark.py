@@ -0,0 +1,215 @@
+"""
+    File name: codec_benchmark.py
+
+    Description:
+        Measures how well each registered compressor does on real experience
+        payloads, so the codec under networking.compression can be picked per
+        deployment. Payloads are captured from a running server's experience
+        queue without removing them, and can be saved to disk to benchmark
+        offline.
+
+    Usage:
+        python -m distrib_rl.distrib.codec_benchmark --capture 200 --save payloads.msgpack
+        python -m distrib_rl.distrib.codec_benchmark --load payloads.msgpack --train-dictionary experience.dict
+        python -m distrib_rl.distrib.codec_benchmark --load payloads.msgpack --codecs LZ4 ZSTD:3 ZSTD:9 SHUFFLE_ZSTD:3
+"""
+
+from distrib_rl.distrib import redis_keys, experience_queues
+from distrib_rl.distrib.message_serialization import MessageSerializer, zstandard
+from redis import Redis
+import pyjson5 as json
+import argparse
+import msgpack
+import time
+import os
+
+DEFAULT_CODECS = (
+    "NONE",
+    "LZ4",
+    "SHUFFLE_LZ4",
+    "ZSTD:1",
+    "ZSTD:3",
+    "ZSTD:9",
+    "SHUFFLE_ZSTD:3",
+    "ZSTD_DICT:3",
+)
+
+# The zstd dictionary trainer works best on many small samples rather than a
+# few large messages.
+DICTIONARY_SAMPLE_SIZE = 64 * 1024
+
+
+def capture_payloads(red, count):
+    """
+    Copy up to count raw messages from the experience list and stream of every
+    experience shard without consuming them. The shards are taken from the
+    config the server published on the primary.
+    :param red: Connection to the primary Redis instance.
+    :param count: Maximum number of messages to capture.
+    :return: List of packed messages exactly as the clients sent them.
+    """
+
+    cfg_json = red.get(redis_keys.SERVER_CONFIG_KEY)
+    cfg = {} if cfg_json is None else dict(json.loads(cfg_json.decode("utf-8")))
+
+    payloads = []
+    for shard in experience_queues.connect_shards(cfg, red):
+        if len(payloads) >= count:
+            break
+
+        payloads += shard.lrange(
+            redis_keys.CLIENT_EXPERIENCE_KEY, 0, count - len(payloads) - 1
+        )
+        if len(payloads) < count:
+            entries = shard.xrange(
+                redis_keys.CLIENT_EXPERIENCE_STREAM_KEY, count=count - len(payloads)
+            )
+            payloads += [fields[b"data"] for _, fields in entries]
+
+    return payloads
+
+
+def decode_payloads(payloads, dictionary=None):
+    serializer = MessageSerializer(dictionary=dictionary)
+    return [serializer.unpack(payload) for payload in payloads]
+
+
+def train_dictionary(messages, dictionary_size):
+    samples = []
+    for message in messages:
+        raw = msgpack.packb(message)
+        for start in range(0, len(raw), DICTIONARY_SAMPLE_SIZE):
+            samples.append(raw[start : start + DICTIONARY_SAMPLE_SIZE])
+
+    return zstandard.train_dictionary(dictionary_size, samples).as_bytes()
+
+
+def benchmark_codec(codec, messages, dictionary=None):
+    """
+    Pack and unpack every message with one codec.
+    :param codec: Compression type, optionally followed by :level.
+    :param messages: Decoded messages to pack.
+    :param dictionary: Raw zstd dictionary for ZSTD_DICT.
+    :return: Tuple of (raw bytes, packed bytes, pack seconds, unpack seconds).
+    """
+
+    compression_type, _, level = codec.partition(":")
+    serializer = MessageSerializer(
+        compression_type=compression_type,
+        min_size_to_compress=0,
+        compression_level=int(level) if level else None,
+        dictionary=dictionary,
+    )
+
+    raw_size = sum(len(msgpack.packb(message)) for message in messages)
+
+    t1 = time.perf_counter()
+    packed = [serializer.pack(message) for message in messages]
+    t2 = time.perf_counter()
+    for data in packed:
+        serializer.unpack(data)
+    t3 = time.perf_counter()
+
+    return raw_size, sum(len(data) for data in packed), t2 - t1, t3 - t2
+
+
+def report(codecs, messages, dictionary):
+    print(
+        "{:<16} {:>8} {:>14} {:>14} {:>14}".format(
+            "codec", "ratio", "packed MB", "pack MB/s", "unpack MB/s"
+        )
+    )
+
+    for codec in codecs:
+        try:
+            raw_size, packed_size, pack_time, unpack_time = benchmark_codec(
+                codec, messages, dictionary
+            )
+        except (ImportError, ValueError) as e:
+            print("{:<16} skipped: {}".format(codec, e))
+            continue
+
+        raw_mb = raw_size / 1e6
+        print(
+            "{:<16} {:>8.3f} {:>14.3f} {:>14.1f} {:>14.1f}".format(
+                codec,
+                raw_size / max(1, packed_size),
+                packed_size / 1e6,
+                raw_mb / max(pack_time, 1e-9),
+                raw_mb / max(unpack_time, 1e-9),
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark message compressors on captured experience payloads."
+    )
+    parser.add_argument(
+        "--capture", type=int, default=0, help="Number of messages to capture."
+    )
+    parser.add_argument("--load", help="Load previously saved payloads from a file.")
+    parser.add_argument("--save", help="Save the payloads to a file.")
+    parser.add_argument("--dictionary", help="Existing zstd dictionary to use.")
+    parser.add_argument(
+        "--train-dictionary",
+        help="Train a zstd dictionary on the first half of the payloads, write it to this file and benchmark on the"
+        " second half.",
+    )
+    parser.add_argument("--dictionary-size", type=int, default=112640)
+    parser.add_argument("--codecs", nargs="+", default=list(DEFAULT_CODECS))
+    args = parser.parse_args()
+
+    red = None
+    if args.capture > 0 or not args.dictionary:
+        red = Redis(
+            host=os.environ.get("REDIS_HOST", default="localhost"),
+            port=os.environ.get("REDIS_PORT", default=6379),
+            password=os.environ.get("REDIS_PASSWORD", default=None),
+        )
+
+    dictionary = None
+    if args.dictionary:
+        with open(args.dictionary, "rb") as f:
+            dictionary = f.read()
+    else:
+        try:
+            dictionary = red.get(redis_keys.SERVER_COMPRESSION_DICTIONARY_KEY)
+        except Exception:
+            dictionary = None
+
+    payloads = []
+    if args.load:
+        with open(args.load, "rb") as f:
+            payloads = msgpack.unpackb(f.read())
+    if args.capture > 0:
+        payloads += capture_payloads(red, args.capture)
+
+    if len(payloads) == 0:
+        print("No payloads to benchmark.")
+        return
+
+    if args.save:
+        with open(args.save, "wb") as f:
+            f.write(msgpack.packb(payloads))
+        print(f"Saved {len(payloads)} payloads to {args.save}")
+
+    messages = decode_payloads(payloads, dictionary)
+
+    if args.train_dictionary:
+        split = max(1, len(messages) // 2)
+        dictionary = train_dictionary(messages[:split], args.dictionary_size)
+        with open(args.train_dictionary, "wb") as f:
+            f.write(dictionary)
+        print(
+            f"Trained a {len(dictionary)} byte dictionary on {split} messages, saved to {args.train_dictionary}"
+        )
+        if len(messages) > split:
+            messages = messages[split:]
+
+    print(f"Benchmarking {len(messages)} messages")
+    report(args.codecs, messages, dictionary)
+
+
+if __name__ == "__main__":
+    main()
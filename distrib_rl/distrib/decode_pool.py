@@ -0,0 +1,191 @@
+"""
+    File name: decode_pool.py
+
+    Description:
+        Pool of worker processes that decode experience messages on the learner
+        host. With many clients, one process can't decompress and unpack every
+        message fast enough. Workers take the raw messages and write the
+        rebuilt columns into one of a fixed set of shared memory result slots,
+        so only a small descriptor comes back through the process pool and the
+        process that drains the queues copies each column out once. Slots are
+        reused for every message and only replaced when a batch outgrows them.
+        Results are handed back in the order the messages were submitted, so
+        batches keep their arrival order.
+"""
+
+from distrib_rl.experience.trajectory_batch import TrajectoryBatch
+from distrib_rl.mpframework.shared_segments import open_segment
+from concurrent.futures import ProcessPoolExecutor, wait
+from collections import deque
+import multiprocessing as mp
+import numpy as np
+
+# Result slots per worker, so a worker can start on its next message while we
+# are still copying out its last one.
+SLOTS_PER_WORKER = 2
+
+# Slots are sized for the largest batch seen so far plus some headroom, so a
+# slightly larger batch doesn't replace the slot again.
+SLOT_GROWTH = 1.25
+
+_decoder = None
+_attached = {}
+
+
+def _init_worker(decoder):
+    global _decoder
+    _decoder = decoder
+
+
+def _align(size):
+    return (size + 7) & ~7
+
+
+def _column_view(buf, dtype, shape, offset):
+    if int(np.prod(shape)) == 0:
+        return np.empty(shape, dtype=dtype)
+    return np.ndarray(shape, dtype=dtype, buffer=buf, offset=offset)
+
+
+def _attach(slot, name):
+    segment = _attached.get(slot, None)
+    if segment is not None and segment.name != name:
+        # The slot was replaced by a larger one.
+        segment.close()
+        segment = None
+
+    if segment is None:
+        segment = _attached[slot] = open_segment(name)
+    return segment
+
+
+def _decode(message, slot, segment_name, size):
+    """
+    Decode one message in a worker and write the batch's columns into a result
+    slot.
+    :param message: Raw message as popped from the experience queue.
+    :param slot: Index of the result slot reserved for this message.
+    :param segment_name: Name of the slot's shared memory segment, None if the
+                         slot hasn't been created yet.
+    :param size: Size of the slot in bytes.
+    :return: Tuple of (column layout, bytes needed, column dtypes, reward
+             moments, batch). The batch itself is only sent back if it didn't
+             fit in the slot.
+    """
+
+    batch = TrajectoryBatch.deserialize(_decoder(message))
+
+    layout = []
+    required = 0
+    for name in TrajectoryBatch.TIMESTEP_COLUMNS + TrajectoryBatch.TRAJECTORY_COLUMNS:
+        arr = getattr(batch, name)
+        layout.append((name, arr.dtype.str, arr.shape, required))
+        required += _align(arr.nbytes)
+
+    if segment_name is None or required > size:
+        return layout, required, batch.dtypes, batch.reward_moments, batch
+
+    segment = _attach(slot, segment_name)
+    for name, dtype, shape, offset in layout:
+        _column_view(segment.buf, dtype, shape, offset)[...] = getattr(batch, name)
+    return layout, required, batch.dtypes, batch.reward_moments, None
+
+
+class ExperienceDecodePool(object):
+    def __init__(self, num_workers, decoder):
+        """
+        :param num_workers: Number of worker processes.
+        :param decoder: Picklable function that turns a raw message into the
+                        data a client passed to push_experience.
+        """
+
+        self.num_workers = num_workers
+        self._executor = ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=mp.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(decoder,),
+        )
+        self._slots = [None for _ in range(num_workers * SLOTS_PER_WORKER)]
+        self._free_slots = deque(range(len(self._slots)))
+        self._waiting = deque()
+        self._pending = deque()
+
+    @property
+    def num_pending(self):
+        return len(self._pending) + len(self._waiting)
+
+    def submit(self, messages):
+        self._waiting.extend(messages)
+        self._dispatch()
+
+    def collect(self, timeout=None):
+        """
+        Take every decoded batch at the front of the queue. A batch is never
+        returned before the ones submitted ahead of it, even if it finished
+        decoding first.
+        :param timeout: If not None, wait up to this many seconds for the
+                        oldest message to finish decoding.
+        :return: List of TrajectoryBatch objects in submission order.
+        """
+
+        if timeout is not None and len(self._pending) > 0:
+            wait([self._pending[0][0]], timeout=timeout)
+
+        batches = []
+        while len(self._pending) > 0 and self._pending[0][0].done():
+            future, slot = self._pending.popleft()
+            batches.append(self._load(slot, *future.result()))
+            self._free_slots.append(slot)
+
+        self._dispatch()
+        return batches
+
+    def close(self):
+        for future, _ in self._pending:
+            future.cancel()
+        self._executor.shutdown(wait=True)
+        self._pending.clear()
+        self._waiting.clear()
+
+        for segment in self._slots:
+            if segment is not None:
+                segment.close()
+                segment.unlink()
+        self._slots = []
+        self._free_slots.clear()
+
+    def _dispatch(self):
+        while len(self._waiting) > 0 and len(self._free_slots) > 0:
+            slot = self._free_slots.popleft()
+            segment = self._slots[slot]
+            segment_name = None if segment is None else segment.name
+            size = 0 if segment is None else segment.size
+            future = self._executor.submit(
+                _decode, self._waiting.popleft(), slot, segment_name, size
+            )
+            self._pending.append((future, slot))
+
+    def _load(self, slot, layout, required, dtypes, reward_moments, batch):
+        if batch is not None:
+            # The batch didn't fit, so the slot is replaced by one that fits
+            # the next batch this large.
+            self._resize(slot, int(required * SLOT_GROWTH))
+            return batch
+
+        # The slot is reused for the next message, so the columns are copied
+        # out.
+        buf = self._slots[slot].buf
+        columns = {}
+        for name, dtype, shape, offset in layout:
+            columns[name] = _column_view(buf, dtype, shape, offset).copy()
+        return TrajectoryBatch(dtypes=dtypes, reward_moments=reward_moments, **columns)
+
+    def _resize(self, slot, size):
+        segment = self._slots[slot]
+        if segment is not None:
+            # Workers still holding the old segment close it once they see the
+            # new name.
+            segment.close()
+            segment.unlink()
+        self._slots[slot] = open_segment(None, create=True, size=max(1, size))
@@ -0,0 +1,382 @@
+from redis import Redis
+from redis.exceptions import ResponseError
+from distrib_rl.distrib import redis_keys
+from collections import deque
+import socket
+import time
+import math
+import zlib
+import os
+
+LIST_QUEUE = "list"
+STREAM_QUEUE = "stream"
+
+
+def get_from_cfg(redis, cfg):
+    networking_cfg = cfg.get("networking", {})
+    queue_type = networking_cfg.get("experience_queue", LIST_QUEUE).lower().strip()
+
+    if queue_type == LIST_QUEUE:
+        return ListExperienceQueue(redis)
+
+    if queue_type == STREAM_QUEUE:
+        return StreamExperienceQueue(
+            redis,
+            read_count=networking_cfg.get("stream_read_count", 64),
+            claim_idle_seconds=networking_cfg.get("stream_claim_idle_seconds", 60),
+        )
+
+    raise ValueError(
+        f"Unknown experience queue type '{queue_type}'."
+        f" Supported types are {LIST_QUEUE},{STREAM_QUEUE}"
+    )
+
+
+def connect_shards(cfg, primary):
+    """
+    Open a connection to every experience shard listed under
+    networking.experience_shards as "host:port" strings. Control keys always
+    stay on the primary, only experience queues live on the shards.
+    :param cfg: Config dict.
+    :param primary: Connection to the primary Redis instance.
+    :return: List of connections, just the primary if no shards are configured.
+    """
+
+    shards = cfg.get("networking", {}).get("experience_shards", None)
+    if not shards:
+        return [primary]
+
+    password = os.environ.get("REDIS_PASSWORD", default=None)
+    connections = []
+    for endpoint in shards:
+        host, _, port = str(endpoint).rpartition(":")
+        connections.append(Redis(host=host, port=int(port), password=password))
+
+    return connections
+
+
+def get_client_id():
+    return os.environ.get(
+        "DISTRIB_RL_CLIENT_ID", default=f"{socket.gethostname()}-{os.getpid()}"
+    )
+
+
+def get_shard_index(client_id, num_shards):
+    # Python's hash() is salted per process, crc32 gives every process the same
+    # answer for the same id.
+    return zlib.crc32(client_id.encode("utf-8")) % num_shards
+
+
+class ListExperienceQueue(object):
+    """
+    Experience queue backed by a plain Redis list. Clients LPUSH and LTRIM the
+    list to max_size messages, the server takes everything on the list at once
+    with LRANGE + DEL. Passing a pipeline to push queues the commands on it
+    instead of sending them immediately.
+    """
+
+    # KEYS: status, queue, timestep counter. ARGV: expected status, data, max
+    # size, number of timesteps.
+    PUSH_IF_STATUS_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('LPUSH', KEYS[2], ARGV[2])
+redis.call('LTRIM', KEYS[2], 0, ARGV[3])
+redis.call('INCRBY', KEYS[3], ARGV[4])
+return 1
+"""
+
+    def __init__(self, redis, key=redis_keys.CLIENT_EXPERIENCE_KEY):
+        self.redis = redis
+        self.key = key
+        self._push_if_status = redis.register_script(
+            ListExperienceQueue.PUSH_IF_STATUS_SCRIPT
+        )
+
+    def push(self, packed_data, num_timesteps, max_size, pipe=None):
+        execute = pipe is None
+        if execute:
+            pipe = self.redis.pipeline()
+
+        pipe.lpush(self.key, packed_data)
+        pipe.ltrim(self.key, 0, max_size)
+
+        if execute:
+            pipe.execute()
+
+    def push_if_status(
+        self, packed_data, num_timesteps, max_size, status, counter_key, pipe=None
+    ):
+        """
+        Push a message and add its timesteps to counter_key, but only if the
+        server status still equals status. The check and the push run as one
+        script, so a server that stops in between never receives the message.
+        :return: 1 if the message was pushed, 0 otherwise. Queued on pipe if
+                 given.
+        """
+
+        return self._push_if_status(
+            keys=[redis_keys.SERVER_CURRENT_STATUS_KEY, self.key, counter_key],
+            args=[status, packed_data, max_size, num_timesteps],
+            client=pipe,
+        )
+
+    def ack(self, num_messages):
+        # Popped messages are already gone from the list.
+        pass
+
+    def pop(self, block_timeout=None):
+        first = None
+        if block_timeout is not None:
+            # Sleep inside redis until at least one message arrives, then take
+            # whatever else is on the list. Redis older than 6.0 only accepts
+            # whole seconds for the BRPOP timeout.
+            timeout = max(1, math.ceil(block_timeout))
+            first = self.redis.brpop(self.key, timeout=timeout)
+            if first is None:
+                return []
+
+        pipe = self.redis.pipeline()
+        pipe.lrange(self.key, 0, -1)
+        pipe.delete(self.key)
+        packed_results = pipe.execute()[0]
+        if packed_results is None:
+            packed_results = []
+
+        # LRANGE returns the newest messages first and BRPOP took the oldest
+        # one, so it goes at the end.
+        if first is not None:
+            packed_results.append(first[1])
+        return packed_results
+
+    def clear(self, pipe):
+        pipe.delete(self.key)
+
+
+class StreamExperienceQueue(object):
+    """
+    Experience queue backed by a Redis stream. Clients XADD with an approximate
+    MAXLEN derived from the timestep budget, and any number of server-side
+    consumers share the stream through a consumer group, each draining at most
+    read_count messages per call with XREADGROUP.
+
+    Messages stay pending in the group until ack is called for them, which
+    XACKs and XDELs them. Entries another consumer has left pending for longer
+    than claim_idle_seconds are claimed and returned by our next pop, so the
+    messages of a consumer that died between reading and acking are not lost.
+    A consumer that is only slow can have its messages claimed as well, so a
+    message may be delivered more than once.
+    """
+
+    GROUP_NAME = "distrib_rl_experience_consumers"
+
+    # KEYS: status, stream, timestep counter. ARGV: expected status, data, max
+    # length, number of timesteps.
+    PUSH_IF_STATUS_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[3], '*', 'data', ARGV[2], 'timesteps', ARGV[4])
+redis.call('INCRBY', KEYS[3], ARGV[4])
+return 1
+"""
+
+    def __init__(
+        self,
+        redis,
+        key=redis_keys.CLIENT_EXPERIENCE_STREAM_KEY,
+        read_count=64,
+        claim_idle_seconds=60,
+    ):
+        self.redis = redis
+        self.key = key
+        self.read_count = read_count
+        self.claim_idle_ms = int(claim_idle_seconds * 1000)
+        self.consumer_name = f"{socket.gethostname()}-{os.getpid()}"
+        self._unacked = deque()
+        self._last_claim = time.monotonic()
+        self._push_if_status = redis.register_script(
+            StreamExperienceQueue.PUSH_IF_STATUS_SCRIPT
+        )
+
+    def push(self, packed_data, num_timesteps, max_size, pipe=None):
+        max_len = self._get_max_len(num_timesteps, max_size)
+        target = self.redis if pipe is None else pipe
+        target.xadd(
+            self.key,
+            {b"data": packed_data, b"timesteps": num_timesteps},
+            maxlen=max_len,
+            approximate=True,
+        )
+
+    def push_if_status(
+        self, packed_data, num_timesteps, max_size, status, counter_key, pipe=None
+    ):
+        """
+        Same as ListExperienceQueue.push_if_status.
+        """
+
+        max_len = self._get_max_len(num_timesteps, max_size)
+        return self._push_if_status(
+            keys=[redis_keys.SERVER_CURRENT_STATUS_KEY, self.key, counter_key],
+            args=[status, packed_data, max_len, num_timesteps],
+            client=pipe,
+        )
+
+    def _get_max_len(self, num_timesteps, max_size):
+        # Stream entries can only be capped by count, so we convert the
+        # timestep budget into a message budget using the size of the message
+        # we are pushing.
+        return max(1, math.ceil(max_size / max(1, num_timesteps)))
+
+    def pop(self, block_timeout=None):
+        """
+        Read the next messages for our consumer. They stay pending in the group
+        until ack is called for them.
+        :param block_timeout: If not None, wait up to this many seconds for a
+                              message to arrive.
+        :return: List of raw messages, oldest first.
+        """
+
+        block = None
+        if block_timeout is not None:
+            block = max(1, int(block_timeout * 1000))
+
+        try:
+            entries = []
+            now = time.monotonic()
+            if now - self._last_claim >= self.claim_idle_ms / 1000:
+                self._last_claim = now
+                entries = self._claim_abandoned()
+                if len(entries) > 0:
+                    block = None
+
+            response = self.redis.xreadgroup(
+                StreamExperienceQueue.GROUP_NAME,
+                self.consumer_name,
+                {self.key: ">"},
+                count=self.read_count,
+                block=block,
+            )
+        except ResponseError as e:
+            # The group disappears whenever the stream key is deleted, e.g. by
+            # signal_ready or a flush.
+            if "NOGROUP" not in str(e):
+                raise
+            self.create_group()
+            return []
+
+        if response:
+            entries += response[0][1]
+
+        self._unacked.extend(entry_id for entry_id, _ in entries)
+        return [fields[b"data"] for _, fields in entries]
+
+    def ack(self, num_messages):
+        """
+        Acknowledge and delete the oldest messages returned by pop that haven't
+        been acknowledged yet.
+        :param num_messages: Number of messages to acknowledge.
+        """
+
+        if num_messages == 0:
+            return
+
+        ids = [self._unacked.popleft() for _ in range(num_messages)]
+        pipe = self.redis.pipeline()
+        pipe.xack(self.key, StreamExperienceQueue.GROUP_NAME, *ids)
+        pipe.xdel(self.key, *ids)
+        pipe.execute()
+
+    def _claim_abandoned(self):
+        # XAUTOCLAIM would do this in one call but needs Redis 6.2, so the
+        # pending lists of the other consumers are filtered here instead.
+        summary = self.redis.xpending(self.key, StreamExperienceQueue.GROUP_NAME)
+        consumer_name = self.consumer_name.encode("utf-8")
+        ids = []
+        for consumer in summary["consumers"]:
+            if consumer["name"] == consumer_name:
+                continue
+
+            pending = self.redis.xpending_range(
+                self.key,
+                StreamExperienceQueue.GROUP_NAME,
+                "-",
+                "+",
+                self.read_count - len(ids),
+                consumername=consumer["name"],
+            )
+            ids += [
+                entry["message_id"]
+                for entry in pending
+                if entry["time_since_delivered"] >= self.claim_idle_ms
+            ]
+            if len(ids) >= self.read_count:
+                break
+        if len(ids) == 0:
+            return []
+
+        # Each entry is claimed on its own, so an entry trimmed off the stream
+        # can be told apart from one that another consumer claimed first.
+        pipe = self.redis.pipeline()
+        for entry_id in ids:
+            pipe.xclaim(
+                self.key,
+                StreamExperienceQueue.GROUP_NAME,
+                self.consumer_name,
+                self.claim_idle_ms,
+                [entry_id],
+            )
+
+        # Trimmed entries come back empty and would stay pending forever, so
+        # they are acknowledged straight away.
+        entries = []
+        trimmed = []
+        for entry_id, claimed in zip(ids, pipe.execute()):
+            for claimed_id, fields in claimed:
+                if claimed_id is None:
+                    trimmed.append(entry_id)
+                else:
+                    entries.append((claimed_id, fields))
+        if len(trimmed) > 0:
+            self.redis.xack(self.key, StreamExperienceQueue.GROUP_NAME, *trimmed)
+
+        if len(entries) > 0:
+            print(f"Claimed {len(entries)} experience messages left pending")
+        return entries
+
+    def count_consumers(self):
+        """
+        Count the consumers that have been handed messages by our group since
+        it was created. The group is recreated whenever the stream is cleared,
+        so consumers of earlier runs don't count.
+        """
+
+        try:
+            groups = self.redis.xinfo_groups(self.key)
+        except ResponseError:
+            return 0
+
+        for group in groups:
+            name = group["name"]
+            if isinstance(name, bytes):
+                name = name.decode("utf-8")
+            if name == StreamExperienceQueue.GROUP_NAME:
+                return int(group["consumers"])
+        return 0
+
+    def create_group(self):
+        try:
+            self.redis.xgroup_create(
+                self.key, StreamExperienceQueue.GROUP_NAME, id="0", mkstream=True
+            )
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def clear(self, pipe):
+        pipe.delete(self.key)
+        pipe.xgroup_create(
+            self.key, StreamExperienceQueue.GROUP_NAME, id="0", mkstream=True
+        )
@@ -1,7 +1,13 @@
 import msgpack
 import lz4.frame
+import numpy as np
 from msgpack_numpy import patch
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 patch()
 
 MIN_SIZE_TO_COMPRESS = 1024
@@ -9,68 +15,263 @@ MIN_SIZE_TO_COMPRESS = 1024
 LZ4 = True
 NONE = False
 
+# Marks an array whose bytes were shuffled before packing.
+SHUFFLED_ARRAY_KEY = b"shuffled_nd"
+
+
+def shuffle_bytes(data, item_size):
+    """
+    Transpose a byte string so that byte i of every item_size-byte item is
+    stored contiguously. The sign and exponent bytes of neighbouring floats are
+    usually identical, so this makes them much easier to compress. Any trailing
+    bytes that don't fill a whole item are left where they are.
+    """
+
+    arr = np.frombuffer(data, dtype=np.uint8)
+    n = len(arr) - len(arr) % item_size
+    out = np.empty_like(arr)
+    out[:n] = arr[:n].reshape(-1, item_size).T.ravel()
+    out[n:] = arr[n:]
+    return out.tobytes()
+
+
+def unshuffle_bytes(data, item_size):
+    arr = np.frombuffer(data, dtype=np.uint8)
+    n = len(arr) - len(arr) % item_size
+    out = np.empty_like(arr)
+    out[:n] = arr[:n].reshape(item_size, -1).T.ravel()
+    out[n:] = arr[n:]
+    return out.tobytes()
+
+
+def shuffle_arrays(data):
+    """
+    Replace every array and typed memoryview in a message with a copy whose
+    bytes are shuffled by its own item size, so float32, float16 and bfloat16
+    columns each get the right lane width. Lists, tuples and dicts are walked
+    recursively.
+    """
+
+    if isinstance(data, (np.ndarray, memoryview)):
+        arr = np.asarray(data)
+        if arr.dtype.kind in "biuf" and arr.itemsize > 1:
+            return {
+                SHUFFLED_ARRAY_KEY: True,
+                b"type": arr.dtype.str,
+                b"shape": arr.shape,
+                b"data": shuffle_bytes(np.ascontiguousarray(arr), arr.itemsize),
+            }
+        return data
+
+    if isinstance(data, (list, tuple)):
+        return type(data)(shuffle_arrays(item) for item in data)
+
+    if isinstance(data, dict):
+        return {key: shuffle_arrays(value) for key, value in data.items()}
+
+    return data
+
+
+def _unshuffle_array(obj):
+    if SHUFFLED_ARRAY_KEY not in obj:
+        return obj
+
+    dtype = np.dtype(obj[b"type"])
+    data = unshuffle_bytes(obj[b"data"], dtype.itemsize)
+    return np.frombuffer(data, dtype=dtype).reshape(obj[b"shape"])
+
 
 class NullMessageCompressor(object):
     compression_type = "NONE"
+    options = ()
 
     def __init__(self):
-        super()
+        super().__init__()
 
-    def compress(data):
+    def compress(self, data):
         return data
 
-    def decompress(data):
+    def decompress(self, data):
         return data
 
 
 class LZ4MessageCompressor(object):
     compression_type = "LZ4"
+    options = ("level",)
 
-    def __init__(self):
-        super()
+    def __init__(self, level=0):
+        super().__init__()
+        self.level = level
 
-    def compress(data):
-        return lz4.frame.compress(data)
+    def compress(self, data):
+        return lz4.frame.compress(data, compression_level=self.level)
 
-    def decompress(data):
+    def decompress(self, data):
         return lz4.frame.decompress(data)
 
 
+class ShuffleLZ4MessageCompressor(LZ4MessageCompressor):
+    compression_type = "SHUFFLE_LZ4"
+    shuffle_arrays = True
+
+
+class ZstdMessageCompressor(object):
+    compression_type = "ZSTD"
+    options = ("level",)
+
+    def __init__(self, level=3):
+        super().__init__()
+        if zstandard is None:
+            raise ImportError(
+                f"Compression type '{self.compression_type}' requires the zstandard package."
+            )
+
+        self.level = level
+        self._compressor = zstandard.ZstdCompressor(level=level)
+        self._decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def decompress(self, data):
+        return self._decompressor.decompress(data)
+
+
+class ShuffleZstdMessageCompressor(ZstdMessageCompressor):
+    compression_type = "SHUFFLE_ZSTD"
+    shuffle_arrays = True
+
+
+class ZstdDictMessageCompressor(ZstdMessageCompressor):
+    compression_type = "ZSTD_DICT"
+    options = ("level", "dictionary")
+
+    def __init__(self, level=3, dictionary=None):
+        super().__init__(level=level)
+        if dictionary is None:
+            raise ValueError(
+                f"Compression type '{self.compression_type}' requires a compression dictionary."
+            )
+
+        dict_data = zstandard.ZstdCompressionDict(dictionary)
+        self._compressor = zstandard.ZstdCompressor(level=level, dict_data=dict_data)
+        self._decompressor = zstandard.ZstdDecompressor(dict_data=dict_data)
+
+
+def get_from_cfg(cfg, dictionary=None):
+    """
+    Build a MessageSerializer from the networking section of a config.
+    :param cfg: Config dict.
+    :param dictionary: Raw zstd dictionary, required for the ZSTD_DICT
+                       compression type.
+    :return: MessageSerializer.
+    """
+
+    networking_cfg = cfg.get("networking", {})
+    compression_type = networking_cfg.get("compression", None)
+    if not compression_type:
+        compression_type = LZ4MessageCompressor.compression_type
+
+    return MessageSerializer(
+        compression_type=compression_type,
+        compression_level=networking_cfg.get("compression_level", None),
+        dictionary=dictionary,
+    )
+
+
 class MessageSerializer(object):
     _compressors = {
         NullMessageCompressor.compression_type: NullMessageCompressor,
         LZ4MessageCompressor.compression_type: LZ4MessageCompressor,
+        ShuffleLZ4MessageCompressor.compression_type: ShuffleLZ4MessageCompressor,
+        ZstdMessageCompressor.compression_type: ZstdMessageCompressor,
+        ShuffleZstdMessageCompressor.compression_type: ShuffleZstdMessageCompressor,
+        ZstdDictMessageCompressor.compression_type: ZstdDictMessageCompressor,
     }
 
     def __init__(
         self,
         compression_type=LZ4MessageCompressor.compression_type,
         min_size_to_compress=MIN_SIZE_TO_COMPRESS,
+        compression_level=None,
+        dictionary=None,
     ):
-        super()
+        super().__init__()
         self._compression_type = compression_type.upper()
         self._min_size_to_compress = min_size_to_compress
 
+        self._compressor_kwargs = {}
+        if compression_level is not None:
+            self._compressor_kwargs["level"] = compression_level
+        if dictionary is not None:
+            self._compressor_kwargs["dictionary"] = dictionary
+
+        # Build our own compressor now so a bad config fails here rather than
+        # on the first message.
+        self._compressor_instances = {}
+        self._get_compressor(self._compression_type)
+
     @classmethod
-    def register_compressor(compressor):
-        MessageSerializer._compressors[compressor.compression_type.upper()] = compressor
+    def register_compressor(cls, compressor):
+        """
+        Register a compressor class. It needs a compression_type attribute, an
+        options tuple naming which of the level and dictionary keyword
+        arguments its constructor takes, and compress/decompress methods that
+        take and return bytes. Setting shuffle_arrays to True makes the
+        serializer byte shuffle every array in a message before packing it.
+        """
+
+        cls._compressors[compressor.compression_type.upper()] = compressor
+
+    def __getstate__(self):
+        # Compressors can hold native handles that don't survive pickling, they
+        # are rebuilt on first use.
+        state = self.__dict__.copy()
+        state["_compressor_instances"] = {}
+        return state
 
     def pack(self, data):
+        # Shuffled arrays are restored by unpack whatever the message ends up
+        # being compressed with, so it doesn't matter if this one turns out too
+        # small.
+        if getattr(
+            self._get_compressor(self._compression_type), "shuffle_arrays", False
+        ):
+            data = shuffle_arrays(data)
+
         data = msgpack.packb(data)
-        compression_type = "NONE"
+        compression_type = NullMessageCompressor.compression_type
         if self._compression_type and self._min_size_to_compress <= len(data):
             compression_type = self._compression_type
-            compressor = MessageSerializer._compressors[self._compression_type]
-            data = compressor.compress(data)
+            data = self._get_compressor(compression_type).compress(data)
         return msgpack.packb((compression_type, data))
 
     def unpack(self, data):
         compression_type, data = msgpack.unpackb(data)
-        try:
-            data = MessageSerializer._compressors[compression_type].decompress(data)
-            return msgpack.unpackb(data)
-        except KeyError:
+        data = self._get_compressor(compression_type).decompress(data)
+        return msgpack.unpackb(data, object_hook=_unshuffle_array)
+
+    def _get_compressor(self, compression_type):
+        compressor = self._compressor_instances.get(compression_type, None)
+        if compressor is not None:
+            return compressor
+
+        compressor_cls = MessageSerializer._compressors.get(compression_type, None)
+        if compressor_cls is None:
             raise ValueError(
-                f"Received message with unknown compression type '{compression_type}'."
-                f" Supported types are {','.join(ct for ct in MessageSerializer._compressors.keys)}"
+                f"Unknown compression type '{compression_type}'."
+                f" Supported types are {','.join(MessageSerializer._compressors.keys())}"
             )
+
+        # The level is only meant for the configured compression type, other
+        # types are only ever used to decompress messages packed by someone
+        # else.
+        kwargs = {
+            name: value
+            for name, value in self._compressor_kwargs.items()
+            if name in getattr(compressor_cls, "options", ())
+            and (name != "level" or compression_type == self._compression_type)
+        }
+        compressor = compressor_cls(**kwargs)
+        self._compressor_instances[compression_type] = compressor
+        return compressor
@@ -0,0 +1,160 @@
+"""
+    File name: parameter_deltas.py
+
+    Description:
+        Delta encoding for the flat parameter vectors the server broadcasts
+        every epoch. Every keyframe_interval epochs the encoder emits the full
+        float32 vector, and in between it emits the low-precision difference
+        from the previous epoch. Each payload is written under its own
+        epoch-suffixed key, so a client only has to fetch the deltas it is
+        missing, or the latest keyframe and the deltas after it if it fell too
+        far behind.
+
+        The encoder tracks the vector clients will reconstruct rather than the
+        server's true parameters, so rounding error from the low-precision
+        deltas never accumulates and every client that applies the same chain
+        ends up with exactly the same parameters. At each keyframe they match
+        the server's copy bit for bit.
+"""
+
+import numpy as np
+
+KEYFRAME = 0
+DELTA = 1
+
+
+def version_key(key, epoch):
+    return f"{key}:{epoch}"
+
+
+class ParameterDeltaEncoder(object):
+    def __init__(self, keyframe_interval=1, delta_dtype="float16"):
+        self.keyframe_interval = max(1, int(keyframe_interval))
+        self.delta_dtype = np.dtype(delta_dtype)
+        self.reference = None
+        self.last_epoch = None
+        self.keyframe_epoch = None
+        self.previous_keyframe_epoch = None
+
+    def encode(self, params, epoch):
+        """
+        Encode the parameters for an epoch.
+        :param params: Flat parameter vector.
+        :param epoch: Epoch the parameters belong to.
+        :return: Tuple of (payload, expired_epochs). The payload should be
+                 stored under version_key(key, epoch), and the versions listed
+                 in expired_epochs are no longer reachable by any client and
+                 can be deleted.
+        """
+
+        params = np.asarray(params, dtype=np.float32)
+
+        if self._needs_keyframe(params, epoch):
+            return self._encode_keyframe(params, epoch)
+
+        delta = (params - self.reference).astype(self.delta_dtype)
+
+        # A delta too large for the wire dtype would poison every client, send
+        # the full vector instead.
+        if not np.isfinite(delta).all():
+            return self._encode_keyframe(params, epoch)
+
+        self.reference = self.reference + delta.astype(np.float32)
+        self.last_epoch = epoch
+        return (DELTA, epoch, delta), []
+
+    def _needs_keyframe(self, params, epoch):
+        return (
+            self.reference is None
+            or self.last_epoch != epoch - 1
+            or self.reference.shape != params.shape
+            or epoch % self.keyframe_interval == 0
+        )
+
+    def _encode_keyframe(self, params, epoch):
+        expired_epochs = []
+        if self.previous_keyframe_epoch is not None:
+            expired_epochs = list(
+                range(self.previous_keyframe_epoch, self.keyframe_epoch)
+            )
+
+        self.previous_keyframe_epoch = self.keyframe_epoch
+        self.keyframe_epoch = epoch
+        self.reference = params.copy()
+        self.last_epoch = epoch
+        return (KEYFRAME, epoch, self.reference), expired_epochs
+
+
+class ParameterDeltaDecoder(object):
+    def __init__(self, keyframe_interval=1):
+        self.keyframe_interval = max(1, int(keyframe_interval))
+        self.params = None
+        self.epoch = -1
+
+    def get_required_epochs(self, target_epoch, from_keyframe=False):
+        """
+        Get the list of versions that must be fetched to reach target_epoch.
+        :param target_epoch: Latest epoch published by the server.
+        :param from_keyframe: Ignore our current parameters and rebuild from
+                              the latest scheduled keyframe.
+        :return: List of epochs.
+        """
+
+        keyframe_epoch = target_epoch - target_epoch % self.keyframe_interval
+        if (
+            from_keyframe
+            or self.params is None
+            or self.epoch < keyframe_epoch
+            or self.epoch >= target_epoch
+        ):
+            return list(range(keyframe_epoch, target_epoch + 1))
+
+        return list(range(self.epoch + 1, target_epoch + 1))
+
+    def apply(self, payloads, target_epoch):
+        """
+        Apply a chain of fetched payloads.
+        :param payloads: Payloads fetched for the epochs returned by
+                         get_required_epochs, in order. Missing versions should
+                         be passed as None.
+        :param target_epoch: Epoch the chain should end on.
+        :return: True if the chain was complete and our parameters are now at
+                 target_epoch, False otherwise.
+        """
+
+        # Anything before the last keyframe in the chain is irrelevant, so
+        # start from there if we have one.
+        start = 0
+        params = self.params
+        for i, payload in enumerate(payloads):
+            if payload is not None and payload[0] == KEYFRAME:
+                start = i
+                params = None
+
+        if self.epoch >= target_epoch and params is not None:
+            return False
+
+        epoch = None
+        for payload in payloads[start:]:
+            if payload is None:
+                return False
+
+            kind, epoch, data = payload
+            data = np.asarray(data)
+            if kind == KEYFRAME:
+                params = data.astype(np.float32)
+            elif params is None:
+                return False
+            else:
+                params = params + data.astype(np.float32)
+
+        if params is None or epoch != target_epoch:
+            return False
+
+        self.params = params
+        self.epoch = target_epoch
+        return True
+
+    def reset(self):
+        self.params = None
+        self.epoch = -1
@@ -1,18 +1,27 @@
 from redis import Redis
-from distrib_rl.distrib import redis_keys, RedisServer
+from distrib_rl.distrib import redis_keys, experience_queues, message_serialization
 from distrib_rl.distrib.message_serialization import MessageSerializer
-import time
-import pyjson5 as json
+from distrib_rl.distrib.parameter_deltas import ParameterDeltaDecoder, version_key
+from distrib_rl.distrib.transport import ClientTransport, ServerTransport
+import threading
 import os
 
+# How many times to re-read the epoch pointer if the versions it pointed at
+# expire before we fetch them.
+FETCH_ATTEMPTS = 3
 
-class RedisClient(object):
+
+class RedisClient(ClientTransport):
     def __init__(self):
+        super().__init__()
         self.redis = None
-        self.current_epoch = -1
-        self.current_value_epoch = -1
-        self.max_queue_size = 0
         self._message_serializer = MessageSerializer()
+        self._experience_queue = None
+        self._experience_redis = None
+        self._policy_decoder = ParameterDeltaDecoder()
+        self._val_decoder = ParameterDeltaDecoder()
+        self._update_listener = None
+        self._fetch_lock = threading.Lock()
 
     def connect(self):
         ip = os.environ.get("REDIS_HOST", default="localhost")
@@ -20,10 +29,21 @@ class RedisClient(object):
         password = os.environ.get("REDIS_PASSWORD", default=None)
 
         self.redis = Redis(host=ip, port=port, password=password)
+        self._experience_redis = self.redis
+        self._experience_queue = experience_queues.ListExperienceQueue(self.redis)
 
     def increment_timesteps(self, timesteps):
         self.redis.incrby(redis_keys.SERVER_CUMULATIVE_TIMESTEPS_KEY, timesteps)
 
+    def get_ingest_backlog(self):
+        pushed, ingested = self.redis.mget(
+            [
+                redis_keys.SERVER_CUMULATIVE_TIMESTEPS_KEY,
+                redis_keys.SERVER_INGESTED_TIMESTEPS_KEY,
+            ]
+        )
+        return max(0, int(pushed or 0) - int(ingested or 0))
+
     def push_data(self, key, data):
         red = self.redis
         packed_data = self._message_serializer.pack(data)
@@ -31,6 +51,10 @@ class RedisClient(object):
         red.lpush(key, packed_data)
         red.ltrim(key, 0, self.max_queue_size)
 
+    def push_experience(self, data, num_timesteps):
+        packed_data = self._message_serializer.pack(data)
+        self._experience_queue.push(packed_data, num_timesteps, self.max_queue_size)
+
     def set_data(self, key, data):
         if data is None:
             packed = data
@@ -45,10 +69,84 @@ class RedisClient(object):
             return packed
         return self._message_serializer.unpack(packed)
 
+    def flush(self, experience=None, num_timesteps=0, rewards=None):
+        """
+        Push everything a client produces in one collection window and fetch
+        everything it needs for the next one in a single round trip. The value
+        parameters for the epoch after ours are fetched speculatively in the
+        same pipeline, so a second request is only needed if we fell more than
+        one epoch behind.
+        :param experience: Serialized experience to push, or None.
+        :param num_timesteps: Number of timesteps in experience.
+        :param rewards: Episode rewards to push, or None.
+        :return: Tuple of (server status, (reward mean, reward std), value
+                 params or None if there is no new version).
+        """
+
+        with self._fetch_lock:
+            next_epoch = self.current_value_epoch + 1
+            speculative_epochs = self._val_decoder.get_required_epochs(next_epoch)
+
+            pipe = self.redis.pipeline()
+            pipe.get(redis_keys.SERVER_CURRENT_STATUS_KEY)
+            if experience is not None:
+                # Experience is only pushed if the server is still running when
+                # it arrives. On the primary the check and the push are one
+                # script. A separate shard can't see the status, so we check it
+                # first.
+                packed_data = self._message_serializer.pack(experience)
+                if self._experience_redis is self.redis:
+                    self._experience_queue.push_if_status(
+                        packed_data,
+                        num_timesteps,
+                        self.max_queue_size,
+                        ServerTransport.RUNNING_STATUS,
+                        redis_keys.SERVER_CUMULATIVE_TIMESTEPS_KEY,
+                        pipe=pipe,
+                    )
+                elif self.check_server_status() == ServerTransport.RUNNING_STATUS:
+                    self._experience_queue.push(
+                        packed_data, num_timesteps, self.max_queue_size
+                    )
+                    pipe.incrby(
+                        redis_keys.SERVER_CUMULATIVE_TIMESTEPS_KEY, num_timesteps
+                    )
+            if rewards:
+                pipe.lpush(
+                    redis_keys.CLIENT_POLICY_REWARD_KEY,
+                    self._message_serializer.pack(rewards),
+                )
+                pipe.ltrim(redis_keys.CLIENT_POLICY_REWARD_KEY, 0, self.max_queue_size)
+            pipe.get(redis_keys.SERVER_CURRENT_UPDATE_KEY)
+            pipe.get(redis_keys.RUNNING_REWARD_MEAN_KEY)
+            pipe.get(redis_keys.RUNNING_REWARD_STD_KEY)
+            pipe.mget(
+                [
+                    version_key(redis_keys.SERVER_VAL_PARAMS_KEY, e)
+                    for e in speculative_epochs
+                ]
+            )
+            results = pipe.execute()
+
+            status = results[0]
+            if status is not None:
+                status = status.decode("utf-8")
+
+            epoch, mean, std, packed_payloads = results[-4:]
+            reward_stats = self._parse_reward_stats(mean, std)
+
+            return (
+                status,
+                reward_stats,
+                self._apply_value_update(epoch, next_epoch, packed_payloads),
+            )
+
     def get_reward_stats(self):
         mean = self.redis.get(redis_keys.RUNNING_REWARD_MEAN_KEY)
         std = self.redis.get(redis_keys.RUNNING_REWARD_STD_KEY)
+        return self._parse_reward_stats(mean, std)
 
+    def _parse_reward_stats(self, mean, std):
         if mean is None or std is None:
             mean = 0
             std = 1
@@ -67,92 +165,218 @@ class RedisClient(object):
             for packed_result in packed_results
         ]
 
+    def start_update_listener(self, callback):
+        """
+        Subscribe to the channel the server publishes new epochs on.
+        :param callback: Function called with the new epoch number. It runs on
+                         a background thread, so anything it touches must be
+                         safe to share with the caller's thread.
+        :return: None.
+        """
+
+        def handler(message):
+            try:
+                callback(int(message["data"]))
+            except Exception as e:
+                # An exception here would kill the listener thread, the polling
+                # path will pick the update up instead.
+                print(f"WARNING: failed to handle epoch notification: {e}")
+
+        self.stop_update_listener()
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{redis_keys.SERVER_UPDATE_CHANNEL: handler})
+        self._update_listener = pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+
+    def is_listening_for_updates(self):
+        return self._update_listener is not None and self._update_listener.is_alive()
+
+    def stop_update_listener(self):
+        if self._update_listener is not None:
+            self._update_listener.stop()
+            self._update_listener = None
+
     def get_latest_value_params(self):
-        red = self.redis
-        epoch = red.get(redis_keys.SERVER_CURRENT_UPDATE_KEY)
-        if epoch is not None:
-            epoch = int(epoch)
+        with self._fetch_lock:
+            return self._get_latest_value_params()
+
+    def _get_latest_value_params(self):
+        # The epoch pointer is read together with the payloads of the epoch
+        # after ours, so the usual case of being one epoch behind takes a
+        # single round trip.
+        for _ in range(FETCH_ATTEMPTS):
+            next_epoch = self.current_value_epoch + 1
+            pipe = self.redis.pipeline()
+            pipe.get(redis_keys.SERVER_CURRENT_UPDATE_KEY)
+            pipe.mget(
+                [
+                    version_key(redis_keys.SERVER_VAL_PARAMS_KEY, e)
+                    for e in self._val_decoder.get_required_epochs(next_epoch)
+                ]
+            )
+            epoch, packed_payloads = pipe.execute()
 
-        if epoch == self.current_value_epoch or epoch is None:
-            return None
+            if epoch is None or int(epoch) == self.current_value_epoch:
+                return None
 
-        self.current_value_epoch = epoch
+            val_params = self._apply_value_update(epoch, next_epoch, packed_payloads)
+            if val_params is not None:
+                return val_params
 
-        encoded_val = red.get(redis_keys.SERVER_VAL_PARAMS_KEY)
-        if encoded_val is None:
-            return None
-        return self._message_serializer.unpack(encoded_val)
+            # The versions we needed expired before we got to them, the pointer
+            # has moved on since, so start over from the latest one.
 
-    def get_latest_update(self):
-        red = self.redis
-        epoch = red.get(redis_keys.SERVER_CURRENT_UPDATE_KEY)
-        if epoch is not None:
-            epoch = int(epoch)
+        return None
 
-        if epoch == self.current_epoch or epoch is None:
-            return None, None, None, False
+    def _apply_value_update(self, epoch, next_epoch, packed_payloads):
+        """
+        Bring the value parameters up to the epoch the pointer was at.
+        :param epoch: Raw value of the epoch pointer.
+        :param next_epoch: Epoch the payloads were fetched for.
+        :param packed_payloads: Payloads fetched together with the pointer.
+        :return: Value parameters, or None if there is no new version or it
+                 couldn't be fetched.
+        """
 
-        self.current_epoch = epoch
+        if epoch is None or int(epoch) == self.current_value_epoch:
+            return None
 
-        pipe = red.pipeline()
-        pipe.get(redis_keys.SERVER_POLICY_PARAMS_KEY)
-        pipe.get(redis_keys.SERVER_STRATEGY_FRAMES_KEY)
-        pipe.get(redis_keys.SERVER_STRATEGY_HISTORY_KEY)
-        results = pipe.execute()
+        epoch = int(epoch)
+        val_params = None
+        if epoch == next_epoch:
+            payloads = [
+                None if packed is None else self._message_serializer.unpack(packed)
+                for packed in packed_payloads
+            ]
+            if self._val_decoder.apply(payloads, epoch):
+                val_params = self._val_decoder.params
+
+        if val_params is None:
+            val_params = self._fetch_params(
+                redis_keys.SERVER_VAL_PARAMS_KEY, self._val_decoder, epoch
+            )
 
-        packed_policy, packed_frames, packed_history = results
+        if val_params is not None:
+            self.current_value_epoch = epoch
 
-        policy = self._message_serializer.unpack(packed_policy)
-        frames = self._message_serializer.unpack(packed_frames)
-        history = self._message_serializer.unpack(packed_history)
+        return val_params
 
-        return policy, frames, history, True
+    def get_latest_update(self, epoch=None):
+        with self._fetch_lock:
+            return self._get_latest_update(epoch)
 
-    def get_cfg(self):
-        import numpy as np
-        import random
-        import torch
+    def _get_latest_update(self, epoch=None):
+        if epoch is not None:
+            # A notification can arrive after a poll already got us something
+            # newer.
+            if epoch <= self.current_epoch:
+                return None, None, None, False
+            return self._fetch_update(epoch)
+
+        # Without a notification the epoch pointer is read in the same round
+        # trip as the snapshot of the epoch after ours. If the pointer turns
+        # out to be further ahead, or the snapshot it points at expires before
+        # we fetch it, we go again.
+        for _ in range(FETCH_ATTEMPTS):
+            next_epoch = self.current_epoch + 1
+            pipe = self.redis.pipeline()
+            pipe.get(redis_keys.SERVER_CURRENT_UPDATE_KEY)
+            pipe.mget(self._get_update_keys(next_epoch))
+            epoch, packed_results = pipe.execute()
+
+            if epoch is None or int(epoch) == self.current_epoch:
+                return None, None, None, False
 
-        print("Fetching new config...")
-        while True:
-            status = self.redis.get(redis_keys.SERVER_CURRENT_STATUS_KEY)
-            if status is not None:
-                status = status.decode("utf-8")
+            epoch = int(epoch)
+            if epoch == next_epoch:
+                update = self._apply_update(epoch, packed_results)
+            else:
+                update = self._fetch_update(epoch)
+
+            if update[-1]:
+                return update
+
+        return None, None, None, False
+
+    def _get_update_keys(self, epoch):
+        # Everything in the snapshot lives under keys suffixed with its epoch,
+        # so one MGET gets a consistent set even if the server publishes the
+        # next epoch in the meantime.
+        epochs = self._policy_decoder.get_required_epochs(epoch)
+        return [version_key(redis_keys.SERVER_STRATEGY_SNAPSHOT_KEY, epoch)] + [
+            version_key(redis_keys.SERVER_POLICY_PARAMS_KEY, e) for e in epochs
+        ]
 
-            print("Waiting for server to start...", status)
+    def _fetch_update(self, epoch):
+        return self._apply_update(epoch, self.redis.mget(self._get_update_keys(epoch)))
 
-            if (
-                status == RedisServer.RUNNING_STATUS
-                or status == RedisServer.AWAITING_ENV_SPACES_STATUS
-            ):
-                break
+    def _apply_update(self, epoch, packed_results):
+        packed_strategy = packed_results[0]
+        if packed_strategy is None:
+            return None, None, None, False
 
-            time.sleep(1)
+        payloads = [
+            None if packed is None else self._message_serializer.unpack(packed)
+            for packed in packed_results[1:]
+        ]
+        if self._policy_decoder.apply(payloads, epoch):
+            policy = self._policy_decoder.params
+        else:
+            policy = self._fetch_params(
+                redis_keys.SERVER_POLICY_PARAMS_KEY, self._policy_decoder, epoch
+            )
+        if policy is None:
+            return None, None, None, False
 
-        cfg = dict(
-            json.loads(self.redis.get(redis_keys.SERVER_CONFIG_KEY).decode("utf-8"))
-        )
-        self.max_queue_size = cfg["experience_replay"]["max_buffer_size"]
-        print("Fetched new config!")
+        self.current_epoch = epoch
+        frames, history = self._message_serializer.unpack(packed_strategy)
 
-        cfg["rng"] = np.random.RandomState(cfg["seed"])
-        torch.manual_seed(cfg["seed"])
-        np.random.seed(cfg["seed"])
-        random.seed(cfg["seed"])
+        return policy, frames, history, True
 
+    def _fetch_params(self, key, decoder, epoch):
+        # Try to catch up by applying the deltas we are missing first. If any
+        # of them are gone, rebuild from the latest keyframe instead.
+        for from_keyframe in (False, True):
+            epochs = decoder.get_required_epochs(epoch, from_keyframe=from_keyframe)
+            packed_payloads = self.redis.mget([version_key(key, e) for e in epochs])
+            payloads = [
+                None if packed is None else self._message_serializer.unpack(packed)
+                for packed in packed_payloads
+            ]
+            if decoder.apply(payloads, epoch):
+                return decoder.params
+
+        return None
+
+    def _get_cfg_json(self):
+        return self.redis.get(redis_keys.SERVER_CONFIG_KEY).decode("utf-8")
+
+    def configure(self, cfg):
         self._configure_serialization(cfg)
+        self._connect_experience_shard(cfg)
 
-        return cfg
+        networking_cfg = cfg.get("networking", {})
+        keyframe_interval = networking_cfg.get("param_keyframe_interval", 1)
+        self._policy_decoder = ParameterDeltaDecoder(keyframe_interval)
+        self._val_decoder = ParameterDeltaDecoder(keyframe_interval)
+
+    def _connect_experience_shard(self, cfg):
+        if self._experience_redis is not self.redis:
+            self._experience_redis.close()
+
+        shards = experience_queues.connect_shards(cfg, self.redis)
+        client_id = experience_queues.get_client_id()
+        shard_index = experience_queues.get_shard_index(client_id, len(shards))
+        self._experience_redis = shards[shard_index]
+        self._experience_queue = experience_queues.get_from_cfg(
+            self._experience_redis, cfg
+        )
+
+        if len(shards) > 1:
+            print(f"Client {client_id} pushing experience to shard {shard_index}")
 
     def _configure_serialization(self, cfg):
-        networking_cfg = cfg.get("networking", {})
-        compression_type = networking_cfg.get("compression", None)
-        if compression_type:
-            self._message_serializer = MessageSerializer(
-                compression_type=compression_type
-            )
-        else:
-            self._message_serializer = MessageSerializer()
+        dictionary = self.redis.get(redis_keys.SERVER_COMPRESSION_DICTIONARY_KEY)
+        self._message_serializer = message_serialization.get_from_cfg(cfg, dictionary)
 
     def check_server_status(self):
         status = self.redis.get(redis_keys.SERVER_CURRENT_STATUS_KEY)
@@ -166,4 +390,7 @@ class RedisClient(object):
         self.redis.set(redis_keys.ENV_SPACES_KEY, encoded)
 
     def disconnect(self):
+        self.stop_update_listener()
+        if self._experience_redis is not self.redis:
+            self._experience_redis.close()
         self.redis.close()
@@ -1,19 +1,23 @@
 ENV_SPACES_KEY = "ENV_SPACES_KEY"
 
 SERVER_POLICY_PARAMS_KEY = "SERVER_POLICY_PARAMS_KEY"
-SERVER_STRATEGY_FRAMES_KEY = "SERVER_STRATEGY_FRAMES_KEY"
-SERVER_STRATEGY_HISTORY_KEY = "SERVER_STRATEGY_HISTORY_KEY"
+SERVER_STRATEGY_SNAPSHOT_KEY = "SERVER_STRATEGY_SNAPSHOT_KEY"
 SERVER_VAL_PARAMS_KEY = "SERVER_VAL_PARAMS_KEY"
 SERVER_CURRENT_UPDATE_KEY = "SERVER_CURRENT_UPDATE_KEY"
 SERVER_CUMULATIVE_TIMESTEPS_KEY = "SERVER_CUMULATIVE_TIMESTEPS_KEY"
+SERVER_INGESTED_TIMESTEPS_KEY = "SERVER_INGESTED_TIMESTEPS_KEY"
 SERVER_CURRENT_STATUS_KEY = "SERVER_CURRENT_STATUS_KEY"
 SERVER_CONFIG_KEY = "SERVER_CONFIG_KEY"
+SERVER_COMPRESSION_DICTIONARY_KEY = "SERVER_COMPRESSION_DICTIONARY_KEY"
+
+SERVER_UPDATE_CHANNEL = "SERVER_UPDATE_CHANNEL"
 
 CLIENT_POLICY_REWARD_KEY = "CLIENT_POLICY_REWARD_KEY"
 CLIENT_POLICY_GRADIENT_KEY = "CLIENT_POLICY_GRADIENT_KEY"
 CLIENT_VALUE_GRADIENT_KEY = "CLIENT_VALUE_GRADIENT_KEY"
 CLIENT_NOVELTY_GRADIENT_KEY = "CLIENT_NOVELTY_GRADIENT_KEY"
 CLIENT_EXPERIENCE_KEY = "CLIENT_EXPERIENCE_KEY"
+CLIENT_EXPERIENCE_STREAM_KEY = "CLIENT_EXPERIENCE_STREAM_KEY"
 
 RUNNING_REWARD_MEAN_KEY = "RUNNING_REWARD_MEAN_KEY"
 RUNNING_REWARD_STD_KEY = "RUNNING_REWARD_STD_KEY"
@@ -1,87 +1,50 @@
 from redis import Redis
-from distrib_rl.distrib import redis_keys
+from distrib_rl.distrib import redis_keys, experience_queues, message_serialization
 from distrib_rl.distrib.message_serialization import MessageSerializer
+from distrib_rl.distrib.parameter_deltas import ParameterDeltaEncoder, version_key
+from distrib_rl.distrib.transport import ServerTransport
+from concurrent.futures import ThreadPoolExecutor, wait, ALL_COMPLETED, FIRST_COMPLETED
+from collections import deque
 import time
 import pyjson5 as json
 import os
 
+# Seconds an old parameter version stays readable after the server stops
+# pointing clients at it.
+DEFAULT_SNAPSHOT_TTL = 60
 
-class RedisServer(object):
-    INITIALIZING_STATUS = "REDIS_SERVER_INITIALIZING_STATUS"
-    RUNNING_STATUS = "REDIS_SERVER_RUNNING_STATUS"
-    STOPPING_STATUS = "REDIS_SERVER_STOPPING_STATUS"
-    RESET_STATUS = "REDIS_SERVER_RESET_STATUS"
-    RECONFIGURE_STATUS = "REDIS_SERVER_RECONFIGURE_STATUS"
-    AWAITING_ENV_SPACES_STATUS = "REDIS_SERVER_AWAITING_ENV_SPACES_STATUS"
 
+class RedisServer(ServerTransport):
     def __init__(self, max_queue_size):
+        super().__init__(max_queue_size)
         self.redis = None
-        self.max_queue_size = max_queue_size
-        self.internal_buffer = []
-        self.available_timesteps = 0
-
-        self.last_sps_measure = time.time()
-        self.accumulated_sps = 0
-        self.steps_per_second = 0
         self._message_serializer = MessageSerializer()
-        self.current_epoch = 0
-
-        # TODO: hardcoded for now, but should be made configurable in the future
-        self.max_policy_age = float("inf")
+        self._compression_dictionary = None
+        self._experience_queues = []
+        self._shard_executor = None
+        self._pending_pops = {}
+        self._unacked = deque()
+        self._policy_encoder = ParameterDeltaEncoder()
+        self._val_encoder = ParameterDeltaEncoder()
+        self._snapshot_ttl = DEFAULT_SNAPSHOT_TTL
+        self._last_update_epoch = None
 
     def connect(self, clear_existing=False, new_server_instance=True):
         ip = os.environ.get("REDIS_HOST", default="localhost")
         port = os.environ.get("REDIS_PORT", default=6379)
         password = os.environ.get("REDIS_PASSWORD", default=None)
         self.redis = Redis(host=ip, port=port, password=password)
+        self._experience_queues = [experience_queues.ListExperienceQueue(self.redis)]
         if clear_existing:
             self.redis.flushall()
 
         if new_server_instance:
             self.redis.set(
-                redis_keys.SERVER_CURRENT_STATUS_KEY, RedisServer.INITIALIZING_STATUS
+                redis_keys.SERVER_CURRENT_STATUS_KEY,
+                ServerTransport.INITIALIZING_STATUS,
             )
             self.redis.set(redis_keys.NEW_DATA_AMOUNT_KEY, 0)
 
-    def get_n_timesteps(self, n):
-        self._update_buffer()
-        n_collected = 0
-        returns = []
-
-        while n_collected < n:
-            while self.available_timesteps < n - n_collected:
-                self._update_buffer()
-                time.sleep(0.01)
-
-            ret = self.internal_buffer.pop(-1)
-            trajectory, num_timesteps, policy_epoch = ret
-
-            if self.current_epoch - policy_epoch <= self.max_policy_age:
-                returns.append(trajectory)
-                n_collected += num_timesteps
-
-        self.available_timesteps -= n_collected
-        return returns
-
-    def get_up_to_n_timesteps(self, n):
-        self._update_buffer()
-        if len(self.internal_buffer) == 0:
-            return []
-
-        n_collected = 0
-        buffer = self.internal_buffer
-        returns = []
-
-        while len(buffer) > 0 and n_collected < n:
-            ret = buffer.pop(-1)
-            trajectory, num_timesteps, policy_epoch = ret
-            if self.current_epoch - policy_epoch <= self.max_policy_age:
-                returns.append(trajectory)
-                n_collected += num_timesteps
-
-        self.available_timesteps -= n_collected
-        return returns
-
     def get_policy_rewards(self):
         # rewards are pushed as packed/compressed lists of scalar values
         # atomic_pop_all returns all entries for a given key as a list, giving
@@ -106,21 +69,78 @@ class RedisServer(object):
 
         self.current_epoch = current_epoch
 
-        packed_policy = self._message_serializer.pack(policy_params)
-        packed_val = self._message_serializer.pack(val_params)
-        packed_frames = self._message_serializer.pack(strategy_frames)
-        packed_history = self._message_serializer.pack(strategy_history)
+        policy_payload, expired_policy = self._policy_encoder.encode(
+            policy_params, current_epoch
+        )
+        val_payload, expired_val = self._val_encoder.encode(val_params, current_epoch)
 
-        pipe = red.pipeline()
-        pipe.set(redis_keys.SERVER_POLICY_PARAMS_KEY, packed_policy)
-        pipe.set(redis_keys.SERVER_VAL_PARAMS_KEY, packed_val)
-        pipe.set(redis_keys.SERVER_STRATEGY_FRAMES_KEY, packed_frames)
-        pipe.set(redis_keys.SERVER_STRATEGY_HISTORY_KEY, packed_history)
+        packed_policy = self._message_serializer.pack(policy_payload)
+        packed_val = self._message_serializer.pack(val_payload)
+        packed_strategy = self._message_serializer.pack(
+            (strategy_frames, strategy_history)
+        )
+
+        # Every version is written once under its own key and the pointer is
+        # moved in the same MULTI/EXEC, so a client that reads the pointer
+        # always finds a complete snapshot behind it.
+        pipe = red.pipeline(transaction=True)
+        pipe.set(
+            version_key(redis_keys.SERVER_POLICY_PARAMS_KEY, current_epoch),
+            packed_policy,
+        )
+        pipe.set(
+            version_key(redis_keys.SERVER_VAL_PARAMS_KEY, current_epoch), packed_val
+        )
+        pipe.set(
+            version_key(redis_keys.SERVER_STRATEGY_SNAPSHOT_KEY, current_epoch),
+            packed_strategy,
+        )
         pipe.set(redis_keys.SERVER_CURRENT_UPDATE_KEY, current_epoch)
+
+        # Versions nobody can start fetching anymore are left to expire rather
+        # than deleted, so clients that are still reading them can finish.
+        for epoch in expired_policy:
+            pipe.expire(
+                version_key(redis_keys.SERVER_POLICY_PARAMS_KEY, epoch),
+                self._snapshot_ttl,
+            )
+        for epoch in expired_val:
+            pipe.expire(
+                version_key(redis_keys.SERVER_VAL_PARAMS_KEY, epoch),
+                self._snapshot_ttl,
+            )
+        if (
+            self._last_update_epoch is not None
+            and self._last_update_epoch != current_epoch
+        ):
+            pipe.expire(
+                version_key(
+                    redis_keys.SERVER_STRATEGY_SNAPSHOT_KEY, self._last_update_epoch
+                ),
+                self._snapshot_ttl,
+            )
+        self._last_update_epoch = current_epoch
+
+        # Subscribed clients fetch the new parameters as soon as this arrives
+        # instead of waiting for their next poll.
+        pipe.publish(redis_keys.SERVER_UPDATE_CHANNEL, current_epoch)
         pipe.execute()
 
-    def push_cfg(self, cfg):
+    def configure(self, cfg):
         self._configure_serialization(cfg)
+        self._configure_shards(cfg)
+
+        networking_cfg = cfg.get("networking", {})
+        keyframe_interval = networking_cfg.get("param_keyframe_interval", 1)
+        delta_dtype = networking_cfg.get("param_delta_dtype", "float16")
+        self._snapshot_ttl = networking_cfg.get("snapshot_ttl", DEFAULT_SNAPSHOT_TTL)
+        self._policy_encoder = ParameterDeltaEncoder(keyframe_interval, delta_dtype)
+        self._val_encoder = ParameterDeltaEncoder(keyframe_interval, delta_dtype)
+
+        super().configure(cfg)
+
+    def push_cfg(self, cfg):
+        self.configure(cfg)
 
         dev = cfg["device"]
         rng = cfg["rng"]
@@ -129,34 +149,85 @@ class RedisServer(object):
         cfg["device"] = "cpu"
         self.redis.set(redis_keys.SERVER_CONFIG_KEY, json.dumps(cfg))
 
+        # Clients can't read our dictionary file, so it is handed out through
+        # redis along with the config.
+        if self._compression_dictionary is None:
+            self.redis.delete(redis_keys.SERVER_COMPRESSION_DICTIONARY_KEY)
+        else:
+            self.redis.set(
+                redis_keys.SERVER_COMPRESSION_DICTIONARY_KEY,
+                self._compression_dictionary,
+            )
+
         cfg["rng"] = rng
         cfg["device"] = dev
 
+    def _configure_shards(self, cfg):
+        self._close_shards()
+
+        shards = experience_queues.connect_shards(cfg, self.redis)
+        self._experience_queues = [
+            experience_queues.get_from_cfg(shard, cfg) for shard in shards
+        ]
+
+        # Every shard gets a thread of its own so one shard blocking or being
+        # slow doesn't hold up the others.
+        if len(shards) > 1:
+            self._shard_executor = ThreadPoolExecutor(
+                max_workers=len(shards), thread_name_prefix="experience_shard"
+            )
+
+    def _close_shards(self):
+        if self._shard_executor is not None:
+            self._shard_executor.shutdown(wait=False)
+            self._shard_executor = None
+        self._pending_pops = {}
+        self._unacked.clear()
+
+        for queue in self._experience_queues:
+            if queue.redis is not self.redis:
+                queue.redis.close()
+        self._experience_queues = []
+
     def _configure_serialization(self, cfg):
         networking_cfg = cfg.get("networking", {})
-        compression_type = networking_cfg.get("compression", None)
-        if compression_type:
-            self._message_serializer = MessageSerializer(
-                compression_type=compression_type
-            )
-        else:
-            self._message_serializer = MessageSerializer()
+        dictionary_path = networking_cfg.get("compression_dictionary", None)
+        self._compression_dictionary = None
+        if dictionary_path:
+            with open(dictionary_path, "rb") as f:
+                self._compression_dictionary = f.read()
+
+        self._message_serializer = message_serialization.get_from_cfg(
+            cfg, self._compression_dictionary
+        )
 
     def signal_ready(self):
-        self.redis.set(redis_keys.SERVER_CURRENT_STATUS_KEY, RedisServer.RUNNING_STATUS)
+        self.redis.set(
+            redis_keys.SERVER_CURRENT_STATUS_KEY, ServerTransport.RUNNING_STATUS
+        )
 
         pipe = self.redis.pipeline()
-        pipe.delete(redis_keys.CLIENT_EXPERIENCE_KEY)
+        shard_pipes = []
+        for queue in self._experience_queues:
+            if queue.redis is self.redis:
+                queue.clear(pipe)
+            else:
+                shard_pipe = queue.redis.pipeline()
+                queue.clear(shard_pipe)
+                shard_pipes.append(shard_pipe)
         pipe.delete(redis_keys.CLIENT_POLICY_REWARD_KEY)
         pipe.set(redis_keys.NEW_DATA_AMOUNT_KEY, 0)
 
         # Short sleep to let any pre-connected clients update their policies before we erase the existing data.
         time.sleep(1)
         pipe.execute()
+        for shard_pipe in shard_pipes:
+            shard_pipe.execute()
 
     def get_env_spaces(self):
         self.redis.set(
-            redis_keys.SERVER_CURRENT_STATUS_KEY, RedisServer.AWAITING_ENV_SPACES_STATUS
+            redis_keys.SERVER_CURRENT_STATUS_KEY,
+            ServerTransport.AWAITING_ENV_SPACES_STATUS,
         )
         in_space, out_space = None, None
 
@@ -169,35 +240,92 @@ class RedisServer(object):
             in_space, out_space = self._message_serializer.unpack(data)
         return in_space, out_space
 
-    def _update_buffer(self):
-        returns = self._atomic_pop_all(redis_keys.CLIENT_EXPERIENCE_KEY)
-        collected_timesteps = 0
-        for trajectories in returns:
-            for serialized_trajectory, policy_epoch in trajectories:
-                n_timesteps = len(serialized_trajectory[0])
-                collected_timesteps += n_timesteps
-                self.internal_buffer.append(
-                    (serialized_trajectory, n_timesteps, policy_epoch)
-                )
-
-        self.available_timesteps += collected_timesteps
+    def set_status(self, status):
+        self.redis.set(redis_keys.SERVER_CURRENT_STATUS_KEY, status)
 
-        self._update_sps(collected_timesteps)
-        self._trim_buffer()
-
-    def _trim_buffer(self):
-        while self.max_queue_size < len(self.internal_buffer):
-            ret = self.internal_buffer.pop(0)
-            del ret
+    def set_reward_stats(self, mean, std):
+        pipe = self.redis.pipeline()
+        pipe.set(redis_keys.RUNNING_REWARD_MEAN_KEY, float(mean))
+        pipe.set(redis_keys.RUNNING_REWARD_STD_KEY, float(std))
+        pipe.execute()
 
-    def _update_sps(self, collected_timesteps):
-        self.accumulated_sps += collected_timesteps
-        elapsed = time.time() - self.last_sps_measure
+    def get_cumulative_timesteps(self):
+        timesteps = self.redis.get(redis_keys.SERVER_CUMULATIVE_TIMESTEPS_KEY)
+        if timesteps is None:
+            return 0
+        return int(timesteps)
+
+    def _get_published_epoch(self):
+        epoch = self.redis.get(redis_keys.SERVER_CURRENT_UPDATE_KEY)
+        if epoch is None:
+            return None
+        return int(epoch)
+
+    def _add_ingested_timesteps(self, timesteps):
+        self.redis.incrby(redis_keys.SERVER_INGESTED_TIMESTEPS_KEY, timesteps)
+
+    def _get_ingested_timesteps(self):
+        timesteps = self.redis.get(redis_keys.SERVER_INGESTED_TIMESTEPS_KEY)
+        if timesteps is None:
+            return 0
+        return int(timesteps)
+
+    def _decode_experience(self, message):
+        return self._message_serializer.unpack(message)
+
+    def _get_experience_decoder(self):
+        return self._message_serializer.unpack
+
+    def _pop_experience(self, block_timeout):
+        if self._shard_executor is None:
+            queue = self._experience_queues[0]
+            packed_results = queue.pop(block_timeout=block_timeout)
+            self._unacked.extend(queue for _ in packed_results)
+            return packed_results
+
+        # Start a pop on every shard that doesn't already have one in flight.
+        # When blocking we return as soon as any shard has data and leave the
+        # others running, their results are collected on a later call.
+        for i, queue in enumerate(self._experience_queues):
+            if i not in self._pending_pops:
+                self._pending_pops[i] = self._shard_executor.submit(
+                    queue.pop, block_timeout
+                )
 
-        if elapsed >= 1:
-            self.steps_per_second = self.accumulated_sps / elapsed
-            self.accumulated_sps = 0
-            self.last_sps_measure = time.time()
+        return_when = ALL_COMPLETED if block_timeout is None else FIRST_COMPLETED
+        wait(self._pending_pops.values(), return_when=return_when)
+
+        packed_results = []
+        for i, future in list(self._pending_pops.items()):
+            if future.done():
+                del self._pending_pops[i]
+                results = future.result()
+                self._unacked.extend(self._experience_queues[i] for _ in results)
+                packed_results += results
+
+        return packed_results
+
+    def _acknowledge_experience(self, num_messages):
+        # Remember which queue each message came from, so every queue is told
+        # how many of its own messages were decoded.
+        counts = {}
+        for _ in range(num_messages):
+            queue = self._unacked.popleft()
+            counts[queue] = counts.get(queue, 0) + 1
+
+        for queue, count in counts.items():
+            queue.ack(count)
+
+    def _can_resync_backlog(self):
+        # Several server processes can share a stream through its consumer
+        # group, and what the others hold isn't in our buffer.
+        for queue in self._experience_queues:
+            if (
+                isinstance(queue, experience_queues.StreamExperienceQueue)
+                and queue.count_consumers() > 1
+            ):
+                return False
+        return True
 
     def _atomic_pop_all(self, key):
         pipe = self.redis.pipeline()
@@ -212,13 +340,22 @@ class RedisServer(object):
         ]
 
     def disconnect(self):
+        self._close_decode_pool()
+        for queue in self._experience_queues:
+            if queue.redis is not self.redis:
+                pipe = queue.redis.pipeline()
+                queue.clear(pipe)
+                pipe.execute()
+        self._close_shards()
+
         if self.redis is not None:
             self.redis.flushall()
             print("\nATTEMPTING TO SET REDIS TO STOPPING STATUS")
             self.redis.set(
-                redis_keys.SERVER_CURRENT_STATUS_KEY, RedisServer.STOPPING_STATUS
+                redis_keys.SERVER_CURRENT_STATUS_KEY, ServerTransport.STOPPING_STATUS
             )
             self.redis.close()
 
-        del self.internal_buffer
-        self.internal_buffer = []
+        self.internal_buffer.clear()
+        self.available_timesteps = 0
+        self.available_bytes = 0
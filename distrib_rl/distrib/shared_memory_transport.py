@@ -0,0 +1,878 @@
+"""
+    File name: shared_memory_transport.py
+
+    Description:
+        Transport for runs where the server and all of its clients live on one
+        host. Everything goes through multiprocessing.shared_memory segments,
+        so no Redis daemon, sockets or msgpack are involved.
+
+        The server owns a small control block holding the status, reward
+        statistics, the current epoch and the version of every published blob.
+        Blobs (config, env spaces, parameter updates, the current MARL
+        opponent) are immutable segments named after their version, so a reader
+        never sees a half written one. Data that flows from the clients to the
+        server goes through single producer, single consumer ring buffers.
+        Every process that pushes data claims a producer slot holding one ring
+        per channel, and each channel is drained by exactly one process on the
+        server side.
+
+        Experience is pickled with protocol 5 and its arrays are written to the
+        ring as out-of-band buffers, so they are copied once into the ring and
+        once out of it.
+
+        A producer that closes only marks itself closed in the control block.
+        Its consumers drain what it left behind, and whichever of them finds
+        every ring of the producer empty removes its segment.
+
+        The rings rely on the hardware not reordering stores with other stores,
+        or loads with other loads, as on x86 (TSO). Python has no memory
+        fences, so on weaker memory models such as ARM a consumer could see a
+        moved head before the record it publishes. transport_factory refuses
+        to pick this transport on anything but x86.
+"""
+
+from distrib_rl.distrib import redis_keys
+from distrib_rl.distrib.transport import ServerTransport, ClientTransport
+from distrib_rl.mpframework.shared_segments import (
+    open_segment,
+    disown_segment,
+    unlink_segment,
+)
+from multiprocessing import shared_memory
+import pyjson5 as json
+import numpy as np
+import threading
+import pickle
+import struct
+import time
+import io
+import os
+
+CONTROL_MAGIC = 0x4452_4C53_484D
+MAX_PRODUCERS = 256
+
+# Control block layout, in int64 slots.
+MAGIC = 0
+TOKEN = 1
+STATUS = 2
+EPOCH = 3
+CLEAR_COUNT = 4
+REWARD_MEAN = 5
+REWARD_STD = 6
+INGESTED_TIMESTEPS = 7
+BLOB_VERSIONS = 8
+PRODUCER_GENERATIONS = 16
+PRODUCER_TIMESTEPS = PRODUCER_GENERATIONS + MAX_PRODUCERS
+CONTROL_SIZE = (PRODUCER_TIMESTEPS + MAX_PRODUCERS) * 8
+
+CONFIG_BLOB = 0
+ENV_SPACES_BLOB = 1
+UPDATE_BLOB = 2
+OPPONENT_BLOB = 3
+
+# Readers may still be opening the previous version of a blob when a new one is
+# written, so writers keep a couple.
+BLOBS_KEPT = 2
+
+EXPERIENCE_CHANNEL = 0
+REWARDS_CHANNEL = 1
+MATCH_RESULTS_CHANNEL = 2
+NUM_CHANNELS = 3
+
+DEFAULT_RING_SIZE = 64 * 1024 * 1024
+SMALL_RING_SIZE = 1024 * 1024
+
+# Ring header layout. The head and tail live on separate cache lines since they
+# are written by different processes.
+RING_HEAD = 0
+RING_TAIL = 8
+RING_CAPACITY = 16
+RING_HEADER_SIZE = 192
+RECORD_HEADER_SIZE = 16
+WRAP_MARKER = -1
+
+UPDATE_POLL_INTERVAL = 0.01
+BLOCKING_POLL_INTERVAL = 0.001
+
+STATUSES = (
+    None,
+    ServerTransport.INITIALIZING_STATUS,
+    ServerTransport.RUNNING_STATUS,
+    ServerTransport.STOPPING_STATUS,
+    ServerTransport.RESET_STATUS,
+    ServerTransport.RECONFIGURE_STATUS,
+    ServerTransport.AWAITING_ENV_SPACES_STATUS,
+)
+
+_BLOB_SLOTS = {redis_keys.MARL_CURRENT_OPPONENT_KEY: OPPONENT_BLOB}
+_LIST_CHANNELS = {
+    redis_keys.CLIENT_POLICY_REWARD_KEY: REWARDS_CHANNEL,
+    redis_keys.MARL_MATCH_RESULTS_KEY: MATCH_RESULTS_CHANNEL,
+}
+
+
+def get_prefix():
+    return os.environ.get("DISTRIB_RL_SHM_PREFIX", default="drl")
+
+
+def _align(size):
+    return (size + 7) & ~7
+
+
+class _Pickler(pickle.Pickler):
+    def reducer_override(self, obj):
+        # Serialized trajectory batches hold their columns as memoryviews,
+        # which can only be pickled out-of-band.
+        if isinstance(obj, memoryview):
+            return memoryview, (pickle.PickleBuffer(obj),)
+        return NotImplemented
+
+
+def _encode(data):
+    """
+    Pickle data with its buffers out-of-band.
+    :param data: Object to encode.
+    :return: List of byte-like parts that make up the record, in order.
+    """
+
+    buffers = []
+    stream = io.BytesIO()
+    _Pickler(stream, protocol=5, buffer_callback=buffers.append).dump(data)
+    pickled = stream.getbuffer()
+    raw_buffers = [buffer.raw() for buffer in buffers]
+
+    lengths = [len(pickled)] + [buffer.nbytes for buffer in raw_buffers]
+    parts = [struct.pack(f"<{len(lengths) + 1}q", len(raw_buffers), *lengths)]
+    for part in [pickled] + raw_buffers:
+        parts.append(part)
+        padding = _align(part.nbytes) - part.nbytes
+        if padding > 0:
+            parts.append(bytes(padding))
+
+    return parts
+
+
+def _decode(record):
+    (n_buffers,) = struct.unpack_from("<q", record, 0)
+    lengths = struct.unpack_from(f"<{n_buffers + 1}q", record, 8)
+
+    view = memoryview(record)
+    offset = 8 * (n_buffers + 2)
+    parts = []
+    for length in lengths:
+        parts.append(view[offset : offset + length])
+        offset += _align(length)
+
+    return pickle.loads(parts[0], buffers=parts[1:])
+
+
+class _Ring(object):
+    def __init__(self, buf, offset):
+        self._header = np.ndarray(
+            (RING_HEADER_SIZE // 8,), dtype=np.int64, buffer=buf, offset=offset
+        )
+        self.capacity = int(self._header[RING_CAPACITY])
+        start = offset + RING_HEADER_SIZE
+        self._data = buf[start : start + self.capacity]
+
+    def write(self, parts, stamp):
+        """
+        Append one record to the ring. Only the producer that owns the ring may
+        call this.
+        :param parts: Byte-like parts of the record.
+        :param stamp: Clear count at the time of writing, records stamped
+                      before the latest clear are discarded.
+        :return: True if the record was written, False if there wasn't enough
+                 free space.
+        """
+
+        length = RECORD_HEADER_SIZE + sum(memoryview(part).nbytes for part in parts)
+        size = _align(length)
+
+        head = int(self._header[RING_HEAD])
+        tail = int(self._header[RING_TAIL])
+        position = head % self.capacity
+        contiguous = self.capacity - position
+
+        needed = size if size <= contiguous else contiguous + size
+        if size > self.capacity or needed > self.capacity - (head - tail):
+            return False
+
+        if size > contiguous:
+            struct.pack_into("<q", self._data, position, WRAP_MARKER)
+            head += contiguous
+            position = 0
+
+        struct.pack_into("<qq", self._data, position, length, stamp)
+        offset = position + RECORD_HEADER_SIZE
+        for part in parts:
+            part = memoryview(part).cast("B")
+            self._data[offset : offset + part.nbytes] = part
+            offset += part.nbytes
+
+        # The head is only moved once the record is complete, this is what
+        # publishes it to the consumer. That takes stores becoming visible in
+        # program order, see the module description.
+        self._header[RING_HEAD] = head + size
+        return True
+
+    def read(self):
+        """
+        Take every record currently in the ring. Only the consumer of the
+        ring's channel may call this.
+        :return: List of (stamp, record) tuples.
+        """
+
+        head = int(self._header[RING_HEAD])
+        tail = int(self._header[RING_TAIL])
+
+        records = []
+        while tail < head:
+            position = tail % self.capacity
+            (length,) = struct.unpack_from("<q", self._data, position)
+            if length == WRAP_MARKER:
+                tail += self.capacity - position
+                continue
+
+            (stamp,) = struct.unpack_from("<q", self._data, position + 8)
+            start = position + RECORD_HEADER_SIZE
+            records.append((stamp, bytearray(self._data[start : position + length])))
+            tail += _align(length)
+
+        self._header[RING_TAIL] = tail
+        return records
+
+    def is_empty(self):
+        return int(self._header[RING_TAIL]) >= int(self._header[RING_HEAD])
+
+    def release(self):
+        self._data.release()
+        self._header = None
+
+
+def _ring_offsets(buf):
+    offsets = []
+    offset = 0
+    for _ in range(NUM_CHANNELS):
+        offsets.append(offset)
+        (capacity,) = struct.unpack_from("<q", buf, offset + RING_CAPACITY * 8)
+        offset += RING_HEADER_SIZE + capacity
+    return offsets
+
+
+class _ControlBlock(object):
+    def __init__(self, prefix, create=False):
+        self.prefix = prefix
+        self.owner = create
+        self._written_blobs = {}
+
+        name = f"{prefix}ctl"
+        if create:
+            try:
+                # Opened with tracking so that unlinking it doesn't confuse our
+                # resource tracker.
+                stale = shared_memory.SharedMemory(name=name)
+                stale.close()
+                stale.unlink()
+                print(f"Removed stale shared memory control block {name}")
+            except FileNotFoundError:
+                pass
+
+            self._segment = open_segment(name, create=True, size=CONTROL_SIZE)
+            self.values = np.ndarray(
+                (CONTROL_SIZE // 8,), dtype=np.int64, buffer=self._segment.buf
+            )
+            self.values[:] = 0
+            self.values[TOKEN] = int.from_bytes(os.urandom(4), "little")
+            self.values[STATUS] = STATUSES.index(ServerTransport.INITIALIZING_STATUS)
+            self.values[EPOCH] = -1
+            self.set_reward_stats(0, 1)
+
+            # Attaching processes check the magic number, so it has to be the
+            # last thing we write.
+            self.values[MAGIC] = CONTROL_MAGIC
+        else:
+            try:
+                self._segment = open_segment(name)
+            except ValueError:
+                # The creator hasn't sized the segment yet.
+                raise FileNotFoundError(
+                    f"Shared memory control block {name} is not ready"
+                )
+
+            self.values = np.ndarray(
+                (CONTROL_SIZE // 8,), dtype=np.int64, buffer=self._segment.buf
+            )
+            if self.values[MAGIC] != CONTROL_MAGIC:
+                self.close()
+                raise FileNotFoundError(
+                    f"Shared memory control block {name} is not ready"
+                )
+
+        self.token = int(self.values[TOKEN])
+
+    def get_status(self):
+        return STATUSES[int(self.values[STATUS])]
+
+    def set_status(self, status):
+        self.values[STATUS] = STATUSES.index(status)
+
+    def get_reward_stats(self):
+        mean, std = self.values[REWARD_MEAN : REWARD_STD + 1].view(np.float64)
+        return float(mean), float(std)
+
+    def set_reward_stats(self, mean, std):
+        self.values[REWARD_MEAN : REWARD_STD + 1].view(np.float64)[:] = (mean, std)
+
+    def get_cumulative_timesteps(self):
+        return int(
+            self.values[PRODUCER_TIMESTEPS : PRODUCER_TIMESTEPS + MAX_PRODUCERS].sum()
+        )
+
+    def producer_name(self, slot):
+        return f"{self.prefix}{self.token}p{slot}"
+
+    def write_blob(self, slot, data):
+        pickled = pickle.dumps(data, protocol=5)
+
+        version = int(self.values[BLOB_VERSIONS + slot])
+        while True:
+            version += 1
+            try:
+                segment = open_segment(
+                    self._blob_name(slot, version), create=True, size=len(pickled) + 8
+                )
+                break
+            except FileExistsError:
+                continue
+
+        struct.pack_into("<q", segment.buf, 0, len(pickled))
+        segment.buf[8 : 8 + len(pickled)] = pickled
+        self.values[BLOB_VERSIONS + slot] = version
+
+        written = self._written_blobs.setdefault(slot, [])
+        written.append(segment)
+        while len(written) > BLOBS_KEPT:
+            expired = written.pop(0)
+            expired.close()
+            expired.unlink()
+
+    def read_blob(self, slot):
+        version = int(self.values[BLOB_VERSIONS + slot])
+        while version != 0:
+            try:
+                segment = open_segment(self._blob_name(slot, version))
+            except FileNotFoundError:
+                # The writer moved on and deleted this version while we were
+                # opening it, try the new one. If there is no new one the
+                # writer has exited.
+                latest = int(self.values[BLOB_VERSIONS + slot])
+                if latest == version:
+                    return None
+                version = latest
+                continue
+
+            (length,) = struct.unpack_from("<q", segment.buf, 0)
+            pickled = bytes(segment.buf[8 : 8 + length])
+            segment.close()
+            return pickle.loads(pickled)
+
+        return None
+
+    def _blob_name(self, slot, version):
+        return f"{self.prefix}{self.token}b{slot}v{version}"
+
+    def close(self):
+        if self.owner:
+            # Producers that closed after their consumers stopped draining
+            # leave their segments to us, and so do clients that are still
+            # connected.
+            generations = self.values[
+                PRODUCER_GENERATIONS : PRODUCER_GENERATIONS + MAX_PRODUCERS
+            ]
+            for slot in np.flatnonzero(generations != 0):
+                unlink_segment(self.producer_name(slot))
+
+        for written in self._written_blobs.values():
+            for segment in written:
+                segment.close()
+                segment.unlink()
+        self._written_blobs = {}
+
+        self.values = None
+        self._segment.close()
+        if self.owner:
+            self._segment.unlink()
+
+
+class _Producer(object):
+    def __init__(self, control, ring_size):
+        self._control = control
+        capacities = [_align(ring_size), SMALL_RING_SIZE, SMALL_RING_SIZE]
+        size = sum(RING_HEADER_SIZE + capacity for capacity in capacities)
+
+        # Creating the segment is what claims a slot, so two producers can
+        # never end up sharing one.
+        self._segment = None
+        for slot in range(MAX_PRODUCERS):
+            try:
+                self._segment = open_segment(
+                    control.producer_name(slot), create=True, size=size
+                )
+                break
+            except FileExistsError:
+                continue
+
+        if self._segment is None:
+            raise RuntimeError(
+                f"All {MAX_PRODUCERS} shared memory producer slots are in use"
+            )
+
+        self.slot = slot
+        offset = 0
+        for capacity in capacities:
+            struct.pack_into(
+                "<q", self._segment.buf, offset + RING_CAPACITY * 8, capacity
+            )
+            offset += RING_HEADER_SIZE + capacity
+        self._rings = [
+            _Ring(self._segment.buf, o) for o in _ring_offsets(self._segment.buf)
+        ]
+
+        self.generation = abs(int(control.values[PRODUCER_GENERATIONS + slot])) + 1
+        control.values[PRODUCER_GENERATIONS + slot] = self.generation
+
+    def push(self, channel, data):
+        stamp = int(self._control.values[CLEAR_COUNT])
+        if self._rings[channel].write(_encode(data), stamp):
+            return True
+
+        print(
+            f"WARNING: shared memory ring for channel {channel} is full, dropping message"
+        )
+        return False
+
+    def add_timesteps(self, timesteps):
+        # Each slot's counter has a single writer, so this doesn't need to be
+        # atomic.
+        self._control.values[PRODUCER_TIMESTEPS + self.slot] += timesteps
+
+    def close(self):
+        # Consumers drain whatever is left in our rings once they see the
+        # generation flip, and the last of them removes the segment. We may
+        # exit before then, so it can't be left to our resource tracker either.
+        disown_segment(self._segment)
+        self._control.values[PRODUCER_GENERATIONS + self.slot] = -self.generation
+        for ring in self._rings:
+            ring.release()
+        self._rings = []
+        self._segment.close()
+
+
+class _Consumer(object):
+    def __init__(self, control, channel):
+        self._control = control
+        self._channel = channel
+        self._attached = {}
+        # Closed producers whose ring we already drained, by slot, with their
+        # negated generation.
+        self._finished = {}
+
+    def drain(self):
+        """
+        Take every record pushed to our channel by any producer since the last
+        call.
+        :return: List of raw records.
+        """
+
+        values = self._control.values
+        generations = values[
+            PRODUCER_GENERATIONS : PRODUCER_GENERATIONS + MAX_PRODUCERS
+        ].copy()
+        slots = set(np.flatnonzero(generations != 0).tolist())
+        slots.update(self._attached.keys())
+
+        records = []
+        for slot in sorted(slots):
+            generation = int(generations[slot])
+            attached = self._attached.get(slot, None)
+            if attached is not None:
+                records += attached[2].read()
+                if attached[0] == generation:
+                    continue
+
+                if attached[0] == -generation:
+                    self._finish(slot, generation)
+                else:
+                    self._detach(slot)
+
+            if generation > 0:
+                ring = self._attach(slot, generation)
+                if ring is not None:
+                    records += ring.read()
+            elif self._finished.get(slot, None) != generation:
+                # The producer closed before we ever saw it, its segment stays
+                # around until every ring is drained.
+                ring = self._attach(slot, -generation)
+                if ring is not None:
+                    records += ring.read()
+                    self._finish(slot, generation)
+                self._finished[slot] = generation
+
+        clear_count = int(values[CLEAR_COUNT])
+        return [record for stamp, record in records if stamp >= clear_count]
+
+    def _attach(self, slot, generation):
+        try:
+            segment = open_segment(self._control.producer_name(slot))
+        except FileNotFoundError:
+            return None
+
+        ring = _Ring(segment.buf, _ring_offsets(segment.buf)[self._channel])
+        self._attached[slot] = (generation, segment, ring)
+        return ring
+
+    def _finish(self, slot, generation):
+        # Nothing gets written to a closed producer's rings anymore, so once
+        # all of them are empty nobody needs the segment. Consumers of the
+        # other channels see the same and whoever gets there first removes it.
+        _, segment, _ = self._attached[slot]
+        rings = [_Ring(segment.buf, offset) for offset in _ring_offsets(segment.buf)]
+        empty = all(ring.is_empty() for ring in rings)
+        for ring in rings:
+            ring.release()
+
+        self._detach(slot)
+        self._finished[slot] = generation
+        if empty:
+            unlink_segment(self._control.producer_name(slot))
+
+    def _detach(self, slot):
+        _, segment, ring = self._attached.pop(slot)
+        ring.release()
+        segment.close()
+
+    def close(self):
+        for slot in list(self._attached.keys()):
+            self._detach(slot)
+
+
+class SharedMemoryServer(ServerTransport):
+    def __init__(self, max_queue_size):
+        super().__init__(max_queue_size)
+        self._control = None
+        self._consumers = {}
+
+    def connect(self, clear_existing=False, new_server_instance=True):
+        # Every server instance gets a fresh control block and namespace, so
+        # there is never anything to clear.
+        self._control = _ControlBlock(get_prefix(), create=new_server_instance)
+
+    def push_cfg(self, cfg):
+        self.configure(cfg)
+
+        dev = cfg["device"]
+        rng = cfg["rng"]
+
+        del cfg["rng"]
+        cfg["device"] = "cpu"
+        self._control.write_blob(CONFIG_BLOB, json.dumps(cfg))
+
+        cfg["rng"] = rng
+        cfg["device"] = dev
+
+    def signal_ready(self):
+        self._control.set_status(ServerTransport.RUNNING_STATUS)
+
+        # Short sleep to let any pre-connected clients update their policies
+        # before we erase the existing data.
+        time.sleep(1)
+        self._control.values[CLEAR_COUNT] += 1
+
+    def set_status(self, status):
+        self._control.set_status(status)
+
+    def get_env_spaces(self):
+        self._control.set_status(ServerTransport.AWAITING_ENV_SPACES_STATUS)
+
+        env_spaces = None
+        while env_spaces is None:
+            env_spaces = self._control.read_blob(ENV_SPACES_BLOB)
+            if env_spaces is None:
+                time.sleep(0.1)
+
+        return env_spaces
+
+    def push_update(
+        self,
+        policy_params,
+        val_params,
+        strategy_frames,
+        strategy_history,
+        current_epoch,
+    ):
+        self.current_epoch = current_epoch
+        self._control.write_blob(
+            UPDATE_BLOB,
+            (
+                current_epoch,
+                np.asarray(policy_params, dtype=np.float32),
+                np.asarray(val_params, dtype=np.float32),
+                strategy_frames,
+                strategy_history,
+            ),
+        )
+        self._control.values[EPOCH] = current_epoch
+
+    def set_reward_stats(self, mean, std):
+        self._control.set_reward_stats(mean, std)
+
+    def get_cumulative_timesteps(self):
+        return self._control.get_cumulative_timesteps()
+
+    def get_policy_rewards(self):
+        records = self._get_consumer(REWARDS_CHANNEL).drain()
+        return [reward for record in records for reward in _decode(record)]
+
+    def _pop_experience(self, block_timeout):
+        consumer = self._get_consumer(EXPERIENCE_CHANNEL)
+        records = consumer.drain()
+        if block_timeout is not None:
+            deadline = time.perf_counter() + block_timeout
+            while len(records) == 0 and time.perf_counter() < deadline:
+                time.sleep(BLOCKING_POLL_INTERVAL)
+                records = consumer.drain()
+
+        return records
+
+    def _get_published_epoch(self):
+        epoch = int(self._control.values[EPOCH])
+        if epoch < 0:
+            return None
+        return epoch
+
+    def _add_ingested_timesteps(self, timesteps):
+        # Only the process draining the experience channel writes this.
+        self._control.values[INGESTED_TIMESTEPS] += timesteps
+
+    def _get_ingested_timesteps(self):
+        return int(self._control.values[INGESTED_TIMESTEPS])
+
+    def _decode_experience(self, message):
+        return _decode(message)
+
+    def _get_experience_decoder(self):
+        return _decode
+
+    def _get_consumer(self, channel):
+        consumer = self._consumers.get(channel, None)
+        if consumer is None:
+            consumer = _Consumer(self._control, channel)
+            self._consumers[channel] = consumer
+        return consumer
+
+    def disconnect(self):
+        self._close_decode_pool()
+        for consumer in self._consumers.values():
+            consumer.close()
+        self._consumers = {}
+
+        if self._control is not None:
+            if self._control.owner:
+                print("\nATTEMPTING TO SET SHARED MEMORY TO STOPPING STATUS")
+                self._control.set_status(ServerTransport.STOPPING_STATUS)
+            self._control.close()
+            self._control = None
+
+        self.internal_buffer.clear()
+        self.available_timesteps = 0
+        self.available_bytes = 0
+
+
+class SharedMemoryClient(ClientTransport):
+    def __init__(self):
+        super().__init__()
+        self._control = None
+        self._producer = None
+        self._consumers = {}
+        self._ring_size = DEFAULT_RING_SIZE
+        self._update_listener = None
+        self._stop_listener = None
+        self._fetch_lock = threading.Lock()
+
+    def connect(self):
+        # The server may not be up yet, check_server_status keeps trying to
+        # attach until it is.
+        self._get_control()
+
+    def configure(self, cfg):
+        networking_cfg = cfg.get("networking", {})
+        self._ring_size = networking_cfg.get("shm_ring_size", DEFAULT_RING_SIZE)
+
+    def check_server_status(self):
+        control = self._get_control()
+        if control is None:
+            return None
+        return control.get_status()
+
+    def transmit_env_spaces(self, input_shape, output_shape):
+        self._control.write_blob(ENV_SPACES_BLOB, (input_shape, output_shape))
+
+    def push_experience(self, data, num_timesteps):
+        self._get_producer().push(EXPERIENCE_CHANNEL, data)
+
+    def increment_timesteps(self, timesteps):
+        self._get_producer().add_timesteps(timesteps)
+
+    def get_ingest_backlog(self):
+        control = self._control
+        return max(
+            0,
+            control.get_cumulative_timesteps()
+            - int(control.values[INGESTED_TIMESTEPS]),
+        )
+
+    def flush(self, experience=None, num_timesteps=0, rewards=None):
+        with self._fetch_lock:
+            status = self._control.get_status()
+            if experience is not None and status == ServerTransport.RUNNING_STATUS:
+                producer = self._get_producer()
+                producer.push(EXPERIENCE_CHANNEL, experience)
+                producer.add_timesteps(num_timesteps)
+            if rewards:
+                self._get_producer().push(REWARDS_CHANNEL, rewards)
+
+            reward_stats = self._control.get_reward_stats()
+            return status, reward_stats, self._get_latest_value_params()
+
+    def push_data(self, key, data):
+        self._get_producer().push(_LIST_CHANNELS[key], data)
+
+    def set_data(self, key, data):
+        self._control.write_blob(_BLOB_SLOTS[key], data)
+
+    def get_data(self, key):
+        return self._control.read_blob(_BLOB_SLOTS[key])
+
+    def atomic_pop_all(self, key):
+        channel = _LIST_CHANNELS[key]
+        consumer = self._consumers.get(channel, None)
+        if consumer is None:
+            consumer = _Consumer(self._control, channel)
+            self._consumers[channel] = consumer
+
+        return [_decode(record) for record in consumer.drain()]
+
+    def get_reward_stats(self):
+        return self._control.get_reward_stats()
+
+    def get_latest_update(self, epoch=None):
+        # The update blob always holds a complete snapshot of the latest epoch,
+        # so there is nothing to pick between.
+        with self._fetch_lock:
+            update = self._get_update(self.current_epoch)
+            if update is None:
+                return None, None, None, False
+
+            epoch, policy, _, frames, history = update
+            self.current_epoch = epoch
+            return policy, frames, history, True
+
+    def get_latest_value_params(self):
+        with self._fetch_lock:
+            return self._get_latest_value_params()
+
+    def _get_latest_value_params(self):
+        update = self._get_update(self.current_value_epoch)
+        if update is None:
+            return None
+
+        self.current_value_epoch = update[0]
+        return update[2]
+
+    def _get_update(self, current_epoch):
+        epoch = int(self._control.values[EPOCH])
+        if epoch < 0 or epoch == current_epoch:
+            return None
+
+        update = self._control.read_blob(UPDATE_BLOB)
+        if update is None or update[0] == current_epoch:
+            return None
+        return update
+
+    def start_update_listener(self, callback):
+        self.stop_update_listener()
+
+        control = self._control
+        stop = threading.Event()
+
+        def poll():
+            last_epoch = int(control.values[EPOCH])
+            while not stop.wait(UPDATE_POLL_INTERVAL):
+                epoch = int(control.values[EPOCH])
+                if epoch == last_epoch:
+                    continue
+
+                last_epoch = epoch
+                try:
+                    callback(epoch)
+                except Exception as e:
+                    print(f"WARNING: failed to handle epoch notification: {e}")
+
+        self._stop_listener = stop
+        self._update_listener = threading.Thread(target=poll, daemon=True)
+        self._update_listener.start()
+
+    def stop_update_listener(self):
+        if self._update_listener is not None:
+            self._stop_listener.set()
+            self._update_listener.join()
+            self._update_listener = None
+            self._stop_listener = None
+
+    def is_listening_for_updates(self):
+        return self._update_listener is not None and self._update_listener.is_alive()
+
+    def _get_cfg_json(self):
+        return self._control.read_blob(CONFIG_BLOB)
+
+    def _get_control(self):
+        # A stopped server unlinks its control block, so look for the next
+        # server's instead of reading the old one.
+        control = self._control
+        if (
+            control is not None
+            and control.get_status() != ServerTransport.STOPPING_STATUS
+        ):
+            return control
+
+        try:
+            control = _ControlBlock(get_prefix())
+        except FileNotFoundError:
+            return self._control
+
+        self._close_control()
+        self._control = control
+        return control
+
+    def _get_producer(self):
+        if self._producer is None:
+            self._producer = _Producer(self._control, self._ring_size)
+        return self._producer
+
+    def _close_control(self):
+        if self._producer is not None:
+            self._producer.close()
+            self._producer = None
+
+        for consumer in self._consumers.values():
+            consumer.close()
+        self._consumers = {}
+
+        if self._control is not None:
+            self._control.close()
+            self._control = None
+
+    def disconnect(self):
+        self.stop_update_listener()
+        self._close_control()
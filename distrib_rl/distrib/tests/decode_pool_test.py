@@ -0,0 +1,107 @@
+from distrib_rl.distrib.decode_pool import ExperienceDecodePool, SLOTS_PER_WORKER
+from distrib_rl.distrib.message_serialization import MessageSerializer
+from distrib_rl.experience import TrajectoryBatch
+from distrib_rl.experience.tests.trajectory_batch_test import build_trajectory
+import numpy as np
+import time
+import os
+
+NUM_WORKERS = 2
+NUM_MESSAGES = 50
+NUM_TIMED_MESSAGES = 200
+TIMED_CODEC = "SHUFFLE_ZSTD"
+OBS_SIZE = 107
+
+
+def _decode_all(pool, messages):
+    pool.submit(messages)
+    received = []
+    while len(received) < len(messages):
+        received += pool.collect(timeout=1)
+    return received
+
+
+def time_decode():
+    """
+    Time the pool against decoding inline on the process that drains the
+    queues. Both sides decode the same large, compressed messages. What the pool
+    has to win is the CPU time of the draining process, which is what limits
+    how fast experience can be taken in. Wall clock time is only compared when
+    the workers have cores of their own.
+    """
+
+    serializer = MessageSerializer(TIMED_CODEC)
+    batch = TrajectoryBatch.from_trajectories(
+        [build_trajectory(500, 0) for _ in range(4)]
+    )
+    # Observations the size of a real environment's, noisy enough not to
+    # compress away but rounded like most env observations are.
+    obs = np.random.normal(size=(len(batch.obs), OBS_SIZE))
+    batch.obs = np.round(obs, 2).astype(np.float32)
+    message = serializer.pack(batch.serialize())
+    messages = [message] * NUM_TIMED_MESSAGES
+
+    start, start_cpu = time.perf_counter(), time.process_time()
+    for message in messages:
+        TrajectoryBatch.deserialize(serializer.unpack(message))
+    inline_time = time.perf_counter() - start
+    inline_cpu = time.process_time() - start_cpu
+
+    pool = ExperienceDecodePool(NUM_WORKERS, serializer.unpack)
+    try:
+        # Start the workers and size every result slot before timing, neither
+        # is part of the decode cost.
+        _decode_all(pool, messages[: NUM_WORKERS * SLOTS_PER_WORKER])
+        start, start_cpu = time.perf_counter(), time.process_time()
+        _decode_all(pool, messages)
+        pool_time = time.perf_counter() - start
+        pool_cpu = time.process_time() - start_cpu
+    finally:
+        pool.close()
+
+    print(
+        f"Decoded {NUM_TIMED_MESSAGES} {len(message)} byte messages,"
+        f" inline: {inline_time:.3f}s ({inline_cpu:.3f}s cpu),"
+        f" pool of {NUM_WORKERS}: {pool_time:.3f}s ({pool_cpu:.3f}s cpu)"
+    )
+
+    assert pool_cpu <= inline_cpu, "Decode pool costs more than inline decode"
+    if (os.cpu_count() or 1) > NUM_WORKERS:
+        assert pool_time <= inline_time, "Decode pool is slower than inline decode"
+
+
+def run_test():
+    serializer = MessageSerializer()
+    pool = ExperienceDecodePool(NUM_WORKERS, serializer.unpack)
+
+    sent = []
+    messages = []
+    for i in range(NUM_MESSAGES):
+        batch = TrajectoryBatch.from_trajectories(
+            [build_trajectory(np.random.randint(1, 100), 0) for _ in range(3)]
+        )
+        batch.policy_epochs[:] = i
+        sent.append(batch)
+        messages.append(serializer.pack(batch.serialize()))
+
+    try:
+        received = _decode_all(pool, messages)
+    finally:
+        pool.close()
+
+    # Batches must come back in the order they were submitted, whichever worker
+    # finished first.
+    for expected, batch in zip(sent, received):
+        assert np.array_equal(expected.policy_epochs, batch.policy_epochs)
+        for name in (
+            TrajectoryBatch.TIMESTEP_COLUMNS + TrajectoryBatch.TRAJECTORY_COLUMNS
+        ):
+            assert np.array_equal(getattr(expected, name), getattr(batch, name))
+
+    print(f"Decoded {NUM_MESSAGES} messages with {NUM_WORKERS} workers")
+
+    time_decode()
+
+
+if __name__ == "__main__":
+    run_test()
@@ -0,0 +1,58 @@
+from distrib_rl.distrib.experience_queues import StreamExperienceQueue
+from redis import Redis
+import os
+
+STREAM_KEY = "experience_queues_test_stream"
+NUM_MESSAGES = 6
+
+
+def build_queue(redis, consumer_name):
+    queue = StreamExperienceQueue(
+        redis, key=STREAM_KEY, read_count=NUM_MESSAGES, claim_idle_seconds=0
+    )
+    queue.consumer_name = consumer_name
+    return queue
+
+
+def run_test():
+    redis = Redis(
+        host=os.environ.get("REDIS_HOST", default="localhost"),
+        port=os.environ.get("REDIS_PORT", default=6379),
+        password=os.environ.get("REDIS_PASSWORD", default=None),
+    )
+    redis.delete(STREAM_KEY)
+    try:
+        crashed = build_queue(redis, "crashed")
+        survivor = build_queue(redis, "survivor")
+        crashed.create_group()
+        for i in range(NUM_MESSAGES):
+            crashed.push(str(i).encode("utf-8"), 1, NUM_MESSAGES)
+
+        # The first consumer reads everything but only gets to acknowledge
+        # half of it.
+        messages = crashed.pop()
+        assert messages == [str(i).encode("utf-8") for i in range(NUM_MESSAGES)]
+        crashed.ack(NUM_MESSAGES // 2)
+        assert redis.xlen(STREAM_KEY) == NUM_MESSAGES - NUM_MESSAGES // 2
+
+        # A message trimmed off the stream while pending can't be recovered.
+        redis.xdel(STREAM_KEY, crashed._unacked[0])
+
+        # The rest is claimed by the next consumer that pops.
+        messages = survivor.pop()
+        expected = range(NUM_MESSAGES // 2 + 1, NUM_MESSAGES)
+        assert messages == [str(i).encode("utf-8") for i in expected]
+        survivor.ack(len(messages))
+        assert redis.xlen(STREAM_KEY) == 0
+        assert (
+            redis.xpending(STREAM_KEY, StreamExperienceQueue.GROUP_NAME)["pending"] == 0
+        )
+    finally:
+        redis.delete(STREAM_KEY)
+        redis.close()
+
+    print("Stream queue recovered the messages of a crashed consumer")
+
+
+if __name__ == "__main__":
+    run_test()
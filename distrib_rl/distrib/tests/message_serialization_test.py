@@ -0,0 +1,78 @@
+from distrib_rl.distrib.message_serialization import (
+    MessageSerializer,
+    shuffle_arrays,
+    zstandard,
+)
+from distrib_rl.experience import TrajectoryBatch
+from distrib_rl.experience.tests.trajectory_batch_test import build_trajectory
+import numpy as np
+
+
+def run_test():
+    rng = np.random.RandomState(0)
+    message = [
+        "obs",
+        rng.randn(4096).astype(np.float32).tobytes(),
+        list(range(100)),
+    ]
+
+    compression_types = ["NONE", "LZ4", "SHUFFLE_LZ4"]
+    if zstandard is not None:
+        compression_types += ["ZSTD", "SHUFFLE_ZSTD", "ZSTD_DICT"]
+        dictionary = zstandard.train_dictionary(
+            4096, [rng.bytes(64) + message[1][:512] for _ in range(64)]
+        ).as_bytes()
+    else:
+        dictionary = None
+
+    for compression_type in compression_types:
+        serializer = MessageSerializer(
+            compression_type=compression_type,
+            compression_level=5,
+            dictionary=dictionary,
+        )
+        packed = serializer.pack(message)
+        assert serializer.unpack(packed) == message
+        print("{}: {} bytes".format(compression_type, len(packed)))
+
+    # Any serializer can read messages packed with a different compression
+    # type.
+    packed = MessageSerializer(compression_type="SHUFFLE_LZ4").pack(message)
+    assert MessageSerializer().unpack(packed) == message
+
+    # Arrays are shuffled by their own item size, whatever surrounds them.
+    arrays = [
+        rng.randn(3, 1000).astype(np.float32),
+        rng.randn(1001).astype(np.float16),
+        memoryview(rng.randint(0, 2**16, 777).astype(np.uint16)),
+        np.arange(5, dtype=np.int8),
+    ]
+    shuffled = shuffle_arrays(("header", arrays))
+    assert shuffled[1][3] is arrays[3]
+    assert isinstance(shuffled[1][0], dict)
+    for compression_type in ("SHUFFLE_LZ4", "SHUFFLE_ZSTD"):
+        if compression_type == "SHUFFLE_ZSTD" and zstandard is None:
+            continue
+
+        serializer = MessageSerializer(compression_type=compression_type)
+        _, unpacked = serializer.unpack(serializer.pack(("header", arrays)))
+        for original, arr in zip(arrays, unpacked):
+            original = np.asarray(original)
+            assert arr.dtype == original.dtype and arr.shape == original.shape
+            assert np.array_equal(arr, original)
+
+    batch = TrajectoryBatch.from_trajectories(
+        [build_trajectory(50, 0), build_trajectory(20, 1)],
+        dtypes={"obs": "bfloat16", "values": "float16"},
+    )
+    serializer = MessageSerializer(compression_type="SHUFFLE_LZ4")
+    decoded = TrajectoryBatch.deserialize(
+        serializer.unpack(serializer.pack(batch.serialize()))
+    )
+    assert np.array_equal(decoded.obs, batch.obs)
+    assert np.array_equal(decoded.values, batch.values)
+    assert np.array_equal(decoded.advantages, batch.advantages)
+
+
+if __name__ == "__main__":
+    run_test()
@@ -0,0 +1,49 @@
+from distrib_rl.distrib.parameter_deltas import (
+    ParameterDeltaEncoder,
+    ParameterDeltaDecoder,
+)
+import numpy as np
+
+NUM_PARAMS = 1000
+NUM_EPOCHS = 25
+KEYFRAME_INTERVAL = 5
+
+
+def run_test():
+    rng = np.random.RandomState(0)
+    encoder = ParameterDeltaEncoder(KEYFRAME_INTERVAL)
+    up_to_date = ParameterDeltaDecoder(KEYFRAME_INTERVAL)
+    lagging = ParameterDeltaDecoder(KEYFRAME_INTERVAL)
+    versions = {}
+
+    params = rng.randn(NUM_PARAMS).astype(np.float32)
+    for epoch in range(NUM_EPOCHS):
+        params = params + rng.randn(NUM_PARAMS).astype(np.float32) * 1e-3
+
+        payload, expired_epochs = encoder.encode(params, epoch)
+        versions[epoch] = payload
+        for expired in expired_epochs:
+            del versions[expired]
+
+        epochs = up_to_date.get_required_epochs(epoch)
+        assert up_to_date.apply([versions.get(e) for e in epochs], epoch)
+
+        if epoch % KEYFRAME_INTERVAL == 0:
+            assert np.array_equal(up_to_date.params, params)
+        else:
+            assert np.allclose(up_to_date.params, params, atol=1e-3)
+
+        # The lagging client only checks in every 7 epochs, so it regularly
+        # needs to rebuild from a keyframe.
+        if epoch % 7 == 0:
+            epochs = lagging.get_required_epochs(epoch)
+            assert lagging.apply([versions.get(e) for e in epochs], epoch)
+            assert np.array_equal(lagging.params, up_to_date.params)
+
+    print(
+        "Decoded {} epochs, {} versions still stored".format(NUM_EPOCHS, len(versions))
+    )
+
+
+if __name__ == "__main__":
+    run_test()
@@ -0,0 +1,79 @@
+from distrib_rl.distrib.shared_memory_transport import (
+    _ControlBlock,
+    _Producer,
+    _Consumer,
+    _decode,
+    EXPERIENCE_CHANNEL,
+    REWARDS_CHANNEL,
+    CLEAR_COUNT,
+)
+from multiprocessing import shared_memory
+import numpy as np
+
+RING_SIZE = 64 * 1024
+NUM_MESSAGES = 2000
+
+
+def run_test():
+    rng = np.random.RandomState(0)
+    control = _ControlBlock("drl_test_", create=True)
+    producer = _Producer(control, RING_SIZE)
+    consumer = _Consumer(control, EXPERIENCE_CHANNEL)
+
+    sent = []
+    received = []
+    try:
+        # Messages of random sizes with reads at random intervals, so the ring
+        # wraps many times at different offsets.
+        for i in range(NUM_MESSAGES):
+            data = rng.randn(rng.randint(1, 2000)).astype(np.float32)
+            if producer.push(EXPERIENCE_CHANNEL, (i, memoryview(data).cast("B"))):
+                sent.append(data)
+
+            if rng.randint(0, 3) == 0:
+                received += [_decode(record) for record in consumer.drain()]
+        received += [_decode(record) for record in consumer.drain()]
+
+        assert len(received) == len(sent)
+        for data, (_, buffer) in zip(sent, received):
+            assert np.array_equal(data, np.frombuffer(buffer, dtype=np.float32))
+
+        # Anything pushed before a clear is dropped.
+        producer.push(EXPERIENCE_CHANNEL, "stale")
+        control.values[CLEAR_COUNT] += 1
+        producer.push(EXPERIENCE_CHANNEL, "fresh")
+        assert [_decode(record) for record in consumer.drain()] == ["fresh"]
+
+        # A producer that closes before anyone attached to it keeps its records
+        # until every ring is drained.
+        late = _Producer(control, RING_SIZE)
+        late.push(EXPERIENCE_CHANNEL, "late experience")
+        late.push(REWARDS_CHANNEL, "late rewards")
+        late.close()
+        name = control.producer_name(late.slot)
+        assert [_decode(record) for record in consumer.drain()] == ["late experience"]
+        shared_memory.SharedMemory(name=name).close()
+
+        rewards_consumer = _Consumer(control, REWARDS_CHANNEL)
+        assert [_decode(r) for r in rewards_consumer.drain()] == ["late rewards"]
+        rewards_consumer.close()
+        try:
+            shared_memory.SharedMemory(name=name)
+            assert False, "the closed producer's segment should have been removed"
+        except FileNotFoundError:
+            pass
+        assert consumer.drain() == []
+
+        print(
+            "Sent {} of {} messages through a {} byte ring".format(
+                len(sent), NUM_MESSAGES, RING_SIZE
+            )
+        )
+    finally:
+        consumer.close()
+        producer.close()
+        control.close()
+
+
+if __name__ == "__main__":
+    run_test()
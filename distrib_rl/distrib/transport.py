@@ -0,0 +1,544 @@
+"""
+    File name: transport.py
+
+    Description:
+        Interfaces between the learner and its clients. A ServerTransport is
+        used by the server and its data shuffling process, a ClientTransport by
+        every client process. The Redis implementations are the default, the
+        shared memory implementations let processes on a single host talk to
+        each other without a Redis daemon. Which one gets used is decided by
+        transport_factory.
+"""
+
+from distrib_rl.experience import TrajectoryBatch
+from distrib_rl.distrib.decode_pool import ExperienceDecodePool
+from collections import deque
+import pyjson5 as json
+import numpy as np
+import time
+
+# How long the experience queues have to stay empty before we assume that
+# anything clients pushed and we never received was lost on the way.
+BACKLOG_RESYNC_DELAY = 1.0
+
+# Policy lag is histogrammed per epoch of lag, anything at least this many
+# epochs old shares the last bin.
+POLICY_LAG_BINS = 16
+
+
+class ServerTransport(object):
+    INITIALIZING_STATUS = "REDIS_SERVER_INITIALIZING_STATUS"
+    RUNNING_STATUS = "REDIS_SERVER_RUNNING_STATUS"
+    STOPPING_STATUS = "REDIS_SERVER_STOPPING_STATUS"
+    RESET_STATUS = "REDIS_SERVER_RESET_STATUS"
+    RECONFIGURE_STATUS = "REDIS_SERVER_RECONFIGURE_STATUS"
+    AWAITING_ENV_SPACES_STATUS = "REDIS_SERVER_AWAITING_ENV_SPACES_STATUS"
+
+    def __init__(self, max_queue_size):
+        self.max_queue_size = max_queue_size
+        self.max_queue_bytes = None
+        self.internal_buffer = deque()
+        self.available_timesteps = 0
+        self.available_bytes = 0
+
+        self.last_sps_measure = time.time()
+        self.accumulated_sps = 0
+        self.steps_per_second = 0
+        self._block_timeout = None
+        self._decode_pool = None
+        self.current_epoch = 0
+
+        self.wait_time = 0
+        self.decode_time = 0
+        self.dropped_timesteps = 0
+        self._ingested_timesteps = 0
+        self._starved_since = None
+        self.stale_timesteps = 0
+        self.policy_lag_counts = np.zeros(POLICY_LAG_BINS, dtype=np.int64)
+        self.max_policy_age = float("inf")
+
+    def connect(self, clear_existing=False, new_server_instance=True):
+        raise NotImplementedError
+
+    def configure(self, cfg):
+        max_policy_age = cfg.get("experience_replay", {}).get("max_policy_age", None)
+        self.max_policy_age = float("inf") if max_policy_age is None else max_policy_age
+
+        networking_cfg = cfg.get("networking", {})
+        self.max_queue_bytes = networking_cfg.get("max_ingest_bytes", None)
+        if networking_cfg.get("blocking_reads", False):
+            self._block_timeout = networking_cfg.get("block_timeout", 1.0)
+        else:
+            self._block_timeout = None
+
+        self._configure_decode_pool(networking_cfg.get("decode_workers", 0))
+
+    def _configure_decode_pool(self, num_workers):
+        # The workers hold a copy of our decoder, so they have to be replaced
+        # whenever we are reconfigured.
+        self._close_decode_pool()
+        if num_workers > 0:
+            self._decode_pool = ExperienceDecodePool(
+                num_workers, self._get_experience_decoder()
+            )
+
+    def _close_decode_pool(self):
+        if self._decode_pool is not None:
+            self._decode_pool.close()
+            self._decode_pool = None
+
+    def push_cfg(self, cfg):
+        raise NotImplementedError
+
+    def signal_ready(self):
+        raise NotImplementedError
+
+    def set_status(self, status):
+        raise NotImplementedError
+
+    def get_env_spaces(self):
+        raise NotImplementedError
+
+    def push_update(
+        self,
+        policy_params,
+        val_params,
+        strategy_frames,
+        strategy_history,
+        current_epoch,
+    ):
+        raise NotImplementedError
+
+    def set_reward_stats(self, mean, std):
+        raise NotImplementedError
+
+    def get_cumulative_timesteps(self):
+        raise NotImplementedError
+
+    def get_policy_rewards(self):
+        raise NotImplementedError
+
+    def disconnect(self):
+        raise NotImplementedError
+
+    def get_n_timesteps(self, n):
+        self._refresh_current_epoch()
+        self._update_buffer()
+        n_collected = 0
+        returns = []
+
+        while n_collected < n:
+            while self.available_timesteps < n - n_collected:
+                if self._block_timeout is not None:
+                    self._update_buffer(block_timeout=self._block_timeout)
+                else:
+                    self._update_buffer()
+                    t1 = time.perf_counter()
+                    time.sleep(0.01)
+                    self.wait_time += time.perf_counter() - t1
+
+            batch = self._pop_batch()
+            if batch.num_timesteps > 0:
+                returns.append(batch)
+                n_collected += batch.num_timesteps
+
+        self._report_ingested()
+        return returns
+
+    def get_up_to_n_timesteps(self, n):
+        self._refresh_current_epoch()
+        self._update_buffer()
+        if len(self.internal_buffer) == 0:
+            return []
+
+        n_collected = 0
+        returns = []
+
+        while len(self.internal_buffer) > 0 and n_collected < n:
+            batch = self._pop_batch()
+            if batch.num_timesteps > 0:
+                returns.append(batch)
+                n_collected += batch.num_timesteps
+
+        self._report_ingested()
+        return returns
+
+    def get_timing_stats(self):
+        """
+        Get the time spent waiting for experience to arrive and the time spent
+        decoding it since the last call.
+        :return: Tuple of (wait time, decode time) in seconds.
+        """
+
+        stats = self.wait_time, self.decode_time
+        self.wait_time = 0
+        self.decode_time = 0
+        return stats
+
+    def get_dropped_timesteps(self):
+        """
+        Get the number of timesteps that clients produced and we threw away
+        since the last call, either because our buffer was full or because they
+        were lost before they reached us.
+        """
+
+        dropped = self.dropped_timesteps
+        self.dropped_timesteps = 0
+        return dropped
+
+    def _pop_experience(self, block_timeout):
+        """
+        Take every experience message that has arrived since the last call.
+        :param block_timeout: If not None, wait up to this many seconds for at
+                              least one message to arrive. If None, any pops
+                              still in flight from an earlier blocking call are
+                              waited for and included.
+        :return: List of raw messages.
+        """
+
+        raise NotImplementedError
+
+    def _acknowledge_experience(self, num_messages):
+        """
+        Let the queues know that the oldest messages returned by _pop_experience
+        have been decoded, so they don't need to be kept for redelivery.
+        :param num_messages: Number of messages, in the order _pop_experience
+                             returned them.
+        """
+
+        pass
+
+    def _decode_experience(self, message):
+        """
+        Turn one raw message returned by _pop_experience into the data a client
+        passed to push_experience.
+        """
+
+        raise NotImplementedError
+
+    def _get_experience_decoder(self):
+        """
+        Get a picklable function that does what _decode_experience does, for
+        use in the decode workers.
+        """
+
+        raise NotImplementedError
+
+    def get_policy_lag_stats(self):
+        """
+        Get the policy lag of every timestep we handed out or rejected since
+        the last call.
+        :return: Tuple of (timesteps per epoch of lag, number of timesteps
+                 rejected for being older than max_policy_age). The last bin of
+                 the histogram counts every lag of at least POLICY_LAG_BINS -
+                 1.
+        """
+
+        stats = self.policy_lag_counts, self.stale_timesteps
+        self.policy_lag_counts = np.zeros(POLICY_LAG_BINS, dtype=np.int64)
+        self.stale_timesteps = 0
+        return stats
+
+    def _get_published_epoch(self):
+        """
+        Get the epoch of the latest update published to clients, or None if
+        there isn't one yet.
+        """
+
+        raise NotImplementedError
+
+    def _refresh_current_epoch(self):
+        # The process draining experience isn't the one publishing updates, so
+        # it has to look the epoch up.
+        epoch = self._get_published_epoch()
+        if epoch is not None:
+            self.current_epoch = epoch
+
+    def _add_ingested_timesteps(self, timesteps):
+        """
+        Add to the shared count of timesteps that left the ingest backlog, i.e.
+        were consumed or dropped by us. Clients compare it against the
+        cumulative timestep count to find out how far behind we are.
+        """
+
+        raise NotImplementedError
+
+    def _get_ingested_timesteps(self):
+        raise NotImplementedError
+
+    def _report_ingested(self):
+        if self._ingested_timesteps > 0:
+            self._add_ingested_timesteps(self._ingested_timesteps)
+            self._ingested_timesteps = 0
+
+    def _resync_backlog(self):
+        """
+        Count whatever clients pushed that never reached us as dropped.
+        Messages are lost when a full queue is trimmed or when the queues are
+        cleared, and nobody counts them at that point.
+        """
+
+        if not self._can_resync_backlog():
+            return
+
+        # Every timestep in this count was pushed before the pop below started.
+        # It is therefore in our buffer, already ingested, or gone. Pops and
+        # decodes still in flight are waited for first, so none of it is
+        # mistaken for lost. Anything pushed after the count only makes us
+        # underestimate what was lost, and the next resync picks that up.
+        cumulative = self.get_cumulative_timesteps()
+        self._ingest(self._pop_experience(None), drain=True)
+        self._report_ingested()
+
+        lost = cumulative - self._get_ingested_timesteps() - self.available_timesteps
+        if lost > 0:
+            self.dropped_timesteps += lost
+            self._add_ingested_timesteps(lost)
+
+    def _can_resync_backlog(self):
+        """
+        Whether every message that leaves our queues ends up with us. If other
+        processes consume from the same queues, data in their buffers would
+        look lost.
+        """
+
+        return True
+
+    def _pop_batch(self):
+        batch = self.internal_buffer.pop()
+        self.available_timesteps -= batch.num_timesteps
+        self.available_bytes -= batch.nbytes
+        self._ingested_timesteps += batch.num_timesteps
+
+        lags = np.maximum(self.current_epoch - batch.policy_epochs, 0)
+        lengths = batch.trajectory_lengths
+        self.policy_lag_counts += np.bincount(
+            np.minimum(lags, POLICY_LAG_BINS - 1),
+            weights=lengths,
+            minlength=POLICY_LAG_BINS,
+        ).astype(np.int64)
+
+        fresh = lags <= self.max_policy_age
+        if not fresh.all():
+            self.stale_timesteps += int(lengths[~fresh].sum())
+            batch = batch.select(fresh)
+
+        return batch
+
+    def _update_buffer(self, block_timeout=None):
+        pool = self._decode_pool
+        decoding = pool is not None and pool.num_pending > 0
+
+        # While earlier messages are still being decoded we wait on those
+        # rather than on the queue.
+        t1 = time.perf_counter()
+        messages = self._pop_experience(None if decoding else block_timeout)
+        t2 = time.perf_counter()
+        if block_timeout is not None:
+            self.wait_time += t2 - t1
+
+        self._ingest(messages, block_timeout=block_timeout if decoding else None)
+
+        if len(messages) > 0 or (pool is not None and pool.num_pending > 0):
+            self._starved_since = None
+        elif self._starved_since is None:
+            self._starved_since = t2
+        elif t2 - self._starved_since >= BACKLOG_RESYNC_DELAY:
+            self._starved_since = None
+            self._resync_backlog()
+
+    def _ingest(self, messages, block_timeout=None, drain=False):
+        """
+        Decode messages and add them to our buffer.
+        :param messages: Raw messages returned by _pop_experience.
+        :param block_timeout: If not None, wait up to this many seconds for the
+                              decode pool.
+        :param drain: Wait until the decode pool has finished everything
+                      submitted to it.
+        """
+
+        t1 = time.perf_counter()
+        pool = self._decode_pool
+        if pool is None:
+            batches = [
+                TrajectoryBatch.deserialize(self._decode_experience(message))
+                for message in messages
+            ]
+        else:
+            pool.submit(messages)
+            batches = pool.collect(block_timeout)
+            while drain and pool.num_pending > 0:
+                batches += pool.collect(BACKLOG_RESYNC_DELAY)
+        self._acknowledge_experience(len(batches))
+
+        collected_timesteps = 0
+        for batch in batches:
+            collected_timesteps += batch.num_timesteps
+            self.available_bytes += batch.nbytes
+            self.internal_buffer.append(batch)
+
+        self.available_timesteps += collected_timesteps
+        self.decode_time += time.perf_counter() - t1
+
+        self._update_sps(collected_timesteps)
+        self._trim_buffer()
+        self._report_ingested()
+
+    def _trim_buffer(self):
+        # The buffer holds whole client batches rather than single
+        # trajectories, so we budget it in timesteps and optionally in bytes,
+        # evicting the oldest batches first. The newest batch is always kept.
+        buffer = self.internal_buffer
+        while len(buffer) > 1 and (
+            self.available_timesteps - buffer[0].num_timesteps >= self.max_queue_size
+            or (
+                self.max_queue_bytes is not None
+                and self.available_bytes > self.max_queue_bytes
+            )
+        ):
+            batch = buffer.popleft()
+            self.available_timesteps -= batch.num_timesteps
+            self.available_bytes -= batch.nbytes
+            self.dropped_timesteps += batch.num_timesteps
+            self._ingested_timesteps += batch.num_timesteps
+
+    def _update_sps(self, collected_timesteps):
+        self.accumulated_sps += collected_timesteps
+        elapsed = time.time() - self.last_sps_measure
+
+        if elapsed >= 1:
+            self.steps_per_second = self.accumulated_sps / elapsed
+            self.accumulated_sps = 0
+            self.last_sps_measure = time.time()
+
+
+class ClientTransport(object):
+    def __init__(self):
+        self.current_epoch = -1
+        self.current_value_epoch = -1
+        self.max_queue_size = 0
+
+    def connect(self):
+        raise NotImplementedError
+
+    def configure(self, cfg):
+        raise NotImplementedError
+
+    def check_server_status(self):
+        raise NotImplementedError
+
+    def transmit_env_spaces(self, input_shape, output_shape):
+        raise NotImplementedError
+
+    def push_experience(self, data, num_timesteps):
+        raise NotImplementedError
+
+    def increment_timesteps(self, timesteps):
+        raise NotImplementedError
+
+    def get_ingest_backlog(self):
+        """
+        Get the number of timesteps clients have pushed that the server hasn't
+        consumed or dropped yet.
+        """
+
+        raise NotImplementedError
+
+    def flush(self, experience=None, num_timesteps=0, rewards=None):
+        """
+        Push everything a client produces in one collection window and fetch
+        everything it needs for the next one. Experience is dropped instead of
+        pushed if the server isn't running at the time of the flush.
+        :param experience: Serialized experience to push, or None.
+        :param num_timesteps: Number of timesteps in experience.
+        :param rewards: Episode rewards to push, or None.
+        :return: Tuple of (server status, (reward mean, reward std), value
+                 params or None if there is no new version).
+        """
+
+        raise NotImplementedError
+
+    def push_data(self, key, data):
+        raise NotImplementedError
+
+    def set_data(self, key, data):
+        raise NotImplementedError
+
+    def get_data(self, key):
+        raise NotImplementedError
+
+    def atomic_pop_all(self, key):
+        raise NotImplementedError
+
+    def get_reward_stats(self):
+        raise NotImplementedError
+
+    def get_latest_update(self, epoch=None):
+        """
+        Fetch the newest policy update we don't have yet.
+        :param epoch: Epoch to fetch, e.g. from an update notification. If
+                      None, the epoch the server currently points clients at is
+                      fetched.
+        :return: Tuple of (policy params, strategy frames, strategy history,
+                 success).
+        """
+
+        raise NotImplementedError
+
+    def get_latest_value_params(self):
+        raise NotImplementedError
+
+    def start_update_listener(self, callback):
+        """
+        Get notified of new epochs as soon as the server publishes them.
+        :param callback: Function called with the new epoch number. It runs on
+                         a background thread, so anything it touches must be
+                         safe to share with the caller's thread.
+        :return: None.
+        """
+
+        raise NotImplementedError
+
+    def stop_update_listener(self):
+        raise NotImplementedError
+
+    def is_listening_for_updates(self):
+        raise NotImplementedError
+
+    def disconnect(self):
+        raise NotImplementedError
+
+    def get_cfg(self):
+        import numpy as np
+        import random
+        import torch
+
+        print("Fetching new config...")
+        while True:
+            status = self.check_server_status()
+
+            print("Waiting for server to start...", status)
+
+            if (
+                status == ServerTransport.RUNNING_STATUS
+                or status == ServerTransport.AWAITING_ENV_SPACES_STATUS
+            ):
+                break
+
+            time.sleep(1)
+
+        cfg = dict(json.loads(self._get_cfg_json()))
+        self.max_queue_size = cfg["experience_replay"]["max_buffer_size"]
+        print("Fetched new config!")
+
+        cfg["rng"] = np.random.RandomState(cfg["seed"])
+        torch.manual_seed(cfg["seed"])
+        np.random.seed(cfg["seed"])
+        random.seed(cfg["seed"])
+
+        self.configure(cfg)
+
+        return cfg
+
+    def _get_cfg_json(self):
+        raise NotImplementedError
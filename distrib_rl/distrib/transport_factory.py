@@ -0,0 +1,62 @@
+"""
+    File name: transport_factory.py
+
+    Description:
+        Picks the transport used between the server and its clients. The choice
+        has to be made before a client has fetched its config, so it comes from
+        the DISTRIB_RL_TRANSPORT environment variable rather than the config,
+        and every process of a run must use the same one. Defaults to Redis.
+
+        The shared memory transport is only imported once it is picked, it
+        needs multiprocessing.shared_memory and its rings are only correct on
+        x86, see shared_memory_transport.
+"""
+
+from distrib_rl.distrib.redis_server import RedisServer
+from distrib_rl.distrib.redis_client import RedisClient
+import platform
+import os
+
+REDIS = "redis"
+SHARED_MEMORY = "shared_memory"
+
+# The shared memory rings have no memory fences and rely on x86's store and load
+# ordering.
+SHARED_MEMORY_MACHINES = ("x86_64", "amd64", "i386", "i686", "x86")
+
+
+def get_transport_type():
+    transport_type = os.environ.get("DISTRIB_RL_TRANSPORT", default=REDIS).lower()
+    if transport_type not in (REDIS, SHARED_MEMORY):
+        raise ValueError(
+            f"Unknown transport '{transport_type}'. Supported transports are"
+            f" {REDIS},{SHARED_MEMORY}"
+        )
+
+    if (
+        transport_type == SHARED_MEMORY
+        and platform.machine().lower() not in SHARED_MEMORY_MACHINES
+    ):
+        raise ValueError(
+            f"The {SHARED_MEMORY} transport is only supported on x86, this"
+            f" machine is '{platform.machine()}'. Use the {REDIS} transport."
+        )
+    return transport_type
+
+
+def get_server(max_queue_size):
+    if get_transport_type() == SHARED_MEMORY:
+        from distrib_rl.distrib.shared_memory_transport import SharedMemoryServer
+
+        return SharedMemoryServer(max_queue_size)
+
+    return RedisServer(max_queue_size)
+
+
+def get_client():
+    if get_transport_type() == SHARED_MEMORY:
+        from distrib_rl.distrib.shared_memory_transport import SharedMemoryClient
+
+        return SharedMemoryClient()
+
+    return RedisClient()
@@ -1 +1,2 @@
 from .custom import novelty, novelty_maze
+from .vector_env import VectorEnv
@@ -0,0 +1,149 @@
+"""
+    File name: vector_env.py
+
+    Description:
+        Several copies of an environment that are stepped together, so an agent
+        can pick the actions for all of them with one forward pass of its
+        policy. The copies either live in this process or each get a subprocess
+        worker. An env that finishes an episode is reset right away. Its last
+        observation is put in its info dict under final_observation, like gym's
+        vector envs do. The observation and action spaces are those of a single
+        env.
+"""
+
+import multiprocessing as mp
+import numpy as np
+
+FINAL_OBSERVATION_KEY = "final_observation"
+
+
+def _step(env, action):
+    obs, rew, terminated, truncated, info = env.step(action)
+    if terminated or truncated:
+        info = dict(info)
+        info[FINAL_OBSERVATION_KEY] = obs
+        obs = env.reset()
+    return obs, rew, terminated, truncated, info
+
+
+def _worker(conn, env_fn):
+    env = env_fn()
+    try:
+        while True:
+            command, data = conn.recv()
+            if command == "step":
+                conn.send(_step(env, data))
+            elif command == "reset":
+                conn.send(env.reset(**data))
+            elif command == "spaces":
+                conn.send((env.observation_space, env.action_space))
+            elif command == "close":
+                break
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        env.close()
+        conn.close()
+
+
+class VectorEnv(object):
+    def __init__(self, env_fns, asynchronous=False):
+        """
+        :param env_fns: List of functions that build one env each. They have to
+                        be picklable if asynchronous is set.
+        :param asynchronous: Step every env in its own subprocess instead of
+                             one after another in this process.
+        """
+
+        self.num_envs = len(env_fns)
+        self.asynchronous = asynchronous
+        self.envs = None
+        self._connections = None
+        self._workers = None
+
+        if asynchronous:
+            ctx = mp.get_context("spawn")
+            self._connections = []
+            self._workers = []
+            for env_fn in env_fns:
+                parent_conn, child_conn = ctx.Pipe()
+                worker = ctx.Process(
+                    target=_worker, args=(child_conn, env_fn), daemon=True
+                )
+                worker.start()
+                child_conn.close()
+                self._connections.append(parent_conn)
+                self._workers.append(worker)
+
+            self._connections[0].send(("spaces", None))
+            self.observation_space, self.action_space = self._connections[0].recv()
+        else:
+            self.envs = [env_fn() for env_fn in env_fns]
+            self.observation_space = self.envs[0].observation_space
+            self.action_space = self.envs[0].action_space
+
+    def reset(self, seed=None, options=None):
+        """
+        :param seed: Optional seed, env i is seeded with seed + i.
+        :return: Stacked observations of every env.
+        """
+
+        kwargs = [
+            {"seed": None if seed is None else seed + i, "options": options}
+            for i in range(self.num_envs)
+        ]
+        if self.asynchronous:
+            for conn, env_kwargs in zip(self._connections, kwargs):
+                conn.send(("reset", env_kwargs))
+            obs = [conn.recv() for conn in self._connections]
+        else:
+            obs = [
+                env.reset(**env_kwargs) for env, env_kwargs in zip(self.envs, kwargs)
+            ]
+
+        return np.stack(obs)
+
+    def step(self, actions):
+        """
+        :param actions: One action per env. If there are fewer actions than
+                        envs, only the first len(actions) envs are stepped and
+                        the others stay paused where they are.
+        :return: Tuple of (stacked observations, rewards, terminated flags,
+                 truncated flags, list of info dicts).
+        """
+
+        if self.asynchronous:
+            for conn, action in zip(self._connections, actions):
+                conn.send(("step", action))
+            results = [conn.recv() for conn in self._connections]
+        else:
+            results = [_step(env, action) for env, action in zip(self.envs, actions)]
+
+        obs, rews, terminated, truncated, infos = zip(*results)
+        return (
+            np.stack(obs),
+            np.asarray(rews, dtype=np.float32),
+            np.asarray(terminated, dtype=bool),
+            np.asarray(truncated, dtype=bool),
+            list(infos),
+        )
+
+    def close(self):
+        if self.asynchronous:
+            for conn in self._connections:
+                try:
+                    conn.send(("close", None))
+                except (BrokenPipeError, OSError):
+                    pass
+            for worker in self._workers:
+                worker.join(timeout=5)
+                if worker.is_alive():
+                    worker.terminate()
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+            self._workers = []
+        else:
+            for env in self.envs:
+                env.close()
+            self.envs = []
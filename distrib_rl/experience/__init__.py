@@ -1,6 +1,7 @@
 from .parallel_shuffler import ParallelShuffler
 from .timestep import Timestep
-from .trajectory import Trajectory
-from .experience_replay import ExperienceReplay
+from .trajectory import Trajectory, finalize_trajectories
+from .trajectory_batch import TrajectoryBatch
+from .experience_replay import ExperienceReplay, shuffled_minibatches
 from .distrib_experience_manager import DistribExperienceManager
 from .parallel_experience_manager import ParallelExperienceManager
@@ -13,66 +13,13 @@ class DistribExperienceManager(object):
             return None
 
         exp = self.experience
-
         n_collected = 0
-        acts = []
-        probs = []
-        rews = []
-        obses = []
-        done = []
-        frews = []
-        vals = []
-        advs = []
-        rets = []
-        noise_indices = []
-        ep_rews = []
 
         while True:
             batches = self.server.get_n_timesteps(num_timesteps)
-            for batch in batches:
-                (
-                    actions,
-                    log_probs,
-                    rewards,
-                    obs,
-                    dones,
-                    future_rewards,
-                    values,
-                    advantages,
-                    pred_rets,
-                    ep_rew,
-                    noise_idx,
-                ) = batch
-                acts += actions
-                probs += log_probs
-                rews += rewards
-                obses += obs
-                done += dones
-                frews += future_rewards
-                vals += values
-                advs += advantages
-                rets += pred_rets
-                noise_indices.append(noise_idx)
-                ep_rews.append(ep_rew)
-                n_collected += len(batch[0])
-
-            if len(acts) > 0:
-                exp.register_trajectory(
-                    (
-                        acts,
-                        probs,
-                        rews,
-                        obses,
-                        done,
-                        frews,
-                        vals,
-                        advs,
-                        rets,
-                        noise_indices,
-                        ep_rews,
-                    ),
-                    serialized=True,
-                )
+            if len(batches) > 0:
+                exp.register_batches(batches)
+                n_collected += sum(batch.num_timesteps for batch in batches)
                 break
 
             if exp.num_timesteps > batch_size:
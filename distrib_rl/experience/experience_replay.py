@@ -1,4 +1,9 @@
-from distrib_rl.experience import Trajectory
+from distrib_rl.experience import Trajectory, TrajectoryBatch
+from distrib_rl.experience.trajectory_batch import (
+    BFLOAT16,
+    bfloat16_bits_to_float32,
+    float32_to_bfloat16_bits,
+)
 import torch
 import numpy as np
 
@@ -6,148 +11,159 @@ from distrib_rl.utils import WelfordRunningStat
 
 
 class ExperienceReplay(object):
+    """
+    Fixed capacity replay of the timesteps the learner trains on. Every column
+    is allocated once, the first time data arrives, with room for
+    max_buffer_size timesteps. New timesteps are written at a head that wraps
+    around and overwrites the oldest ones, so registering data costs as much as
+    the data itself rather than the whole buffer. The column attributes are
+    views of the filled part of the storage, in storage order rather than
+    arrival order.
+    """
+
+    COLUMNS = ("actions", "log_probs", "obs", "values", "advantages")
+
     def __init__(self, cfg):
         self.cfg = cfg
-        self.actions = torch.FloatTensor()
-        self.log_probs = torch.FloatTensor()
-        self.rewards = torch.FloatTensor()
-        self.obs = torch.FloatTensor()
-        self.dones = torch.FloatTensor()
-        self.future_rewards = torch.FloatTensor()
-        self.values = torch.FloatTensor()
-        self.advantages = torch.FloatTensor()
-        self.pred_rets = torch.FloatTensor()
-        self.ep_rews = torch.FloatTensor()
-        self.noise_idxs = torch.FloatTensor()
-        self.num_timesteps = 0
+
+        # Columns are stored in the dtype declared in the config and only
+        # upcast when a minibatch is used.
+        dtypes = TrajectoryBatch.get_column_dtypes(
+            cfg["experience_replay"].get("dtypes", None)
+        )
+        self.dtypes = {name: getattr(torch, dtypes[name]) for name in self.COLUMNS}
+
         self.max_buffer_size = cfg["experience_replay"]["max_buffer_size"]
         self.rng = cfg["rng"]
+        self._storage = None
+        self._arrays = None
+        self._head = 0
+        self.num_timesteps = 0
+        self._update_views()
 
         self.reward_stats = WelfordRunningStat(1)
 
         self.time = 0
 
     def register_trajectory(self, trajectory: Trajectory, serialized=False):
-        if not serialized:
-            (
-                actions,
-                log_probs,
-                rewards,
-                obs,
-                dones,
-                future_rewards,
-                values,
-                advantages,
-                pred_rets,
-                ep_rew,
-                noise_idx,
-            ) = trajectory.serialize()
-        else:
-            (
-                actions,
-                log_probs,
-                rewards,
-                obs,
-                dones,
-                future_rewards,
-                values,
-                advantages,
-                pred_rets,
-                ep_rew,
-                noise_idx,
-            ) = trajectory
-
-        self.reward_stats.increment(future_rewards, len(future_rewards))
-        self.actions = torch.cat(
-            (self.actions, torch.as_tensor(actions,dtype=torch.float32)), 0
-        )
-        self.log_probs = torch.cat(
-            (self.log_probs, torch.as_tensor(log_probs, dtype=torch.float32)), 0
-        )
-        self.obs = torch.cat((self.obs, torch.as_tensor(obs, dtype=torch.float32)), 0)
-        self.values = torch.cat(
-            (self.values, torch.as_tensor(values, dtype=torch.float32)), 0
-        )
-        self.advantages = torch.cat(
-            (self.advantages, torch.as_tensor(advantages, dtype=torch.float32)), 0
-        )
-        self.noise_idxs = torch.cat(
-            (self.noise_idxs, torch.as_tensor(noise_idx, dtype=torch.float32)), 0
-        )
-        self.ep_rews = torch.cat(
-            (self.ep_rews, torch.as_tensor(ep_rew, dtype=torch.float32)), 0
-        )
-        self._clamp_size()
-        self.num_timesteps = len(self.actions)
-
-    def get_all_batches_shuffled(self, batch_size):
-        if batch_size == self.num_timesteps:
-            return self.get_all_batches(batch_size)
-
-        indices = [i for i in range(self.num_timesteps)]
-        self.rng.shuffle(indices)
-
-        acts, probs, rews, obs, dones, f_rews, vals, adv, pr = (
-            self.actions,
-            self.log_probs,
-            self.rewards,
-            self.obs,
-            self.dones,
-            self.future_rewards,
-            self.values,
-            self.advantages,
-            self.pred_rets,
+        if serialized:
+            data = trajectory
+            trajectory = Trajectory()
+            trajectory.deserialize(data)
+
+        self.register_batch(TrajectoryBatch.from_trajectories([trajectory]))
+
+    def register_batch(self, batch: TrajectoryBatch):
+        self.register_batches([batch])
+
+    def register_batches(self, batches):
+        """
+        Copy a list of batches into the storage. Each column of each batch is
+        written straight into its place in the ring, so the batches are never
+        concatenated and nothing is copied twice.
+        :param batches: List of TrajectoryBatch objects, oldest first.
+        """
+
+        for batch in batches:
+            self._update_reward_stats(batch)
+
+        batches = [batch for batch in batches if batch.num_timesteps > 0]
+        if len(batches) == 0:
+            return
+
+        if self._storage is None:
+            self._allocate(batches[0])
+
+        # Only the newest max_buffer_size timesteps could survive anyway,
+        # anything older is skipped.
+        skip = max(
+            0, sum(batch.num_timesteps for batch in batches) - self.max_buffer_size
         )
+        for batch in batches:
+            if skip >= batch.num_timesteps:
+                skip -= batch.num_timesteps
+                continue
 
-        acts = acts[indices]
-        probs = probs[indices]
-        obs = obs[indices]
-        vals = vals[indices]
-        adv = adv[indices]
-
-        batches = []
-        n = len(acts) // batch_size
-
-        # max_idx = self.num_timesteps - batch_size
-        # indices = self.rng.randint(0, max_idx, n)
-        # self.cfg["rng"].shuffle(indices)
-
-        for i in range(n):
-            # batch = Trajectory()
-            start = i * batch_size
-            stop = start + batch_size
+            self._write(batch, skip)
+            skip = 0
 
-            # batch.actions = acts[start:stop]
-            # batch.log_probs = probs[start:stop]
-            # batch.obs = obs[start:stop]
-            # batch.values = vals[start:stop]
-            # batch.advantages = adv[start:stop]
+        self._update_views()
 
-            # batches.append(batch)
+    def _update_reward_stats(self, batch):
+        if batch.reward_moments is not None:
+            self.reward_stats.increment_from_obs_update(batch.reward_moments)
+        else:
+            future_rewards = batch.future_rewards
+            if batch.dtypes["future_rewards"] == BFLOAT16:
+                future_rewards = bfloat16_bits_to_float32(future_rewards)
+            self.reward_stats.increment(future_rewards, len(future_rewards))
+
+    def _write(self, batch, start):
+        capacity = self.max_buffer_size
+        n = batch.num_timesteps - start
+        head = self._head
+        first = min(n, capacity - head)
+        for name in self.COLUMNS:
+            column = _to_storage_dtype(batch, name, self.dtypes[name], start)
+            storage = self._arrays[name]
+            storage[head : head + first] = column[:first]
+            storage[: n - first] = column[first:]
+
+        self._head = (head + n) % capacity
+        self.num_timesteps = min(self.num_timesteps + n, capacity)
+
+    def _allocate(self, batch):
+        self._storage = {
+            name: torch.empty(
+                (self.max_buffer_size,) + getattr(batch, name).shape[1:],
+                dtype=self.dtypes[name],
+            )
+            for name in self.COLUMNS
+        }
+
+        # Numpy views of the storage, so batches can be copied in without
+        # wrapping every column in a tensor first.
+        self._arrays = {}
+        for name, storage in self._storage.items():
+            if storage.dtype == torch.bfloat16:
+                self._arrays[name] = storage.view(torch.int16).numpy().view(np.uint16)
+            else:
+                self._arrays[name] = storage.numpy()
+
+    def _update_views(self):
+        for name in self.COLUMNS:
+            if self._storage is None:
+                view = torch.empty(0, dtype=self.dtypes[name])
+            else:
+                view = self._storage[name][: self.num_timesteps]
+            setattr(self, name, view)
+
+    def get_all_batches_shuffled(self, batch_size, n_epochs=1):
+        # A single batch of everything doesn't need shuffling, it comes back in
+        # storage order like it always has.
+        if batch_size == self.num_timesteps and n_epochs == 1:
+            return self.get_all_batches(batch_size)
 
-            batches.append(
-                [
-                    acts[start:stop],
-                    probs[start:stop],
-                    obs[start:stop],
-                    vals[start:stop],
-                    adv[start:stop],
-                ]
+        return list(
+            shuffled_minibatches(
+                self.get_all(), batch_size, n_epochs, self.make_generator()
             )
+        )
 
-        return batches
+    def make_generator(self, device="cpu"):
+        # Shuffles are drawn by torch so they can happen on the device, seeding
+        # from our rng keeps runs reproducible.
+        generator = torch.Generator(device=device)
+        generator.manual_seed(int(self.rng.randint(2**31)))
+        return generator
 
     def get_all_batches(self, batch_size):
-        acts, probs, rews, obs, dones, f_rews, vals, adv, pr = (
+        acts, probs, obs, vals, adv = (
             self.actions,
             self.log_probs,
-            self.rewards,
             self.obs,
-            self.dones,
-            self.future_rewards,
             self.values,
             self.advantages,
-            self.pred_rets,
         )
 
         batches = []
@@ -172,28 +188,12 @@ class ExperienceReplay(object):
         return (
             self.actions,
             self.log_probs,
-            self.rewards,
             self.obs,
-            self.dones,
-            self.future_rewards,
             self.values,
             self.advantages,
-            self.pred_rets,
         )
 
     def get_batch(self, size):
-        acts, probs, rews, obs, dones, f_rews, vals, adv, pr = (
-            self.actions,
-            self.log_probs,
-            self.rewards,
-            self.obs,
-            self.dones,
-            self.future_rewards,
-            self.values,
-            self.advantages,
-            self.pred_rets,
-        )
-
         if size > self.num_timesteps:
             print(
                 "Asked for batch of size {} when only {} timesteps have been collected. Returning entire memory.".format(
@@ -201,64 +201,66 @@ class ExperienceReplay(object):
                 )
             )
 
-            return acts, probs, rews, obs, dones, f_rews, vals, adv, pr
+            return self.get_all()
 
-        return (
-            acts[:size],
-            probs[:size],
-            rews[:size],
-            obs[:size],
-            dones[:size],
-            f_rews[:size],
-            vals[:size],
-            adv[:size],
-            pr[:size],
-        )
+        return tuple(column[:size] for column in self.get_all())
 
     def get_random_batch(self, size):
-        acts, probs, rews, obs, dones, f_rews, vals, adv, pr = (
-            self.actions,
-            self.log_probs,
-            self.rewards,
-            self.obs,
-            self.dones,
-            self.future_rewards,
-            self.values,
-            self.advantages,
-            self.pred_rets,
-        )
         size = min(size, self.num_timesteps)
-        indices = [i for i in range(self.num_timesteps)]
-        self.cfg["rng"].shuffle(indices)
-        indices = indices[:size]
-
-        pr = pr[indices]
-        acts = acts[indices]
-        probs = probs[indices]
-        rews = rews[indices]
-        obs = obs[indices]
-        dones = dones[indices]
-        f_rews = f_rews[indices]
-        vals = vals[indices]
-        adv = adv[indices]
-
-        return acts, probs, rews, obs, dones, f_rews, vals, adv, pr
-
-    def _clamp_size(self):
-        arr_to_check = max(len(self.actions), len(self.noise_idxs))
-        start = arr_to_check - self.max_buffer_size
-        if start > 0:
-            self.actions = self.actions[start:]
-            self.log_probs = self.log_probs[start:]
-            self.rewards = self.rewards[start:]
-            self.obs = self.obs[start:]
-            self.dones = self.dones[start:]
-            self.future_rewards = self.future_rewards[start:]
-            self.values = self.values[start:]
-            self.advantages = self.advantages[start:]
-            self.pred_rets = self.pred_rets[start:]
-            self.noise_idxs = self.noise_idxs[start:]
-            self.ep_rews = self.ep_rews[start:]
+        if size == 0:
+            return self.get_all()
+
+        return tuple(
+            next(shuffled_minibatches(self.get_all(), size, 1, self.make_generator()))
+        )
 
     def clear(self):
-        self.__init__(self.cfg)
+        # The storage is kept, only what's in it is forgotten.
+        self._head = 0
+        self.num_timesteps = 0
+        self._update_views()
+        self.reward_stats = WelfordRunningStat(1)
+
+
+def shuffled_minibatches(columns, batch_size, n_epochs=1, generator=None):
+    """
+    Lazily gather shuffled minibatches from a set of equally long columns. Each
+    epoch draws one permutation on the columns' device and every minibatch is
+    gathered from it only when it's asked for, so nothing is copied between
+    devices and the columns are never reordered as a whole.
+    :param columns: Sequence of tensors with one row per timestep.
+    :param batch_size: Number of timesteps per minibatch. Timesteps that don't
+                       fill a whole minibatch are skipped.
+    :param n_epochs: Number of passes over the columns, each in a new order.
+    :param generator: Optional torch.Generator on the columns' device.
+    :return: Generator of lists holding one minibatch of every column.
+    """
+
+    num_timesteps = len(columns[0])
+    num_batches = num_timesteps // batch_size
+    device = columns[0].device
+
+    for _ in range(n_epochs):
+        indices = torch.randperm(num_timesteps, device=device, generator=generator)
+        for i in range(num_batches):
+            batch_indices = indices[i * batch_size : (i + 1) * batch_size]
+            yield [column[batch_indices] for column in columns]
+
+
+def _to_storage_dtype(batch, name, dtype, start):
+    """
+    Prepare the part of a column from start onwards for assignment into a numpy
+    view of storage with the given torch dtype. Numpy handles any other cast
+    during the assignment, bfloat16 storage is written as raw bit patterns.
+    """
+
+    arr = getattr(batch, name)[start:]
+    is_bfloat16 = batch.dtypes[name] == BFLOAT16
+    if dtype == torch.bfloat16:
+        if is_bfloat16:
+            return arr
+        return float32_to_bfloat16_bits(arr)
+
+    if is_bfloat16:
+        return bfloat16_bits_to_float32(arr)
+    return arr
@@ -1,5 +1,7 @@
 from distrib_rl.mpframework import ProcessHandler
-from distrib_rl.experience import ParallelShuffler
+from distrib_rl.experience import ParallelShuffler, shuffled_minibatches
+from distrib_rl.experience.replay_handoff import ReplayHandoff
+import torch
 import time
 
 
@@ -11,13 +13,55 @@ class ParallelExperienceManager(object):
         self.rew_std = 1
         self.ts_collected = 0
         self.steps_per_second = 0
+        self.data_wait_time = 0
+        self.decode_time = 0
+        self.dropped_timesteps = 0
+        self.stale_timesteps = 0
+        self.policy_lag_counts = None
+
+        po_cfg = cfg["policy_optimizer"]
+        self.batch_size = po_cfg["batch_size"]
+        self.epochs_per_update = po_cfg.get("epochs_per_update", 1)
+        self.device = cfg.get("device", "cpu")
+        self.generator = torch.Generator(device=self.device)
+        self.generator.manual_seed(int(cfg["rng"].randint(2**31)))
+        self.handoff = ReplayHandoff()
+        self._held_snapshot = None
+
         self._init_process()
 
     def get_all_batches_shuffled(self):
+        """
+        Wait for the next snapshot of the replay, move it to our device and
+        shuffle it into minibatches there. The snapshot's slot is handed back
+        to the shuffler as soon as it has been copied to the device. On the CPU
+        the minibatches are gathered straight from shared memory, so the slot
+        is held until the next call.
+        :return: Generator of minibatches that covers the snapshot
+                 epochs_per_update times.
+        """
+
+        self._release_snapshot()
+        descriptor = self._get_experience()
+        columns = [column.to(self.device) for column in self.handoff.read(descriptor)]
+        self._held_snapshot = descriptor
+        if torch.device(self.device).type != "cpu":
+            self._release_snapshot()
+
+        return shuffled_minibatches(
+            columns, self.batch_size, self.epochs_per_update, self.generator
+        )
+
+    def _get_experience(self):
         self.ts_collected = 0
-        new_batches = []
+        self.data_wait_time = 0
+        self.decode_time = 0
+        self.dropped_timesteps = 0
+        self.stale_timesteps = 0
+        self.policy_lag_counts = None
+        descriptor = None
         handler = self.process_handler
-        while len(new_batches) == 0:
+        while descriptor is None:
             batches = handler.get_all()
             if batches is None:
                 time.sleep(0.01)
@@ -31,11 +75,35 @@ class ParallelExperienceManager(object):
                         self.rew_std,
                         ts_collected,
                         self.steps_per_second,
+                        data_wait_time,
+                        decode_time,
+                        dropped_timesteps,
+                        policy_lag_counts,
+                        stale_timesteps,
                     ) = msg
                     self.ts_collected += ts_collected
+                    self.data_wait_time += data_wait_time
+                    self.decode_time += decode_time
+                    self.dropped_timesteps += dropped_timesteps
+                    self.stale_timesteps += stale_timesteps
+                    if self.policy_lag_counts is None:
+                        self.policy_lag_counts = policy_lag_counts
+                    else:
+                        self.policy_lag_counts = (
+                            self.policy_lag_counts + policy_lag_counts
+                        )
                 else:
-                    new_batches.append(msg)
-        return new_batches
+                    # Every snapshot holds the whole replay, so only the newest
+                    # one is worth training on.
+                    if descriptor is not None:
+                        self.handoff.release(descriptor)
+                    descriptor = msg
+        return descriptor
+
+    def _release_snapshot(self):
+        if self._held_snapshot is not None:
+            self.handoff.release(self._held_snapshot)
+            self._held_snapshot = None
 
     def _init_process(self):
         rng = self.cfg["rng"]
@@ -49,4 +117,6 @@ class ParallelExperienceManager(object):
 
     def cleanup(self):
         self.process_handler.stop()
+        self._held_snapshot = None
+        self.handoff.close()
         self.cfg = None
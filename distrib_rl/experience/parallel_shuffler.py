@@ -11,12 +11,13 @@ class ParallelShuffler(Process):
         self.ts_per_update = 0
         self.sleep_fn = 0
         self.batch_size = 0
-        self.buffer = []
+        self.handoff = None
 
     def init(self):
         import numpy
         from distrib_rl.experience import DistribExperienceManager
-        from distrib_rl.distrib import RedisServer
+        from distrib_rl.experience.replay_handoff import ReplayHandoff
+        from distrib_rl.distrib import transport_factory
         from time import sleep
 
         self.sleep_fn = sleep
@@ -24,8 +25,11 @@ class ParallelShuffler(Process):
         self.task_checker.wait_for_initialization(header="initialization_data")
         self.cfg = self.task_checker.latest_data.copy()
         self.cfg["rng"] = numpy.random.RandomState(self.cfg["seed"])
-        self.server = RedisServer(self.cfg["experience_replay"]["max_buffer_size"])
+        self.server = transport_factory.get_server(
+            self.cfg["experience_replay"]["max_buffer_size"]
+        )
         self.server.connect(new_server_instance=False)
+        self.server.configure(self.cfg)
         self.exp_manager = DistribExperienceManager(self.cfg, server=self.server)
 
         if "updates_per_timestep" in self.cfg["policy_optimizer"]:
@@ -54,6 +58,7 @@ class ParallelShuffler(Process):
                 )
             )
         self.batch_size = self.cfg["policy_optimizer"]["batch_size"]
+        self.handoff = ReplayHandoff(self.cfg["experience_replay"]["max_buffer_size"])
 
     def update(self, header, data):
         pass
@@ -62,30 +67,44 @@ class ParallelShuffler(Process):
         pass
 
     def publish(self):
-        if not self.results_publisher.is_empty():
+        # Wait until the learner has let go of a slot before collecting more,
+        # it's still training on the other one.
+        slot = self.handoff.acquire()
+        if slot is None:
             self.sleep_fn(0.01)
             return
 
         publisher = self.results_publisher
-        for batch in self.buffer:
-            publisher.publish(header="experience_batch", data=batch)
-
-        buffer = []
         ts_collected, fps = self.exp_manager.get_timesteps_as_batches(
             self.ts_per_update, self.batch_size
         )
 
-        for batch in self.exp_manager.experience.get_all_batches_shuffled(
-            self.batch_size
-        ):
-            buffer.append(batch)
-
-        rew_mean = self.exp_manager.experience.reward_stats.mean[0]
-        rew_std = self.exp_manager.experience.reward_stats.std[0]
+        # The learner shuffles and slices the replay itself once it's on its
+        # device, so it only needs a snapshot.
+        experience = self.exp_manager.experience
+        if experience.num_timesteps >= self.batch_size:
+            descriptor = self.handoff.write(slot, experience.get_all())
+            publisher.publish(header="experience_batch", data=descriptor)
+
+        rew_mean = experience.reward_stats.mean[0]
+        rew_std = experience.reward_stats.std[0]
+        wait_time, decode_time = self.server.get_timing_stats()
+        dropped_ts = self.server.get_dropped_timesteps()
+        policy_lag_counts, stale_ts = self.server.get_policy_lag_stats()
         publisher.publish(
-            header="misc_data", data=(rew_mean, rew_std, ts_collected, fps)
+            header="misc_data",
+            data=(
+                rew_mean,
+                rew_std,
+                ts_collected,
+                fps,
+                wait_time,
+                decode_time,
+                dropped_ts,
+                policy_lag_counts,
+                stale_ts,
+            ),
         )
-        self.buffer = buffer
 
     def cleanup(self):
         print("SHUTTING DOWN SHUFFLING PROCESS")
@@ -95,6 +114,9 @@ class ParallelShuffler(Process):
         if self.exp_manager is not None:
             self.exp_manager.cleanup()
 
+        if self.handoff is not None:
+            self.handoff.close()
+
         if self.cfg is not None:
             self.cfg.clear()
 
@@ -0,0 +1,203 @@
+"""
+    File name: replay_handoff.py
+
+    Description:
+        Double buffered shared memory region that hands snapshots of the replay
+        from the ParallelShuffler to the learner. The shuffler owns the region
+        and writes each snapshot into whichever of the two slots is free while
+        the learner trains on the other one, so only a small descriptor has to
+        go through the process queue. A slot becomes free again once the
+        learner releases it.
+"""
+
+from distrib_rl.mpframework.shared_segments import open_segment
+import numpy as np
+import torch
+
+NUM_SLOTS = 2
+SLOT_FREE = 0
+SLOT_READY = 1
+
+# The slot states live on their own cache line in front of the slots.
+HEADER_SIZE = 64
+
+
+def _align(size):
+    return (size + 63) & ~63
+
+
+class ReplayHandoff(object):
+    def __init__(self, capacity=0):
+        """
+        :param capacity: Number of rows each slot should hold. The region grows
+                         if a larger snapshot is written.
+        """
+
+        self.capacity = capacity
+        self._segment = None
+        self._states = None
+        self._column_specs = None
+        self._column_offsets = None
+        self._slot_size = 0
+        self._next_slot = 0
+        self._attached = {}
+        # Regions replaced while the reader still had a slot queued or held in
+        # them.
+        self._retired = []
+
+    def acquire(self):
+        """
+        Find a slot the reader isn't holding.
+        :return: Slot index, or None if both slots are still waiting to be
+                 released.
+        """
+
+        self._unlink_released()
+        if self._segment is None:
+            return self._next_slot
+
+        for i in range(NUM_SLOTS):
+            slot = (self._next_slot + i) % NUM_SLOTS
+            if self._states[slot] == SLOT_FREE:
+                return slot
+        return None
+
+    def write(self, slot, columns):
+        """
+        Copy a snapshot into a slot returned by acquire and mark it ready.
+        :param slot: Slot index.
+        :param columns: List of tensors that all have the same number of rows.
+        :return: Descriptor of the snapshot to pass to read on the other side.
+        """
+
+        num_rows = len(columns[0])
+        specs = [(column.dtype, tuple(column.shape[1:])) for column in columns]
+        if specs != self._column_specs or num_rows > self.capacity:
+            self._create(specs, max(num_rows, self.capacity))
+
+        base = HEADER_SIZE + slot * self._slot_size
+        layout = [
+            (str(dtype).split(".")[-1], shape, base + offset)
+            for (dtype, shape), offset in zip(specs, self._column_offsets)
+        ]
+        for column, view in zip(columns, _views(self._segment, layout, num_rows)):
+            view.copy_(column)
+
+        self._states[slot] = SLOT_READY
+        self._next_slot = (slot + 1) % NUM_SLOTS
+        return self._segment.name, slot, num_rows, layout
+
+    def read(self, descriptor):
+        """
+        :param descriptor: Descriptor returned by write.
+        :return: List of tensors backed by the slot. They are only valid until
+                 the slot is released.
+        """
+
+        name, slot, num_rows, layout = descriptor
+        segment, _ = self._attach(name)
+        return _views(segment, layout, num_rows)
+
+    def release(self, descriptor):
+        _, states = self._attach(descriptor[0])
+        states[descriptor[1]] = SLOT_FREE
+
+    def close(self):
+        while len(self._retired) > 0:
+            segment, states = self._retired.pop()
+            del states
+            self._close(segment)
+            segment.unlink()
+
+        while len(self._attached) > 0:
+            _, (segment, states) = self._attached.popitem()
+            del states
+            self._close(segment)
+
+        if self._segment is not None:
+            self._states = None
+            self._close(self._segment)
+            self._segment.unlink()
+            self._segment = None
+
+    def _attach(self, name):
+        attached = self._attached.get(name, None)
+        if attached is None:
+            # A new region means the old ones were replaced. Let go of those we
+            # no longer hold a slot in.
+            for old_name in list(self._attached.keys()):
+                segment, states = self._attached[old_name]
+                if np.all(states == SLOT_FREE):
+                    del self._attached[old_name], states
+                    self._close(segment)
+
+            segment = open_segment(name)
+            states = np.ndarray((NUM_SLOTS,), dtype=np.int64, buffer=segment.buf)
+            attached = self._attached[name] = (segment, states)
+        return attached
+
+    def _create(self, specs, capacity):
+        # A descriptor for the old region may still be queued or held by the
+        # reader, so the region is only unlinked once both of its slots have
+        # been released.
+        if self._segment is not None:
+            self._retired.append((self._segment, self._states))
+            self._states = None
+            self._segment = None
+            self._unlink_released()
+
+        offsets = []
+        slot_size = 0
+        for dtype, shape in specs:
+            offsets.append(slot_size)
+            row_size = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+            slot_size += _align(capacity * row_size)
+
+        self._segment = open_segment(
+            None, create=True, size=HEADER_SIZE + NUM_SLOTS * max(1, slot_size)
+        )
+        self._states = np.ndarray(
+            (NUM_SLOTS,), dtype=np.int64, buffer=self._segment.buf
+        )
+        self._states[:] = SLOT_FREE
+        self._column_specs = specs
+        self._column_offsets = offsets
+        self._slot_size = max(1, slot_size)
+        self.capacity = capacity
+
+    def _unlink_released(self):
+        retired = self._retired
+        self._retired = []
+        while len(retired) > 0:
+            segment, states = retired.pop()
+            if np.any(states != SLOT_FREE):
+                self._retired.append((segment, states))
+                continue
+
+            del states
+            self._close(segment)
+            segment.unlink()
+
+    @staticmethod
+    def _close(segment):
+        try:
+            segment.close()
+        except BufferError:
+            # Someone still holds a tensor backed by the segment, the mapping
+            # goes away with it.
+            pass
+
+
+def _views(segment, layout, num_rows):
+    views = []
+    for dtype, shape, offset in layout:
+        count = num_rows * int(np.prod(shape, dtype=np.int64))
+        if count == 0:
+            views.append(torch.empty((num_rows, *shape), dtype=getattr(torch, dtype)))
+            continue
+
+        view = torch.frombuffer(
+            segment.buf, dtype=getattr(torch, dtype), count=count, offset=offset
+        )
+        views.append(view.view(num_rows, *shape))
+    return views
@@ -1,5 +1,11 @@
-from distrib_rl.experience import ExperienceReplay, Timestep, Trajectory
+from distrib_rl.experience import (
+    ExperienceReplay,
+    Timestep,
+    Trajectory,
+    TrajectoryBatch,
+)
 import numpy as np
+import torch
 
 
 def run_test():
@@ -21,16 +27,59 @@ def run_test():
         ts.done = False
         print("Timestep {}: {}".format(i, ts.serialize()))
         trajectory.register_timestep(ts)
-    trajectory.finalize(gamma=0.95)
+    trajectory.finalize(
+        gamma=0.95, lmbda=0.95, values=[0.0 for _ in range(num_timesteps * 2 + 1)]
+    )
 
     print("\nFinalized trajectory:\n{}\n".format(trajectory.serialize()))
     replay.register_trajectory(trajectory)
 
+    # The trajectory is twice the size of the replay, so only its second half
+    # is kept.
+    assert replay.num_timesteps == num_timesteps
+    assert replay.obs.flatten().tolist() == list(
+        range(num_timesteps, num_timesteps * 2)
+    )
+
+    # Registering a partial trajectory wraps around and overwrites the oldest
+    # timesteps.
+    trajectory.truncate(3)
+    replay.register_trajectory(trajectory)
+    assert replay.num_timesteps == num_timesteps
+    assert replay.obs.flatten().tolist()[:4] == [0, 1, 2, num_timesteps + 3]
+
+    # A list of batches lands exactly where their concatenation would, older
+    # batches that can't fit are skipped.
+    batches = [
+        TrajectoryBatch.from_trajectories([trajectory]),
+        TrajectoryBatch.from_trajectories([trajectory]),
+        TrajectoryBatch.from_trajectories([trajectory]),
+    ]
+    concatenated = ExperienceReplay(cfg)
+    concatenated.register_trajectory(trajectory)
+    concatenated.register_batch(TrajectoryBatch.concatenate(batches))
+    listed = ExperienceReplay(cfg)
+    listed.register_trajectory(trajectory)
+    listed.register_batches(batches)
+    assert listed.obs.flatten().tolist() == concatenated.obs.flatten().tolist()
+    assert listed.reward_stats.count == concatenated.reward_stats.count
+
     batch = replay.get_batch(num_timesteps // 2)
     random_batch = replay.get_random_batch(num_timesteps // 2)
     print("Replay batch:\n{}\n", batch)
     print("Replay random batch:\n{}\n", random_batch)
 
+    # Every epoch of shuffled minibatches covers each timestep exactly once.
+    minibatches = replay.get_all_batches_shuffled(num_timesteps // 2, n_epochs=2)
+    assert len(minibatches) == 4
+    for epoch in range(2):
+        obs = torch.cat([batch[2] for batch in minibatches[epoch * 2 : epoch * 2 + 2]])
+        assert sorted(obs.flatten().tolist()) == sorted(replay.obs.flatten().tolist())
+
+    # Asking for everything at once keeps storage order.
+    (whole,) = replay.get_all_batches_shuffled(num_timesteps)
+    assert torch.equal(whole[2], replay.obs)
+
 
 if __name__ == "__main__":
     run_test()
@@ -0,0 +1,49 @@
+from distrib_rl.experience import Trajectory, finalize_trajectories
+import numpy as np
+
+
+def random_trajectory(rng, num_timesteps, terminal):
+    trajectory = Trajectory()
+    for i in range(num_timesteps):
+        done = 1 if terminal and i == num_timesteps - 1 else 0
+        trajectory.add(0, -0.5, rng.randn(), rng.randn(3), done)
+    return trajectory
+
+
+def run_test():
+    rng = np.random.RandomState(0)
+    shapes = [(1, True), (7, False), (0, True), (30, True), (12, False), (2, True)]
+
+    for reward_stats in (None, (0.3, 2.5)):
+        packed, reference, values = [], [], []
+        for num_timesteps, terminal in shapes:
+            trajectory = random_trajectory(rng, num_timesteps, terminal)
+            packed.append(trajectory)
+            reference.append(random_trajectory(rng, 0, False))
+            reference[-1]._set_timestep_columns(
+                trajectory.actions,
+                trajectory.log_probs,
+                trajectory.rewards,
+                trajectory.obs,
+                trajectory.dones,
+            )
+            values.append(rng.randn(num_timesteps + 1).astype(np.float32))
+
+        finalize_trajectories(packed, values, 0.99, 0.95, reward_stats=reward_stats)
+
+        for trajectory, other, v in zip(packed, reference, values):
+            if len(other) == 0:
+                continue
+
+            other.finalize(
+                gamma=0.99, lmbda=0.95, values=v.tolist(), reward_stats=reward_stats
+            )
+            for name in ("future_rewards", "values", "advantages", "pred_rets"):
+                ours = getattr(trajectory, name)
+                theirs = getattr(other, name)
+                assert ours.dtype == np.float32 and ours.shape == theirs.shape
+                assert np.allclose(ours, theirs, atol=1e-5), name
+
+
+if __name__ == "__main__":
+    run_test()
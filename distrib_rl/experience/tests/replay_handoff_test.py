@@ -0,0 +1,81 @@
+from distrib_rl.experience.replay_handoff import ReplayHandoff
+from distrib_rl.mpframework.shared_segments import open_segment
+import torch
+
+NUM_ROWS = 16
+OBS_SIZE = 5
+
+
+def build_snapshot(num_rows, fill, obs_dtype=torch.float32):
+    obs = torch.full((num_rows, OBS_SIZE), fill, dtype=obs_dtype)
+    actions = torch.arange(num_rows, dtype=torch.int64) + fill
+    values = torch.full((num_rows,), fill, dtype=torch.float16)
+    return [obs, actions, values]
+
+
+def check_snapshot(columns, expected):
+    assert len(columns) == len(expected)
+    for column, expected_column in zip(columns, expected):
+        assert column.dtype == expected_column.dtype
+        assert torch.equal(column, expected_column)
+
+
+def segment_exists(name):
+    try:
+        open_segment(name).close()
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def run_test():
+    writer = ReplayHandoff(NUM_ROWS)
+    reader = ReplayHandoff()
+    try:
+        # Write, read and release through both slots.
+        for i in range(4):
+            slot = writer.acquire()
+            assert slot == i % 2
+            snapshot = build_snapshot(NUM_ROWS, i)
+            descriptor = writer.write(slot, snapshot)
+            check_snapshot(reader.read(descriptor), snapshot)
+            reader.release(descriptor)
+
+        # With both slots waiting on the reader the writer has to hold off.
+        first = build_snapshot(NUM_ROWS // 2, 10)
+        second = build_snapshot(NUM_ROWS, 11)
+        first_descriptor = writer.write(writer.acquire(), first)
+        second_descriptor = writer.write(writer.acquire(), second)
+        assert writer.acquire() is None
+        check_snapshot(reader.read(first_descriptor), first)
+        reader.release(first_descriptor)
+        assert writer.acquire() == first_descriptor[1]
+        check_snapshot(reader.read(second_descriptor), second)
+        reader.release(second_descriptor)
+
+        # Half precision columns, the new spec replaces the region while a
+        # snapshot in the old one is still queued for the reader.
+        queued = build_snapshot(NUM_ROWS, 20)
+        queued_descriptor = writer.write(writer.acquire(), queued)
+        old_name = queued_descriptor[0]
+        for i, obs_dtype in enumerate((torch.bfloat16, torch.float16)):
+            snapshot = build_snapshot(NUM_ROWS * 2, 21 + i, obs_dtype)
+            descriptor = writer.write(writer.acquire(), snapshot)
+            assert descriptor[0] != old_name
+            check_snapshot(reader.read(descriptor), snapshot)
+            reader.release(descriptor)
+            assert segment_exists(old_name)
+
+        check_snapshot(reader.read(queued_descriptor), queued)
+        reader.release(queued_descriptor)
+        writer.acquire()
+        assert not segment_exists(old_name)
+    finally:
+        reader.close()
+        writer.close()
+
+    print("Replay handoff passed snapshots through both slots")
+
+
+if __name__ == "__main__":
+    run_test()
@@ -0,0 +1,105 @@
+from distrib_rl.distrib.message_serialization import MessageSerializer
+from distrib_rl.experience import (
+    ExperienceReplay,
+    Timestep,
+    Trajectory,
+    TrajectoryBatch,
+)
+from distrib_rl.utils import WelfordRunningStat
+import numpy as np
+import pickle
+import torch
+
+
+def build_trajectory(num_timesteps, policy_epoch):
+    # A small capacity makes the buffers grow a few times along the way.
+    trajectory = Trajectory(policy_epoch, capacity=2)
+    for i in range(num_timesteps):
+        ts = Timestep()
+        ts.action = i % 2
+        ts.log_prob = -0.5
+        ts.reward = float(i)
+        ts.obs = np.full(4, i, dtype=np.float32)
+        ts.done = 1 if i == num_timesteps - 1 else 0
+        trajectory.register_timestep(ts)
+
+    values = [0.5 for _ in range(num_timesteps + 1)]
+    trajectory.finalize(gamma=0.99, lmbda=0.95, values=values)
+    return trajectory
+
+
+def run_test():
+    trajectories = [build_trajectory(n, epoch) for n, epoch in ((5, 1), (3, 2))]
+    batch = TrajectoryBatch.from_trajectories(trajectories)
+
+    # Pickling only keeps the filled part of the buffers.
+    unpickled = pickle.loads(pickle.dumps(trajectories[0]))
+    assert len(unpickled) == 5 and len(unpickled._obs) == 5
+    assert np.array_equal(unpickled.obs, trajectories[0].obs)
+    assert np.array_equal(unpickled.advantages, trajectories[0].advantages)
+
+    serializer = MessageSerializer()
+    packed = serializer.pack(batch.serialize())
+    decoded = TrajectoryBatch.deserialize(serializer.unpack(packed))
+
+    assert decoded.num_timesteps == 8
+    assert decoded.num_trajectories == 2
+    assert decoded.obs.shape == (8, 4)
+    assert np.array_equal(decoded.obs, batch.obs)
+    assert np.array_equal(decoded.policy_epochs, [1, 2])
+    assert np.allclose(decoded.advantages[:5], trajectories[0].advantages)
+
+    merged = TrajectoryBatch.concatenate([decoded, decoded])
+    assert np.array_equal(merged.offsets, [0, 5, 8, 13, 16])
+
+    fresh = merged.select(merged.policy_epochs > 1)
+    assert fresh.num_trajectories == 2
+    assert np.array_equal(fresh.offsets, [0, 3, 6])
+    assert np.array_equal(fresh.obs[:3], batch.obs[5:])
+    assert fresh.reward_moments is None
+
+    # Merging the shipped moments has to match feeding the stats one sample at
+    # a time.
+    merged_stats = WelfordRunningStat(1)
+    merged_stats.increment_from_obs_update(merged.reward_moments)
+    sample_stats = WelfordRunningStat(1)
+    for reward in merged.future_rewards:
+        sample_stats.update(reward)
+    assert merged.reward_moments[2] == 16
+    assert np.allclose(merged_stats.mean, sample_stats.mean)
+    assert np.allclose(merged_stats.std, sample_stats.std)
+
+    batched_stats = WelfordRunningStat(1)
+    batched_stats.increment(merged.future_rewards[:1], 1)
+    batched_stats.increment(merged.future_rewards[1:], 15)
+    assert np.allclose(batched_stats.mean, sample_stats.mean)
+    assert np.allclose(batched_stats.std, sample_stats.std)
+
+    print("Packed {} timesteps into {} bytes".format(batch.num_timesteps, len(packed)))
+
+    dtypes = {
+        "obs": "bfloat16",
+        "actions": "int8",
+        "dones": "bool",
+        "values": "float16",
+    }
+    small = TrajectoryBatch.from_trajectories(trajectories, dtypes=dtypes)
+    decoded = TrajectoryBatch.deserialize(
+        serializer.unpack(serializer.pack(small.serialize()))
+    )
+    assert decoded.dtypes["obs"] == "bfloat16"
+    assert np.array_equal(decoded.dones, [0, 0, 0, 0, 1, 0, 0, 1])
+    assert decoded.actions.dtype == np.int8
+
+    cfg = {
+        "experience_replay": {"max_buffer_size": 100, "dtypes": dtypes},
+        "rng": np.random.RandomState(0),
+    }
+    replay = ExperienceReplay(cfg)
+    replay.register_batch(decoded)
+    assert replay.obs.dtype == torch.bfloat16
+    assert torch.equal(replay.obs.float(), torch.as_tensor(batch.obs))
+
+
+if __name__ == "__main__":
+    run_test()
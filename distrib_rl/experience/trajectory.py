@@ -5,30 +5,143 @@ import torch
 
 
 class Trajectory(object):
-    def __init__(self, policy_epoch=0):
-        self.actions = []
-        self.log_probs = []
-        self.rewards = []
-        self.obs = []
-        self.dones = []
-        self.next_obs = []
-        self.future_rewards = []
-        self.values = []
-        self.advantages = []
-        self.pred_rets = []
+    """
+    Struct of arrays holding one trajectory. The per-timestep columns are numpy
+    arrays that are allocated when the first timestep arrives, with room for
+    capacity timesteps, and doubled whenever they fill up. Agents write into
+    them with add, so collecting a timestep doesn't allocate anything. The
+    column attributes are views of the filled part.
+    """
+
+    DEFAULT_CAPACITY = 64
+
+    __slots__ = (
+        "_actions",
+        "_log_probs",
+        "_rewards",
+        "_obs",
+        "_dones",
+        "_num_timesteps",
+        "_capacity",
+        "future_rewards",
+        "values",
+        "advantages",
+        "pred_rets",
+        "final_obs",
+        "is_partial",
+        "ep_rew",
+        "noise_idx",
+        "policy_epoch",
+    )
+
+    def __init__(self, policy_epoch=0, capacity=None):
+        """
+        :param policy_epoch: Epoch of the policy the trajectory is collected
+                             with.
+        :param capacity: Expected number of timesteps, e.g. the length of the
+                         previous episode.
+        """
+
+        self._actions = None
+        self._log_probs = None
+        self._rewards = None
+        self._obs = None
+        self._dones = None
+        self._num_timesteps = 0
+        self._capacity = max(1, capacity or Trajectory.DEFAULT_CAPACITY)
+        self.future_rewards = _empty()
+        self.values = _empty()
+        self.advantages = _empty()
+        self.pred_rets = _empty()
         self.final_obs = None
         self.is_partial = False
         self.ep_rew = 0
         self.noise_idx = 0
         self.policy_epoch = policy_epoch
 
+    @property
+    def actions(self):
+        return self._view(self._actions)
+
+    @property
+    def log_probs(self):
+        return self._view(self._log_probs)
+
+    @property
+    def rewards(self):
+        return self._view(self._rewards)
+
+    @property
+    def obs(self):
+        return self._view(self._obs)
+
+    @property
+    def dones(self):
+        return self._view(self._dones)
+
+    def __len__(self):
+        return self._num_timesteps
+
+    def add(self, action, log_prob, reward, obs, done):
+        n = self._num_timesteps
+        if self._rewards is None:
+            self._allocate(action, obs)
+        elif n == len(self._rewards):
+            self._grow()
+
+        self._actions[n] = action
+        self._log_probs[n] = log_prob
+        self._rewards[n] = reward
+        self._obs[n] = obs
+        self._dones[n] = done
+        self._num_timesteps = n + 1
+
     def register_timestep(self, timestep: Timestep):
-        action, log_prob, reward, obs, done = timestep.serialize()
-        self.actions.append(action)
-        self.log_probs.append(log_prob)
-        self.rewards.append(reward)
-        self.obs.append(obs)
-        self.dones.append(done)
+        self.add(*timestep.serialize())
+
+    def _allocate(self, action, obs):
+        capacity = self._capacity
+        self._actions = np.empty((capacity,) + np.shape(action), dtype=np.float32)
+        self._log_probs = np.empty(capacity, dtype=np.float32)
+        self._rewards = np.empty(capacity, dtype=np.float32)
+        self._obs = np.empty((capacity,) + np.shape(obs), dtype=np.float32)
+        self._dones = np.empty(capacity, dtype=np.float32)
+
+    def _grow(self):
+        n = self._num_timesteps
+        for name in ("_actions", "_log_probs", "_rewards", "_obs", "_dones"):
+            column = getattr(self, name)
+            grown = np.empty((2 * len(column),) + column.shape[1:], dtype=column.dtype)
+            grown[:n] = column[:n]
+            setattr(self, name, grown)
+        self._capacity = len(self._rewards)
+
+    def _view(self, column):
+        if column is None:
+            return _empty()
+        return column[: self._num_timesteps]
+
+    def _set_timestep_columns(self, actions, log_probs, rewards, obs, dones):
+        self._actions = np.asarray(actions, dtype=np.float32)
+        self._log_probs = np.asarray(log_probs, dtype=np.float32)
+        self._rewards = np.asarray(rewards, dtype=np.float32)
+        self._obs = np.asarray(obs, dtype=np.float32)
+        self._dones = np.asarray(dones, dtype=np.float32)
+        self._num_timesteps = len(self._rewards)
+        self._capacity = max(1, self._num_timesteps)
+
+    def __getstate__(self):
+        # Only the filled part of the columns is worth sending to another
+        # process.
+        state = {name: getattr(self, name) for name in Trajectory.__slots__}
+        for name in ("_actions", "_log_probs", "_rewards", "_obs", "_dones"):
+            state[name] = getattr(self, name[1:])
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+        self._capacity = max(1, self._num_timesteps)
 
     def serialize(self):
         return (
@@ -50,25 +163,27 @@ class Trajectory(object):
 
     def deserialize(self, other):
         (
-            self.actions,
-            self.log_probs,
-            self.rewards,
-            self.obs,
-            self.dones,
-            self.future_rewards,
-            self.values,
-            self.advantages,
-            self.pred_rets,
+            actions,
+            log_probs,
+            rewards,
+            obs,
+            dones,
+            future_rewards,
+            values,
+            advantages,
+            pred_rets,
             self.ep_rew,
             self.noise_idx,
         ) = other
 
+        self._set_timestep_columns(actions, log_probs, rewards, obs, dones)
+        self.future_rewards = np.asarray(future_rewards, dtype=np.float32)
+        self.values = np.asarray(values, dtype=np.float32)
+        self.advantages = np.asarray(advantages, dtype=np.float32)
+        self.pred_rets = np.asarray(pred_rets, dtype=np.float32)
+
     def truncate(self, stop):
-        self.actions = self.actions[:stop]
-        self.log_probs = self.log_probs[:stop]
-        self.rewards = self.rewards[:stop]
-        self.obs = self.obs[:stop]
-        self.dones = self.dones[:stop]
+        self._num_timesteps = min(self._num_timesteps, stop)
         self.future_rewards = self.future_rewards[:stop]
         self.values = self.values[:stop]
         self.advantages = self.advantages[:stop]
@@ -85,10 +200,11 @@ class Trajectory(object):
         if gamma is not None:
             self.future_rewards = RLMath.compute_discounted_future_sum(
                 self.rewards, gamma
-            ).tolist()
+            ).astype(np.float32)
 
         if values is not None:
-            self.values = [arg for arg in values]
+            values = np.asarray(values, dtype=np.float64)
+            self.values = values.astype(np.float32)
 
         if lmbda is not None:
             if reward_stats is not None:
@@ -102,8 +218,8 @@ class Trajectory(object):
 
             last_gae_lam = 0
             n_returns = len(rews)
-            adv = [0 for _ in range(n_returns)]
-            self.pred_rets = [0 for _ in range(n_returns)]
+            adv = np.zeros(n_returns)
+            pred_rets = np.zeros(n_returns)
 
             for step in reversed(range(n_returns)):
                 if step == n_returns - 1:
@@ -112,10 +228,91 @@ class Trajectory(object):
                     done = 1 - terminal[step + 1]
 
                 pred_ret = rews[step] + gamma * next_values[step] * done
-                self.pred_rets[step] = pred_ret
+                pred_rets[step] = pred_ret
                 delta = pred_ret - values[step]
                 last_gae_lam = delta + gamma * lmbda * done * last_gae_lam
                 adv[step] = last_gae_lam
 
-            self.advantages = adv
-            self.values = [v + a for v, a in zip(values[:-1], adv)]
+            self.pred_rets = pred_rets.astype(np.float32)
+            self.advantages = adv.astype(np.float32)
+            self.values = (values[:-1] + adv).astype(np.float32)
+
+
+def _empty():
+    return np.zeros(0, dtype=np.float32)
+
+
+def finalize_trajectories(trajectories, values, gamma, lmbda, reward_stats=None):
+    """
+    Finalize a group of trajectories at once. They are packed into one array
+    with their boundaries marked, and the discounted returns, TD targets and
+    GAE of all of them are computed with a handful of vectorized operations.
+    The results match calling finalize on every trajectory.
+    :param trajectories: List of trajectories.
+    :param values: List holding the value estimates of every trajectory, one
+                   more than its number of timesteps.
+    :param gamma: Discount factor.
+    :param lmbda: GAE lambda.
+    :param reward_stats: Optional (mean, std) of the rewards, the rewards are
+                         divided by std for the TD targets.
+    """
+
+    pairs = [(t, v) for t, v in zip(trajectories, values) if len(t) > 0]
+    if len(pairs) == 0:
+        return
+
+    trajectories = [t for t, _ in pairs]
+    lengths = np.asarray([len(t) for t in trajectories])
+    ends = np.cumsum(lengths) - 1
+    num_timesteps = ends[-1] + 1
+
+    rewards = np.concatenate([t.rewards for t in trajectories])
+    dones = np.concatenate([t.dones for t in trajectories])
+    packed_values = np.concatenate([np.asarray(v, dtype=np.float64) for _, v in pairs])
+
+    # Every trajectory has one more value than timesteps, so timestep t of
+    # trajectory i has its value at t + i.
+    value_indices = np.arange(num_timesteps) + np.repeat(
+        np.arange(len(trajectories)), lengths
+    )
+    current_values = packed_values[value_indices]
+    next_values = packed_values[value_indices + 1]
+
+    is_end = np.zeros(num_timesteps, dtype=bool)
+    is_end[ends] = True
+
+    # Same convention as finalize: a timestep is cut off from the next one by
+    # the done flag of that next timestep, and the last timestep of a
+    # trajectory by its own.
+    next_dones = np.empty(num_timesteps, dtype=np.float64)
+    next_dones[:-1] = dones[1:]
+    next_dones[ends] = dones[ends]
+    not_done = 1 - next_dones
+
+    rews = rewards
+    if reward_stats is not None:
+        mean, std = reward_stats
+        rews = np.divide(rewards, std)
+
+    future_rewards = RLMath.compute_segmented_discounted_future_sum(
+        rewards, gamma, is_end
+    )
+    pred_rets = rews + gamma * next_values * not_done
+    deltas = pred_rets - current_values
+    advantages = RLMath.compute_segmented_discounted_future_sum(
+        deltas, gamma * lmbda, is_end | (not_done == 0)
+    )
+    targets = current_values + advantages
+
+    splits = ends[:-1] + 1
+    for trajectory, fr, v, a, p in zip(
+        trajectories,
+        np.split(future_rewards.astype(np.float32), splits),
+        np.split(targets.astype(np.float32), splits),
+        np.split(advantages.astype(np.float32), splits),
+        np.split(pred_rets.astype(np.float32), splits),
+    ):
+        trajectory.future_rewards = fr
+        trajectory.values = v
+        trajectory.advantages = a
+        trajectory.pred_rets = p
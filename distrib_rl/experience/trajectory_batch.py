@@ -0,0 +1,300 @@
+from distrib_rl.utils import WelfordRunningStat
+import numpy as np
+
+# Declared column dtypes that numpy can't represent directly. bfloat16 columns
+# are carried as the raw uint16 bit patterns and bool columns are bit-packed on
+# the wire.
+BFLOAT16 = "bfloat16"
+PACKED_BOOL = "bool"
+
+
+def float32_to_bfloat16_bits(arr):
+    """
+    Round a float32 array to bfloat16 (round to nearest even) and return the
+    bit patterns as uint16.
+    """
+
+    bits = np.ascontiguousarray(arr, dtype=np.float32).view(np.uint32)
+    rounding = ((bits >> 16) & 1) + np.uint32(0x7FFF)
+    return ((bits + rounding) >> 16).astype(np.uint16)
+
+
+def bfloat16_bits_to_float32(bits):
+    return (np.asarray(bits, dtype=np.uint16).astype(np.uint32) << 16).view(np.float32)
+
+
+def cast_column(values, dtype):
+    if dtype == BFLOAT16:
+        return float32_to_bfloat16_bits(np.asarray(values, dtype=np.float32))
+    return np.asarray(values, dtype=dtype)
+
+
+def _get_moments(future_rewards):
+    if len(future_rewards) == 0:
+        return 0.0, 0.0, 0
+
+    mean, m2, count = WelfordRunningStat.batch_moments(future_rewards)
+    return float(mean), float(m2), count
+
+
+class TrajectoryBatch(object):
+    """
+    Columnar container for a group of finalized trajectories. Every
+    per-timestep field lives in one contiguous array and trajectory boundaries
+    are described by an offsets array, so a batch can be shipped as a handful
+    of raw buffers and rebuilt on the receiving end as numpy views without
+    creating a Python object per timestep.
+    """
+
+    FORMAT_VERSION = 2
+
+    TIMESTEP_COLUMNS = (
+        "actions",
+        "log_probs",
+        "rewards",
+        "obs",
+        "dones",
+        "future_rewards",
+        "values",
+        "advantages",
+        "pred_rets",
+    )
+    TRAJECTORY_COLUMNS = ("offsets", "policy_epochs", "ep_rews", "noise_idxs")
+
+    DTYPES = {
+        "actions": np.float32,
+        "log_probs": np.float32,
+        "rewards": np.float32,
+        "obs": np.float32,
+        "dones": np.float32,
+        "future_rewards": np.float32,
+        "values": np.float32,
+        "advantages": np.float32,
+        "pred_rets": np.float32,
+        "offsets": np.int64,
+        "policy_epochs": np.int64,
+        "ep_rews": np.float32,
+        "noise_idxs": np.int64,
+    }
+
+    def __init__(self, dtypes=None, reward_moments=None, **columns):
+        for name in (
+            TrajectoryBatch.TIMESTEP_COLUMNS + TrajectoryBatch.TRAJECTORY_COLUMNS
+        ):
+            setattr(self, name, columns.get(name, None))
+
+        # Declared dtype of every column, needed to tell bfloat16 columns apart
+        # from plain uint16 ones.
+        self.dtypes = TrajectoryBatch.get_column_dtypes(dtypes)
+
+        # (mean, sum of squared differences, count) of future_rewards, computed
+        # by whoever built the batch so the server can merge reward statistics
+        # without looking at every timestep. None if they have to be
+        # recomputed.
+        self.reward_moments = reward_moments
+
+    @staticmethod
+    def get_column_dtypes(declared=None):
+        """
+        Merge declared column dtypes, e.g. from experience_replay.dtypes in the
+        config, with the defaults.
+        :param declared: Dict mapping column names to dtype names. Supports any
+                         numpy dtype name plus bfloat16, and bool columns are
+                         bit-packed on the wire.
+        :return: Dict mapping every column name to a dtype name.
+        """
+
+        dtypes = {
+            name: np.dtype(dtype).name for name, dtype in TrajectoryBatch.DTYPES.items()
+        }
+        if not declared:
+            return dtypes
+
+        for name, dtype in declared.items():
+            if name not in dtypes:
+                raise ValueError(
+                    f"Unknown trajectory batch column '{name}'."
+                    f" Supported columns are {','.join(dtypes.keys())}"
+                )
+            dtypes[name] = dtype if dtype == BFLOAT16 else np.dtype(dtype).name
+
+        return dtypes
+
+    @property
+    def num_timesteps(self):
+        return int(self.offsets[-1])
+
+    @property
+    def num_trajectories(self):
+        return len(self.offsets) - 1
+
+    @property
+    def nbytes(self):
+        return sum(
+            getattr(self, name).nbytes
+            for name in TrajectoryBatch.TIMESTEP_COLUMNS
+            + TrajectoryBatch.TRAJECTORY_COLUMNS
+        )
+
+    @property
+    def trajectory_lengths(self):
+        return np.diff(self.offsets)
+
+    @staticmethod
+    def from_trajectories(trajectories, dtypes=None):
+        dtypes = TrajectoryBatch.get_column_dtypes(dtypes)
+        columns = {}
+        reward_moments = None
+        for name in TrajectoryBatch.TIMESTEP_COLUMNS:
+            column = np.concatenate(
+                [
+                    np.asarray(getattr(trajectory, name), dtype=np.float32)
+                    for trajectory in trajectories
+                ]
+            )
+            if name == "future_rewards":
+                # Taken before the column is cast so a reduced precision dtype
+                # doesn't bias the statistics.
+                reward_moments = _get_moments(column)
+            columns[name] = cast_column(column, dtypes[name])
+
+        lengths = [len(trajectory.rewards) for trajectory in trajectories]
+        offsets = np.zeros(len(trajectories) + 1, dtype=dtypes["offsets"])
+        np.cumsum(lengths, out=offsets[1:])
+
+        columns["offsets"] = offsets
+        columns["policy_epochs"] = cast_column(
+            [trajectory.policy_epoch for trajectory in trajectories],
+            dtypes["policy_epochs"],
+        )
+        columns["ep_rews"] = cast_column(
+            [trajectory.ep_rew for trajectory in trajectories],
+            dtypes["ep_rews"],
+        )
+        columns["noise_idxs"] = cast_column(
+            [trajectory.noise_idx for trajectory in trajectories],
+            dtypes["noise_idxs"],
+        )
+
+        return TrajectoryBatch(dtypes=dtypes, reward_moments=reward_moments, **columns)
+
+    @staticmethod
+    def concatenate(batches):
+        if len(batches) == 1:
+            return batches[0]
+
+        dtypes = batches[0].dtypes
+        for batch in batches:
+            if batch.dtypes != dtypes:
+                raise ValueError(
+                    "Can't concatenate trajectory batches with different column dtypes."
+                )
+
+        columns = {}
+        for name in (
+            TrajectoryBatch.TIMESTEP_COLUMNS + TrajectoryBatch.TRAJECTORY_COLUMNS
+        ):
+            if name == "offsets":
+                continue
+            columns[name] = np.concatenate([getattr(batch, name) for batch in batches])
+
+        offsets = [np.zeros(1, dtype=TrajectoryBatch.DTYPES["offsets"])]
+        start = 0
+        for batch in batches:
+            offsets.append(batch.offsets[1:] + start)
+            start += batch.num_timesteps
+        columns["offsets"] = np.concatenate(offsets)
+
+        reward_moments = None
+        if all(batch.reward_moments is not None for batch in batches):
+            stats = WelfordRunningStat(1)
+            for batch in batches:
+                stats.increment_from_obs_update(batch.reward_moments)
+            mean, m2, count = stats.get_moments()
+            reward_moments = float(mean[0]), float(m2[0]), count
+
+        return TrajectoryBatch(dtypes=dtypes, reward_moments=reward_moments, **columns)
+
+    def select(self, trajectory_mask):
+        """
+        Build a new batch containing only the trajectories for which
+        trajectory_mask is True.
+        :param trajectory_mask: Boolean array with one entry per trajectory.
+        :return: A new TrajectoryBatch.
+        """
+
+        lengths = self.trajectory_lengths
+        timestep_mask = np.repeat(trajectory_mask, lengths)
+
+        columns = {}
+        for name in TrajectoryBatch.TIMESTEP_COLUMNS:
+            columns[name] = getattr(self, name)[timestep_mask]
+
+        for name in TrajectoryBatch.TRAJECTORY_COLUMNS:
+            if name == "offsets":
+                continue
+            columns[name] = getattr(self, name)[trajectory_mask]
+
+        offsets = np.zeros(
+            np.count_nonzero(trajectory_mask) + 1, dtype=self.offsets.dtype
+        )
+        np.cumsum(lengths[trajectory_mask], out=offsets[1:])
+        columns["offsets"] = offsets
+
+        # Moments of the whole batch don't describe a subset of it.
+        reward_moments = self.reward_moments if trajectory_mask.all() else None
+        return TrajectoryBatch(
+            dtypes=self.dtypes, reward_moments=reward_moments, **columns
+        )
+
+    def serialize(self):
+        columns = []
+        for name in (
+            TrajectoryBatch.TIMESTEP_COLUMNS + TrajectoryBatch.TRAJECTORY_COLUMNS
+        ):
+            arr = np.ascontiguousarray(getattr(self, name))
+            dtype = self.dtypes[name]
+            if dtype == PACKED_BOOL:
+                data = np.packbits(arr.astype(np.bool_, copy=False))
+            else:
+                data = arr
+                if dtype != BFLOAT16:
+                    dtype = arr.dtype.str
+            # The view keeps the column's item size, the shuffling compressors
+            # need it.
+            columns.append((name, dtype, arr.shape, memoryview(data)))
+
+        return TrajectoryBatch.FORMAT_VERSION, columns, self.reward_moments
+
+    @staticmethod
+    def deserialize(data):
+        version = data[0]
+        if version != TrajectoryBatch.FORMAT_VERSION:
+            raise ValueError(
+                f"Received trajectory batch with unknown format version '{version}'."
+                f" Supported version is {TrajectoryBatch.FORMAT_VERSION}"
+            )
+        _, columns, reward_moments = data
+
+        # np.frombuffer gives us views directly over the received message, no
+        # per-element objects are created here.
+        decoded = {}
+        dtypes = {}
+        for name, dtype, shape, buffer in columns:
+            if dtype == PACKED_BOOL:
+                count = int(np.prod(shape))
+                arr = np.unpackbits(np.frombuffer(buffer, dtype=np.uint8), count=count)
+                decoded[name] = arr.view(np.bool_).reshape(shape)
+            else:
+                # bfloat16 columns stay raw uint16 bit patterns.
+                if dtype == BFLOAT16:
+                    np_dtype = np.dtype(np.uint16)
+                else:
+                    np_dtype = np.dtype(dtype)
+                    dtype = np_dtype.name
+                decoded[name] = np.frombuffer(buffer, dtype=np_dtype).reshape(shape)
+            dtypes[name] = dtype
+
+        if reward_moments is not None:
+            reward_moments = tuple(reward_moments)
+        return TrajectoryBatch(dtypes=dtypes, reward_moments=reward_moments, **decoded)
@@ -1,5 +1,5 @@
 from trueskill import rate_1vs1, Rating
-from distrib_rl.distrib import RedisClient, redis_keys
+from distrib_rl.distrib import redis_keys, transport_factory
 
 
 class OpponentSelector(object):
@@ -10,7 +10,7 @@ class OpponentSelector(object):
         self.policy_skill = Rating(100)
         self.known_policies = []
 
-        self.client = RedisClient()
+        self.client = transport_factory.get_client()
         self.client.connect()
 
     def get_opponent(self):
@@ -0,0 +1,71 @@
+"""
+    File name: shared_segments.py
+
+    Description:
+        Helpers for multiprocessing.shared_memory segments that are shared
+        between processes. Only the process which created a segment is
+        responsible for removing it, unless it hands that responsibility to
+        another process with disown_segment.
+"""
+
+from multiprocessing import shared_memory, resource_tracker
+import threading
+import sys
+
+_tracker_lock = threading.Lock()
+
+
+def open_segment(name, create=False, size=0):
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(
+            name=name, create=create, size=size, track=create
+        )
+
+    # Before python 3.13 every process that opens a segment registers it with
+    # the resource tracker, which unlinks it when that process exits. Only the
+    # creator of a segment should be responsible for it, so registration is
+    # skipped when attaching. The lock keeps segments created on other threads
+    # from being skipped as well.
+    with _tracker_lock:
+        if create:
+            return shared_memory.SharedMemory(name=name, create=True, size=size)
+
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+def disown_segment(segment):
+    """
+    Stop this process from removing a segment it created when it exits, so
+    another process can remove it once it's done with it.
+    """
+
+    if getattr(segment, "_track", True):
+        resource_tracker.unregister(segment._name, "shared_memory")
+
+
+def unlink_segment(name):
+    """
+    Remove a segment some other process created.
+    :return: False if the segment was already gone.
+    """
+
+    # Opened with tracking so that unlinking it doesn't confuse our resource
+    # tracker.
+    try:
+        segment = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return False
+
+    segment.close()
+    try:
+        segment.unlink()
+    except FileNotFoundError:
+        # Someone else removed it in the meantime.
+        resource_tracker.unregister(segment._name, "shared_memory")
+        return False
+    return True
@@ -52,6 +52,15 @@ class ContinuousFF(Policy):
 
         return action.cpu().numpy(), log_prob
 
+    @torch.no_grad()
+    def get_actions(self, obs):
+        mean, std = self.get_output(obs)
+        distribution = Normal(loc=mean, scale=std)
+        actions = distribution.sample()
+        log_probs = self.logpdf(actions, mean, std).sum(dim=-1)
+
+        return actions.cpu().numpy(), log_probs.cpu().numpy()
+
     def get_backprop_data(self, obs, acts, summed_probs=True):
         mean, std = self.get_output(obs)
         # mean, std = RLMath.map_policy_to_continuous_action(model_out)
@@ -1,3 +1,4 @@
+import torch
 from torch.distributions import Categorical
 from distrib_rl.policies import Policy
 from distrib_rl.utils.torch import torch_model_builder
@@ -19,6 +20,14 @@ class DiscreteFF(Policy):
 
         return action.cpu().item(), log_prob.cpu().item()
 
+    @torch.no_grad()
+    def get_actions(self, obs):
+        distribution = Categorical(probs=self.get_output(obs))
+        actions = distribution.sample()
+        log_probs = distribution.log_prob(actions)
+
+        return actions.cpu().numpy(), log_probs.cpu().numpy()
+
     def get_backprop_data(self, obs, acts):
         probs = self.get_output(obs)
 
@@ -1,3 +1,4 @@
+import torch
 from distrib_rl.policies import Policy
 from distrib_rl.utils.torch import torch_model_builder, torch_functions
 
@@ -20,6 +21,18 @@ class MultiDiscreteFF(Policy):
 
         return action.cpu().numpy(), log_prob.cpu().item()
 
+    @torch.no_grad()
+    def get_actions(self, obs):
+        distribution = self.multi_discrete
+        distribution.make_distribution(self.get_output(obs))
+
+        # The distribution squeezes away the batch dimension when there is only
+        # one row.
+        actions = distribution.sample().reshape(len(obs), -1)
+        log_probs = distribution.log_prob(actions.squeeze(0)).reshape(len(obs))
+
+        return actions.cpu().numpy(), log_probs.cpu().numpy()
+
     def get_backprop_data(self, obs, acts):
         logits = self.get_output(obs)
 
@@ -23,6 +23,18 @@ class Policy(nn.Module):
     def get_action(self, obs, deterministic=False):
         raise NotImplementedError
 
+    def get_actions(self, obs):
+        """
+        Sample an action for every row of a batch of observations. Subclasses
+        should override this with a single forward pass over the whole batch.
+        :param obs: Batch of observations.
+        :return: Tuple of (array of actions, array of log probabilities), one
+                 row per observation.
+        """
+
+        actions, log_probs = zip(*[self.get_action(row) for row in obs])
+        return np.asarray(actions), np.asarray(log_probs, dtype=np.float32)
+
     def build_model(self, model_json, input_shape, output_shape):
         raise NotImplementedError
 
@@ -1,12 +1,23 @@
 from distrib_rl.mpframework import ProcessHandler
 from distrib_rl.policy_optimization.distrib_policy_gradients import configurator
-from distrib_rl.distrib import RedisClient, RedisServer
+from distrib_rl.distrib import ServerTransport, transport_factory
 from distrib_rl.policy_optimization.distrib_policy_gradients.client_trajectory_finalizer import (
     ClientTrajectoryFinalizer,
 )
+import threading
 import torch
 import time
 
+# How long to wait before checking the server's backlog again while collection
+# is paused.
+THROTTLE_INTERVAL = 0.1
+
+# What a client does while the server's backlog is over its target. Clients
+# with a VectorEnv can halve the number of envs they step instead of pausing
+# outright, they only pause once they are down to one env.
+PAUSE_THROTTLE = "pause"
+ENVS_THROTTLE = "envs"
+
 
 class Client(object):
     def __init__(self):
@@ -20,6 +31,14 @@ class Client(object):
         self.trajectory_finalizer_handler = None
 
         self.last_checked = 0
+        self.policy_epoch = -1
+        self.pending_update = None
+        self.backlog_target = 0
+        self.throttle_mode = PAUSE_THROTTLE
+        self.active_envs = None
+        self.throttled = False
+        self._fetch_lock = threading.Lock()
+        self._swap_lock = threading.Lock()
 
     def train(self):
         running = True
@@ -35,8 +54,30 @@ class Client(object):
         n_sec = 1
         agent = self.agent
 
+        # Anything we collect while the server is this far behind would be
+        # thrown away before it gets used.
+        if self.is_throttled():
+            if self.active_envs is None or self.active_envs == 1:
+                time.sleep(THROTTLE_INTERVAL)
+                return
+
+            self.active_envs //= 2
+            print(f"Stepping {self.active_envs} of {self.env.num_envs} envs")
+        elif self.active_envs is not None and self.active_envs < self.env.num_envs:
+            self.active_envs = min(self.env.num_envs, self.active_envs * 2)
+            print(f"Stepping {self.active_envs} of {self.env.num_envs} envs")
+
+        kwargs = {}
+        if self.active_envs is not None:
+            kwargs["num_active_envs"] = self.active_envs
+
         for trajectory in agent.gather_timesteps(
-            self.policy, self.client.current_epoch, self.env, num_seconds=n_sec
+            self.policy,
+            self.policy_epoch,
+            self.env,
+            num_seconds=n_sec,
+            update_fn=self.apply_pending_update,
+            **kwargs,
         ):
             self.trajectory_finalizer_handler.put(
                 ClientTrajectoryFinalizer.HEADER_TRAJECTORY, data=trajectory
@@ -48,35 +89,94 @@ class Client(object):
         )
         agent.ep_rewards = []
 
-    def update_models(self):
-        (
-            policy_params,
-            strategy_frames,
-            strategy_history,
-            success,
-        ) = self.client.get_latest_update()
-        if not success:
+    def is_throttled(self):
+        if self.backlog_target <= 0:
             return False
 
+        backlog = self.client.get_ingest_backlog()
+        throttled = backlog > self.backlog_target
+        if throttled and not self.throttled:
+            print(
+                f"Server backlog of {backlog} timesteps is over the target of"
+                f" {self.backlog_target}, throttling collection"
+            )
+        elif self.throttled and not throttled:
+            print("Server caught up, resuming full collection")
+
+        self.throttled = throttled
+        return throttled
+
+    def update_models(self):
+        # While the listener is running new updates are fetched as soon as they
+        # are published, so we only poll the server if it isn't.
+        if not self.client.is_listening_for_updates():
+            self._fetch_update()
+
+        return self.apply_pending_update() is not None
+
+    def apply_pending_update(self):
+        """
+        Swap in the most recently fetched update, if there is one. This is
+        cheap enough to call every env step.
+        :return: The epoch of the new policy, or None if there was nothing to
+                 apply.
+        """
+
+        if self.pending_update is None:
+            return None
+
+        with self._swap_lock:
+            update = self.pending_update
+            self.pending_update = None
+
+        epoch, policy_params, strategy_frames, strategy_history = update
         self.policy.set_trainable_flat(policy_params)
         self.strategy_optimizer.set_from_server(strategy_frames, strategy_history)
+        self.policy_epoch = epoch
+
+        return epoch
+
+    def _fetch_update(self, epoch=None):
+        with self._fetch_lock:
+            (
+                policy_params,
+                strategy_frames,
+                strategy_history,
+                success,
+            ) = self.client.get_latest_update(epoch)
+            if not success:
+                return
+
+            update = (
+                self.client.current_epoch,
+                policy_params,
+                strategy_frames,
+                strategy_history,
+            )
 
-        return True
+            with self._swap_lock:
+                self.pending_update = update
+
+    def _on_new_epoch(self, epoch):
+        self._fetch_update(epoch)
 
     def check_server_status(self):
         server_status_flag = self.client.check_server_status()
 
-        if server_status_flag == RedisServer.RESET_STATUS or server_status_flag == None:
+        if (
+            server_status_flag == ServerTransport.RESET_STATUS
+            or server_status_flag == None
+        ):
             self.reset()
 
         elif (
-            server_status_flag == RedisServer.RECONFIGURE_STATUS
-            or server_status_flag == RedisServer.INITIALIZING_STATUS
-            or server_status_flag == RedisServer.STOPPING_STATUS
+            server_status_flag == ServerTransport.RECONFIGURE_STATUS
+            or server_status_flag == ServerTransport.INITIALIZING_STATUS
+            or server_status_flag == ServerTransport.STOPPING_STATUS
         ):
 
             self.reconfigure()
-        elif server_status_flag == RedisServer.AWAITING_ENV_SPACES_STATUS:
+        elif server_status_flag == ServerTransport.AWAITING_ENV_SPACES_STATUS:
             self.transmit_env_spaces()
 
     def reset(self):
@@ -114,10 +214,16 @@ class Client(object):
         env = self.env
         self.__init__()
 
-        self.client = RedisClient()
+        self.client = transport_factory.get_client()
 
         self.client.connect()
         self.cfg = self.client.get_cfg()
+        self.backlog_target = self.cfg.get("networking", {}).get(
+            "backlog_target", self.cfg["experience_replay"]["max_buffer_size"]
+        )
+        self.throttle_mode = (
+            self.cfg.get("networking", {}).get("throttle_mode", PAUSE_THROTTLE).lower()
+        )
 
         (
             self.env,
@@ -134,6 +240,10 @@ class Client(object):
             learner,
         ) = configurator.build_vars(self.cfg, existing_env=env)
 
+        num_envs = getattr(self.env, "num_envs", 1)
+        if self.throttle_mode == ENVS_THROTTLE and num_envs > 1:
+            self.active_envs = num_envs
+
         self.env.reset()
         self.transmit_env_spaces()
         self.last_checked = time.time()
@@ -142,6 +252,12 @@ class Client(object):
         while not self.update_models():
             time.sleep(1)
 
+        self.client.start_update_listener(self._on_new_epoch)
+
+        # Anything published before we subscribed would otherwise wait for the
+        # next epoch.
+        self._fetch_update()
+
         tfh_cfg = self.cfg.copy()
         tfh_cfg["env_space_shapes"] = (
             self.policy.input_shape,
@@ -1,8 +1,9 @@
+import threading
 import time
 
 import torch
-from distrib_rl.distrib import RedisClient, redis_keys
-from distrib_rl.distrib.redis_server import RedisServer
+from distrib_rl.distrib import ServerTransport, transport_factory
+from distrib_rl.experience import TrajectoryBatch, finalize_trajectories
 from distrib_rl.mpframework import Process
 import numpy as np
 from distrib_rl.policies import policy_factory
@@ -23,8 +24,13 @@ class ClientTrajectoryFinalizer(Process):
         self.lmbda = None
         self.value_estimator = None
         self.reward_stats = None
+        self.value_update_available = None
+        self.server_running = False
 
         self.trajectories_to_send = None
+        self.trajectory_values = None
+        self.pending_value_timesteps = None
+        self.value_batch_timesteps = None
         self.total_timesteps = None
         self.t0 = None
 
@@ -41,8 +47,13 @@ class ClientTrajectoryFinalizer(Process):
         self.lmbda = None
         self.value_estimator = None
         self.reward_stats = None
+        self.value_update_available = threading.Event()
+        self.server_running = False
 
         self.trajectories_to_send = []
+        self.trajectory_values = []
+        self.pending_value_timesteps = 0
+        self.value_batch_timesteps = None
         self.total_timesteps = 0
         self.t0 = None
 
@@ -51,6 +62,13 @@ class ClientTrajectoryFinalizer(Process):
         self.gamma = self.cfg["policy_optimizer"]["gamma"]
         self.lmbda = self.cfg["policy_optimizer"]["gae_lambda"]
 
+        # Values are estimated for the whole flush window at once, or every
+        # value_batch_timesteps observations if that is set, to bound the size
+        # of the forward pass.
+        self.value_batch_timesteps = self.cfg["policy_optimizer"].get(
+            "value_batch_timesteps", None
+        )
+
         pf_cfg = {
             "device": cfg.get("device", "cpu"),
             "value_estimator": cfg["value_estimator"],
@@ -67,8 +85,9 @@ class ClientTrajectoryFinalizer(Process):
             except:
                 pass
 
-        self.client = RedisClient()
+        self.client = transport_factory.get_client()
         self.client.connect()
+        self.client.configure(cfg)
 
         value_params = None
         while value_params is None:
@@ -78,9 +97,15 @@ class ClientTrajectoryFinalizer(Process):
 
         self.value_estimator.set_trainable_flat(value_params)
         self.reward_stats = self.client.get_reward_stats()
+        self.client.start_update_listener(
+            lambda epoch: self.value_update_available.set()
+        )
 
         self.trajectories_to_send = []
+        self.trajectory_values = []
+        self.pending_value_timesteps = 0
         self.total_timesteps = 0
+        self.server_running = self._server_is_running()
 
     def update(self, header, data):
         handler = self.handlers.get(header, None)
@@ -93,25 +118,48 @@ class ClientTrajectoryFinalizer(Process):
         handler(data)
 
     def _flush(self, rewards):
-        if self._server_is_running():
+        # The server status comes back with each flush, so we only bother
+        # packing this window's data if the server was running at the end of
+        # the previous one. The transport drops it anyway if the server stopped
+        # in the meantime.
+        if self.server_running:
             t1 = time.perf_counter()
 
+            experience = None
             if len(self.trajectories_to_send) > 0:
-                self.client.push_data(
-                    redis_keys.CLIENT_EXPERIENCE_KEY, self.trajectories_to_send
+                # Values, returns and advantages of the whole window are
+                # computed together, on packed arrays.
+                self._estimate_values()
+                finalize_trajectories(
+                    self.trajectories_to_send,
+                    self.trajectory_values,
+                    self.gamma,
+                    self.lmbda,
+                    reward_stats=self.reward_stats,
                 )
-                self.client.increment_timesteps(self.total_timesteps)
 
-                t2 = time.perf_counter()
+                # The batch carries the moments of this flush's future rewards,
+                # which the server merges into its reward statistics instead of
+                # visiting every timestep.
+                batch = TrajectoryBatch.from_trajectories(
+                    self.trajectories_to_send,
+                    dtypes=self.cfg["experience_replay"].get("dtypes", None),
+                )
+                experience = batch.serialize()
+            else:
+                rewards = None
+
+            status, self.reward_stats, value_params = self.client.flush(
+                experience, self.total_timesteps, rewards
+            )
+            self.server_running = status == ServerTransport.RUNNING_STATUS
 
+            if experience is not None:
                 # we use t1 here because we don't count the time involved in the
                 # send, as it's not blocking the game
                 seconds = t1 - self.t0
                 steps_per_second = float(self.total_timesteps) / seconds
 
-                if rewards:
-                    self.client.push_data(redis_keys.CLIENT_POLICY_REWARD_KEY, rewards)
-
                 print(
                     "packed and pushed {} trajectories containing {} timesteps in {:7.5f}s ({:.2f} sps)".format(
                         len(self.trajectories_to_send),
@@ -123,46 +171,76 @@ class ClientTrajectoryFinalizer(Process):
             else:
                 print("No trajectories to send.")
 
-            value_params = self.client.get_latest_value_params()
             if value_params is not None:
                 self.value_estimator.set_trainable_flat(value_params)
                 print(
                     f"updated value estimator to version {self.client.current_value_epoch}"
                 )
-
-            self.reward_stats = self.client.get_reward_stats()
+        else:
+            self.server_running = self._server_is_running()
 
         self.total_timesteps = 0
         self.trajectories_to_send = []
+        self.trajectory_values = []
+        self.pending_value_timesteps = 0
         self.t0 = time.perf_counter()
         print("")
 
-    @torch.no_grad()
     def _trajectory(self, trajectory):
         if self.t0 is None:
             self.t0 = time.perf_counter()
 
+        n_timesteps = len(trajectory)
+        self.trajectories_to_send.append(trajectory)
+        self.total_timesteps += n_timesteps
+        self.pending_value_timesteps += n_timesteps + 1
+
+        if (
+            self.value_batch_timesteps is not None
+            and self.pending_value_timesteps >= self.value_batch_timesteps
+        ):
+            self._estimate_values()
+
+    @torch.no_grad()
+    def _estimate_values(self):
+        """
+        Evaluate the value estimator on every trajectory that doesn't have
+        values yet, with one forward pass over their concatenated observations.
+        Each trajectory contributes its observations followed by its final one.
+        """
+
+        pending = self.trajectories_to_send[len(self.trajectory_values) :]
+        if len(pending) == 0:
+            return
+
+        if self.value_update_available.is_set():
+            self.value_update_available.clear()
+            self._update_value_estimator()
+
+        obs = []
+        for trajectory in pending:
+            final_obs = np.asarray(trajectory.final_obs, dtype=np.float32)
+            obs.append(trajectory.obs.reshape((len(trajectory),) + final_obs.shape))
+            obs.append(final_obs[None])
+
         values = (
-            self.value_estimator.get_output(
-                np.asarray(trajectory.obs + [trajectory.final_obs])
-            )
-            .flatten()
-            .tolist()
-        )
-        trajectory.finalize(
-            gamma=self.gamma,
-            reward_stats=self.reward_stats,
-            values=values,
-            lmbda=self.lmbda,
+            self.value_estimator.get_output(np.concatenate(obs)).cpu().numpy().flatten()
         )
-
-        n_timesteps = len(trajectory.rewards)
-        self.trajectories_to_send.append(trajectory.serialize())
-        self.total_timesteps += n_timesteps
+        offsets = np.cumsum([len(trajectory) + 1 for trajectory in pending])
+        self.trajectory_values += np.split(values, offsets[:-1])
+        self.pending_value_timesteps = 0
+
+    def _update_value_estimator(self):
+        value_params = self.client.get_latest_value_params()
+        if value_params is not None:
+            self.value_estimator.set_trainable_flat(value_params)
+            print(
+                f"updated value estimator to version {self.client.current_value_epoch}"
+            )
 
     def _server_is_running(self):
         server_status_flag = self.client.check_server_status()
-        return server_status_flag == RedisServer.RUNNING_STATUS
+        return server_status_flag == ServerTransport.RUNNING_STATUS
 
     def step(self):
         pass
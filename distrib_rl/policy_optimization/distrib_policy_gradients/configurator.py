@@ -8,6 +8,8 @@ from distrib_rl.experience import ExperienceReplay
 from distrib_rl.strategy import StrategyOptimizer
 from distrib_rl.utils import AdaptiveOmega
 from distrib_rl.policy_optimization.learners import *
+from distrib_rl.environments import VectorEnv
+import functools
 import gym
 import numpy as np
 import random
@@ -24,7 +26,22 @@ def build_env(cfg, existing_env=None):
     _register_custom_envs(cfg)
 
     if existing_env is None:
-        env = gym.make(cfg["env_id"], new_step_api=True, **cfg.get("env_kwargs", {}))
+        agent_cfg = cfg.get("agent", {})
+        num_envs = agent_cfg.get("num_envs", 1)
+        if num_envs > 1:
+            # Only what's needed to build the env is sent to subprocess
+            # workers.
+            env_cfg = {
+                key: cfg[key]
+                for key in ("env_id", "env_kwargs", "custom_envs")
+                if key in cfg
+            }
+            env = VectorEnv(
+                [functools.partial(make_env, env_cfg) for _ in range(num_envs)],
+                asynchronous=agent_cfg.get("async_envs", False),
+            )
+        else:
+            env = make_env(cfg)
     else:
         env = existing_env
 
@@ -36,6 +53,11 @@ def build_env(cfg, existing_env=None):
     return env
 
 
+def make_env(cfg):
+    _register_custom_envs(cfg)
+    return gym.make(cfg["env_id"], new_step_api=True, **cfg.get("env_kwargs", {}))
+
+
 def build_vars(cfg, existing_env=None, env_space_shapes=None):
     seed = cfg["seed"]
     cfg["rng"] = np.random.RandomState(seed)
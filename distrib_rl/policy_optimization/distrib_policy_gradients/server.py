@@ -1,6 +1,6 @@
 from distrib_rl.policy_optimization.distrib_policy_gradients import configurator
 from distrib_rl.marl import OpponentSelector
-from distrib_rl.distrib import RedisServer, redis_keys
+from distrib_rl.distrib import ServerTransport, transport_factory
 from distrib_rl.utils import config_loader
 from distrib_rl.experience import ParallelExperienceManager
 import time
@@ -65,7 +65,7 @@ class Server(object):
             #     redis_keys.SERVER_CUMULATIVE_TIMESTEPS_KEY, self.cumulative_ts
             # )
 
-            current_ts = float(self.server.redis.get(redis_keys.SERVER_CUMULATIVE_TIMESTEPS_KEY))
+            current_ts = float(self.server.get_cumulative_timesteps())
             current_time = time.perf_counter()
             sps = (current_ts - self.last_measured_ts) / (current_time - self.last_ts_measure_time)
             self.last_measured_ts = current_ts
@@ -75,11 +75,8 @@ class Server(object):
             else:
                 self.steps_per_second = self.steps_per_second*0.9 + sps*0.1
 
-            self.server.redis.set(
-                redis_keys.RUNNING_REWARD_MEAN_KEY, float(self.exp_manager.rew_mean)
-            )
-            self.server.redis.set(
-                redis_keys.RUNNING_REWARD_STD_KEY, float(self.exp_manager.rew_std)
+            self.server.set_reward_stats(
+                self.exp_manager.rew_mean, self.exp_manager.rew_std
             )
 
             self.epoch_info["steps_per_second"] = int(round(self.steps_per_second))
@@ -105,6 +102,20 @@ class Server(object):
         del self.epoch_info["learner"]["val_loss"]
 
         self.epoch_info["ts_consumed"] = ts_collected
+        self.epoch_info["data_wait_time"] = self.exp_manager.data_wait_time
+        self.epoch_info["decode_time"] = self.exp_manager.decode_time
+        self.epoch_info["ts_dropped"] = self.exp_manager.dropped_timesteps
+        self.epoch_info["ts_stale"] = self.exp_manager.stale_timesteps
+
+        lag_counts = self.exp_manager.policy_lag_counts
+        if lag_counts is None or lag_counts.sum() == 0:
+            self.epoch_info["policy_lag"] = []
+            self.epoch_info["mean_policy_lag"] = 0
+        else:
+            self.epoch_info["policy_lag"] = lag_counts.tolist()
+            self.epoch_info["mean_policy_lag"] = float(
+                np.dot(np.arange(len(lag_counts)), lag_counts) / lag_counts.sum()
+            )
 
         self.cumulative_ts += ts_collected
         self.epoch_info["cumulative_timesteps"] = self.cumulative_ts
@@ -215,32 +226,27 @@ class Server(object):
         return False
 
     def setup_redis(self, cfg):
-        self.server = RedisServer(cfg["experience_replay"]["max_buffer_size"])
-        self.server.connect(clear_existing=True)
-        self.server.redis.set(
-            redis_keys.SERVER_CURRENT_STATUS_KEY, RedisServer.RECONFIGURE_STATUS
+        self.server = transport_factory.get_server(
+            cfg["experience_replay"]["max_buffer_size"]
         )
+        self.server.connect(clear_existing=True)
+        self.server.set_status(ServerTransport.RECONFIGURE_STATUS)
         print("Connected to redis. Waiting for clients...")
         time.sleep(2)
         self.server.push_cfg(cfg)
-        self.server.redis.set(redis_keys.RUNNING_REWARD_MEAN_KEY, 0)
-        self.server.redis.set(redis_keys.RUNNING_REWARD_STD_KEY, 1)
+        self.server.set_reward_stats(0, 1)
         return self.server.get_env_spaces()
 
     def reset(self):
         print("SERVER RESETTING")
-        self.server.redis.set(
-            redis_keys.SERVER_CURRENT_STATUS_KEY, RedisServer.RESET_STATUS
-        )
+        self.server.set_status(ServerTransport.RESET_STATUS)
         print("WAITING 2 SECONDS FOR ALL CLIENTS TO CATCH UP ON RESET SIGNAL")
         time.sleep(2)
         self.cleanup()
 
     def reconfigure(self):
         print("SERVER RECONFIGURING")
-        self.server.redis.set(
-            redis_keys.SERVER_CURRENT_STATUS_KEY, RedisServer.RECONFIGURE_STATUS
-        )
+        self.server.set_status(ServerTransport.RECONFIGURE_STATUS)
         print("WAITING 2 SECONDS FOR ALL CLIENTS TO CATCH UP ON RECONFIGURE SIGNAL")
         time.sleep(2)
         self.cleanup()
@@ -314,7 +320,15 @@ class Server(object):
             return
 
         if self.cfg["log_to_wandb"]:
-            wandb.log(info)
+            # wandb can't plot a list of counts, so the histogram is handed
+            # over prebinned.
+            wandb_info = dict(info)
+            lag_counts = wandb_info.pop("policy_lag")
+            if len(lag_counts) > 0:
+                wandb_info["policy_lag"] = wandb.Histogram(
+                    np_histogram=(lag_counts, np.arange(len(lag_counts) + 1))
+                )
+            wandb.log(wandb_info)
 
         asterisks = "*" * 8
         report = (
@@ -328,11 +342,17 @@ class Server(object):
             "Update Magnitude:      {:7.5f}\n"
             "Omega:                 {:7.5f}\n\n"
             "TS This Epoch          {:7}\n"
+            "TS Dropped             {:7}\n"
+            "TS Stale               {:7}\n"
+            "Mean Policy Lag        {:7.5f}\n"
+            "Policy Lag             {}\n"
             "Cumulative TS          {:7}\n"
             "Steps Per Second       {:7}\n"
             "Value loss:            {:7.5f}\n"
             "Learning Rate:         {:7.5f}\n"
             "Epoch Time:            {:7.5f}\n"
+            "Data Wait Time:        {:7.5f}\n"
+            "Decode Time:           {:7.5f}\n"
             "{} END EPOCH {} REPORT {}\n".format(
                 asterisks,
                 info["epoch"],
@@ -346,11 +366,17 @@ class Server(object):
                 info["update_magnitude"],
                 info["omega"],
                 info["ts_consumed"],
+                info["ts_dropped"],
+                info["ts_stale"],
+                info["mean_policy_lag"],
+                self._format_policy_lag(info["policy_lag"]),
                 info["cumulative_timesteps"],
                 info["steps_per_second"],
                 info["val_loss"],
                 info["learner"]["learning_rate"],
                 info["epoch_time"],
+                info["data_wait_time"],
+                info["decode_time"],
                 asterisks,
                 info["epoch"],
                 asterisks,
@@ -358,6 +384,16 @@ class Server(object):
         )
         print(report)
 
+    def _format_policy_lag(self, lag_counts):
+        # Only epochs of lag that actually occurred are listed, the last bin
+        # also holds everything older than it.
+        last = len(lag_counts) - 1
+        return " ".join(
+            "{}{}:{}".format(lag, "+" if lag == last else "", count)
+            for lag, count in enumerate(lag_counts)
+            if count > 0
+        )
+
     def cleanup(self):
         if self.server is not None:
             self.server.disconnect()
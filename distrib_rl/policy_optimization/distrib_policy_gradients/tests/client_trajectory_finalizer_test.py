@@ -0,0 +1,83 @@
+from distrib_rl.policy_optimization.distrib_policy_gradients.client_trajectory_finalizer import (
+    ClientTrajectoryFinalizer,
+)
+from distrib_rl.experience import Trajectory
+import numpy as np
+import torch
+
+OBS_SIZE = 3
+TRAJECTORY_LENGTHS = (4, 1, 6, 3, 2)
+
+
+class FakeValueEstimator(object):
+    """
+    Values each observation by a weighted sum of its entries, so every value
+    can be traced back to the observation it came from.
+    """
+
+    def __init__(self):
+        self.batch_sizes = []
+
+    def get_output(self, obs):
+        obs = np.asarray(obs)
+        self.batch_sizes.append(len(obs))
+        weights = np.arange(1, OBS_SIZE + 1, dtype=np.float32)
+        return torch.as_tensor(obs @ weights).reshape(-1, 1)
+
+
+def build_trajectory(num_timesteps, seed):
+    rng = np.random.RandomState(seed)
+    trajectory = Trajectory(0)
+    for i in range(num_timesteps):
+        obs = rng.normal(size=OBS_SIZE).astype(np.float32)
+        trajectory.add(0, -0.5, 1.0, obs, 1 if i == num_timesteps - 1 else 0)
+    trajectory.final_obs = rng.normal(size=OBS_SIZE).astype(np.float32)
+    return trajectory
+
+
+def estimate_values(value_batch_timesteps):
+    finalizer = ClientTrajectoryFinalizer()
+    finalizer.init()
+    finalizer.value_estimator = FakeValueEstimator()
+    finalizer.value_batch_timesteps = value_batch_timesteps
+
+    trajectories = [
+        build_trajectory(length, seed) for seed, length in enumerate(TRAJECTORY_LENGTHS)
+    ]
+    for trajectory in trajectories:
+        finalizer._trajectory(trajectory)
+    # The flush evaluates whatever is left below the threshold.
+    finalizer._estimate_values()
+
+    # Each trajectory's split must match evaluating it on its own, final obs
+    # last.
+    reference = FakeValueEstimator()
+    assert len(finalizer.trajectory_values) == len(trajectories)
+    for trajectory, values in zip(trajectories, finalizer.trajectory_values):
+        obs = np.concatenate((trajectory.obs, trajectory.final_obs[None]))
+        expected = reference.get_output(obs).numpy().flatten()
+        assert len(values) == len(trajectory) + 1
+        assert np.allclose(values, expected)
+
+    assert finalizer.pending_value_timesteps == 0
+    return finalizer.value_estimator.batch_sizes
+
+
+def run_test():
+    total_values = sum(length + 1 for length in TRAJECTORY_LENGTHS)
+
+    # Without a threshold the whole window goes through a single forward pass.
+    batch_sizes = estimate_values(None)
+    assert batch_sizes == [total_values]
+
+    # With one, values are estimated as soon as enough observations are
+    # waiting.
+    batch_sizes = estimate_values(8)
+    assert batch_sizes == [14, 7]
+    assert sum(batch_sizes) == total_values
+
+    print("Finalizer values match per trajectory evaluation")
+
+
+if __name__ == "__main__":
+    run_test()
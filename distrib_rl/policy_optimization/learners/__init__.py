@@ -1,4 +1,3 @@
 from .ppo import PPO
-from .reinforce import REINFORCE
 from .distrib_ppo import DistribPPO
 from .ppons import PPONS
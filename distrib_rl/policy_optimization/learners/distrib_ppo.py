@@ -77,11 +77,13 @@ class DistribPPO(object):
         for batch in batches:
             acts, old_probs, obs, target_values, advantages = batch
 
-            acts = acts.to(device)
-            obs = obs.to(device)
-            advantages = advantages.to(device)
-            old_probs = old_probs.to(device)
-            target_values = target_values.to(device)
+            # Minibatches are gathered on our device already, but the replay
+            # may store them in reduced precision.
+            acts = acts.float()
+            obs = obs.float()
+            advantages = advantages.float()
+            old_probs = old_probs.float()
+            target_values = target_values.float()
 
             vals = value_net.get_output(obs).view_as(target_values)
 
@@ -61,11 +61,11 @@ class PPONS(object):
         for batch in batches:
             acts, old_probs, obs, target_values, advantages = batch
 
-            acts = acts.to(device)
-            obs = obs.to(device)
-            advantages = advantages.to(device)
-            old_probs = old_probs.to(device)
-            target_values = target_values.to(device)
+            acts = acts.to(device).float()
+            obs = obs.to(device).float()
+            advantages = advantages.to(device).float()
+            old_probs = old_probs.to(device).float()
+            target_values = target_values.to(device).float()
 
             vals = value_net.get_output(obs).view_as(target_values)
 
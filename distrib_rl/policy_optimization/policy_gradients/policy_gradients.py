@@ -92,7 +92,7 @@ class PolicyGradients(object):
                 value_estimator.get_output(trajectory.obs).flatten().numpy().tolist()
             )
             final_val = (
-                value_estimator.get_output(trajectory.next_obs[-1]).numpy().tolist()
+                value_estimator.get_output(trajectory.final_obs).numpy().tolist()
             )
             values.append(final_val[0])
             trajectory.finalize(
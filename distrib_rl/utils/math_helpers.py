@@ -24,6 +24,33 @@ def compute_discounted_future_sum(arr, discount):
     return scipy.signal.lfilter([1], [1, float(-discount)], arr[::-1], axis=0)[::-1]
 
 
+def compute_segmented_discounted_future_sum(arr, discount, is_end):
+    """
+    Discounted future sum of many sequences packed back to back, computed with
+    one filter over the whole array. The part of each sum that leaks in from
+    the following sequences is subtracted afterwards.
+    :param arr: 1D array.
+    :param discount: Discount factor.
+    :param is_end: Boolean array that is True at the last index of every
+                   sequence, including the last index of arr.
+    :return: Float64 array where every entry only sums up to the end of its own
+             sequence.
+    """
+
+    arr = np.asarray(arr, dtype=np.float64)
+    sums = compute_discounted_future_sum(arr, discount)
+
+    ends = np.flatnonzero(is_end)
+    indices = np.arange(len(arr))
+    next_starts = ends[np.searchsorted(ends, indices)] + 1
+    leaking = next_starts < len(arr)
+
+    sums[leaking] -= sums[next_starts[leaking]] * float(discount) ** (
+        next_starts[leaking] - indices[leaking]
+    )
+    return sums
+
+
 @functools.lru_cache()
 def apply_affine_map(value, from_min, from_max, to_min, to_max):
     if from_max == from_min or to_max == to_min:
@@ -18,11 +18,30 @@ class WelfordRunningStat(object):
 
     def increment(self, samples, num):
         if num > 1:
-            for i in range(num):
-                self.update(samples[i])
-        else:
+            samples = np.asarray(samples).reshape((num,) + self.running_mean.shape)
+            self.increment_from_obs_update(WelfordRunningStat.batch_moments(samples))
+        elif num == 1:
             self.update(samples)
 
+    @staticmethod
+    def batch_moments(samples):
+        """
+        Moments of a batch of samples in the form increment_from_obs_update
+        expects, so a batch can be merged in one step (Chan et al.) rather than
+        one sample at a time.
+        :param samples: Array with one sample per row.
+        :return: Tuple of (mean, sum of squared differences from the mean,
+                 count).
+        """
+
+        samples = np.asarray(samples, dtype=np.float64)
+        mean = samples.mean(axis=0)
+        delta = samples - mean
+        return mean, (delta * delta).sum(axis=0), len(samples)
+
+    def get_moments(self):
+        return self.running_mean.copy(), self.running_variance.copy(), self.count
+
     def update(self, sample):
         current_count = self.count
         self.count += 1
@@ -59,6 +78,8 @@ class WelfordRunningStat(object):
         other_mean = np.asarray(obs_stats_update[0], dtype=np.float32)
         other_var = np.asarray(obs_stats_update[1], dtype=np.float32)
         other_count = obs_stats_update[2]
+        if other_count == 0:
+            return
 
         count = self.count + other_count
 
@@ -75,6 +96,8 @@ class WelfordRunningStat(object):
             + mean_delta_squared * self.count * other_count / count
         )
 
-        self.running_mean = combined_mean
-        self.running_variance = combined_variance
+        # Large counts promote the arithmetic above to float64, the stats
+        # themselves stay float32.
+        self.running_mean[...] = combined_mean
+        self.running_variance[...] = combined_variance
         self.count = count
@@ -32,7 +32,7 @@ setup(
         "trueskill==0.4.5",
         "wandb==0.13.1",
     ],
-    python_requires=">=3.7",
+    python_requires=">=3.8",
     license="Apache 2.0",
     license_file="LICENSE",
     keywords=[